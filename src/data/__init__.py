@@ -0,0 +1,7 @@
+"""Preparación de datos de AURA (TCGA-KIRC y KiTS23 para nnU-Net).
+
+Uso desde la raíz del proyecto:  python -m src.data <comando>
+(`python -m src.data --help` lista los comandos). Los módulos no hacen
+nada al importarse y las dependencias pesadas (SimpleITK, nibabel, PIL,
+pandas, tcia_utils) se cargan solo dentro de las funciones que las usan.
+"""
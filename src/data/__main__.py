@@ -0,0 +1,95 @@
+import os
+import sys
+import argparse
+import importlib
+
+# comando -> (módulo, función, ayuda). El módulo solo se importa al ejecutar su comando.
+COMMANDS = {
+    "download": ("download_tcga", "main", "Descarga las series DICOM de TCGA-KIRC"),
+    "stream-tcga": ("stream_process_tcga", "main", "Descarga, convierte y limpia TCGA-KIRC por lotes"),
+    "catalog": ("dicom_catalog", "main", "Actualiza el catálogo de series DICOM"),
+    "convert": ("convert_dicom_to_nifti", "main", "Convierte las series DICOM descargadas a NIfTI"),
+    "kits-organize": ("kits_organizer", "main", "Organiza KiTS23 para nnU-Net conservando el origen"),
+    "kits-move": ("stream_reorganizer_kits", "main", "Mueve KiTS23 a nnU-Net liberando el origen"),
+    "kits-png": ("reconstruct_kits_from_png", "main", "Reconstruye volúmenes KiTS23 desde PNG"),
+    "check": ("nifti_integrity_checker", "check_files", "Verifica la integridad de los NIfTI del dataset"),
+    "verify": ("dataset_verifier", "main", "Verifica el emparejamiento imagen/etiqueta del dataset"),
+    "fingerprint": ("dataset_fingerprint", "main", "Calcula dataset_fingerprint.json de nnU-Net (solo casos sin huella)"),
+    "cache": ("volume_cache", "main", "Cachea los NIfTI como .npy mapeables en memoria y limpia lo obsoleto"),
+    "dedup": ("content_store", "main", "Deduplica datos crudos y convertidos en el almacén por contenido"),
+    "ingest": ("ingest_daemon", "main", "Vigila las carpetas crudas e incorpora al dataset lo que va llegando"),
+    "fake-nbia-bench": ("fake_nbia", "main", "Benchmark de descarga contra un NBIA simulado"),
+    "benchmark": ("benchmark", "main", "Mide cada etapa con datos sintéticos (sin red ni datos reales)"),
+}
+
+# Opciones por comando; las que no se pasan usan el valor por defecto de la función
+OPTIONS = {
+    "check": [
+        (("--deep",), dict(action="store_true", default=None,
+                           help="Descomprime cada volumen (truncados, NaN/Inf, etiquetas, SHA-256)")),
+        (("--dataset-dir",), dict(metavar="CARPETA",
+                                  help="Dataset nnU-Net a verificar (por defecto Dataset101_KiTS23)")),
+    ],
+    "verify": [
+        (("--dataset-dir",), dict(metavar="CARPETA",
+                                  help="Dataset nnU-Net a verificar (por defecto Dataset101_KiTS23)")),
+    ],
+    "dedup": [
+        (("--report-only",), dict(action="store_true", default=None,
+                                  help="Solo muestra cuánto espacio recupera la deduplicación")),
+        (("--gc",), dict(action="store_true", default=None,
+                         help="Borra los objetos del almacén que ya no usa ningún archivo")),
+    ],
+    "ingest": [
+        (("--once",), dict(action="store_true", default=None,
+                           help="Una sola pasada: procesa lo que ya está listo y termina")),
+        (("--interval",), dict(type=float, help="Segundos entre pasadas")),
+    ],
+    "benchmark": [
+        (("--save",), dict(action="store_true", default=None, help="Guarda los resultados como línea base")),
+        (("--compare",), dict(action="store_true", default=None,
+                              help="Compara con la línea base y termina con error si hay regresiones")),
+        (("--scale",), dict(type=int, help="Multiplica el número de series y casos sintéticos")),
+        (("--stages",), dict(nargs="+", metavar="ETAPA", help="Etapas a medir (por defecto todas)")),
+        (("--baseline-path",), dict(help="Archivo JSON de la línea base")),
+    ],
+}
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m src.data",
+                                     description="Preparación de datos de AURA.")
+    # Se pasan por variables de entorno para que las hereden los procesos de cada pool
+    parser.add_argument("--profile", metavar="ETAPA",
+                        help="Perfila con cProfile cada ejecución de ETAPA (p. ej. nifti_write)")
+    parser.add_argument("--no-metrics", action="store_true",
+                        help="No registra tiempo, bytes ni pico de RAM por etapa")
+    parser.add_argument("--prometheus", metavar="ARCHIVO",
+                        help="Escribe el resumen de la corrida para el textfile collector de Prometheus")
+    parser.add_argument("--volume-cache", action="store_true",
+                        help="Los conversores dejan también una copia .npy sin comprimir (ver comando cache)")
+    subparsers = parser.add_subparsers(dest="command", required=True, metavar="comando")
+    for name, (_, _, help_text) in COMMANDS.items():
+        sub = subparsers.add_parser(name, help=help_text, description=help_text)
+        for flags, kwargs in OPTIONS.get(name, []):
+            sub.add_argument(*flags, **kwargs)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    global_options = {"profile": "AURA_PROFILE_STAGE", "prometheus": "AURA_PROMETHEUS_PATH"}
+    for option, variable in global_options.items():
+        if getattr(args, option):
+            os.environ[variable] = getattr(args, option)
+    if args.no_metrics:
+        os.environ["AURA_METRICS"] = "0"
+    if args.volume_cache:
+        os.environ["AURA_VOLUME_CACHE"] = "1"
+    module_name, function_name, _ = COMMANDS[args.command]
+    module = importlib.import_module(f".{module_name}", __package__)
+    function = getattr(module, function_name)
+    skip = {"command", "no_metrics", "volume_cache", *global_options}
+    options = {k: v for k, v in vars(args).items() if k not in skip and v is not None}
+    return function(**options)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+import threading
+from collections import deque
+
+# --- CONFIGURACIÓN ---
+# Duración buscada para la descarga de cada lote: lotes más cortos desperdician el
+# solapamiento con la conversión, más largos hacen el espacio temporal menos predecible
+TARGET_BATCH_SECONDS = 120
+# Tope de series por lote (muchos scouts pequeños no deben formar un lote interminable)
+MAX_BATCH_SERIES = 100
+# Tamaño estimado de una serie sin FileSize: por imagen (512x512 int16 + cabecera DICOM)
+# o, sin ImageCount tampoco, una serie típica
+BYTES_PER_IMAGE = 525 * 1024
+DEFAULT_SERIES_BYTES = 300 * 1024**2
+# Valores de partida hasta medir la primera descarga
+INITIAL_THROUGHPUT = 20 * 1024**2   # bytes/s entre todas las descargas simultáneas
+INITIAL_LATENCY = 2.0               # segundos fijos por petición (getImage, ZIP, renombrado)
+# Peso de la última medición en la media móvil y series recientes para estimar la latencia
+SMOOTHING = 0.3
+LATENCY_WINDOW = 64
+# ---------------------
+
+
+def series_bytes(series):
+    """Bytes estimados de una serie con los metadatos de getSeries."""
+    if series.get("FileSize"):
+        return int(series["FileSize"])
+    if series.get("ImageCount"):
+        return int(series["ImageCount"]) * BYTES_PER_IMAGE
+    return DEFAULT_SERIES_BYTES
+
+
+def _fit_latency(samples):
+    """Ajusta segundos = latencia + bytes / ancho de banda por mínimos cuadrados.
+
+    Devuelve la latencia (None si no hay tamaños distintos para separarla del ancho de banda).
+    """
+    n = len(samples)
+    if n < 2:
+        return None
+    mean_b = sum(b for b, _ in samples) / n
+    mean_s = sum(s for _, s in samples) / n
+    var_b = sum((b - mean_b) ** 2 for b, _ in samples)
+    if var_b == 0:
+        return None
+    slope = sum((b - mean_b) * (s - mean_s) for b, s in samples) / var_b
+    if slope <= 0:
+        # Sin relación con el tamaño: todo el tiempo es latencia
+        return mean_s
+    return max(0.0, mean_s - slope * mean_b)
+
+
+class BatchSizer:
+    """Arma lotes de descarga por tiempo estimado en vez de por número de series.
+
+    Cada serie cuesta `latencia / descargas simultáneas + bytes / throughput`:
+    los scouts pequeños pesan casi solo por la latencia y entran muchos por
+    lote; una serie que sola ya supera TARGET_BATCH_SECONDS va sola. El
+    throughput (de todas las descargas juntas) y la latencia por petición se
+    recalculan con cada lote descargado (`observe`), así que los lotes
+    siguientes se ajustan a la red real. `max_bytes` acota además los bytes
+    por lote (p. ej. al espacio temporal disponible).
+    """
+
+    def __init__(self, sizes, workers, target_seconds=TARGET_BATCH_SECONDS,
+                 max_series=MAX_BATCH_SERIES, max_bytes=None):
+        self.sizes = sizes  # {uid: bytes estimados}
+        self.workers = max(1, workers)
+        self.target_seconds = target_seconds
+        self.max_series = max_series
+        self.max_bytes = max_bytes
+        self.throughput = INITIAL_THROUGHPUT
+        self.latency = INITIAL_LATENCY
+        self.samples = deque(maxlen=LATENCY_WINDOW)
+        self.lock = threading.Lock()
+
+    def series_cost(self, uid):
+        """Segundos que una serie añade a la descarga de su lote."""
+        return self.latency / self.workers + self.sizes.get(uid, DEFAULT_SERIES_BYTES) / self.throughput
+
+    def observe(self, summary):
+        """Actualiza throughput y latencia con el resumen de download_series de un lote."""
+        timings = summary.get("timings", [])
+        with self.lock:
+            # Las descargas simultáneas pueden haber cambiado (AdaptiveConcurrency)
+            self.workers = max(1, summary.get("workers") or self.workers)
+            self.samples.extend(timings)
+            latency = _fit_latency(self.samples)
+            if latency is not None:
+                self.latency += SMOOTHING * (latency - self.latency)
+            if summary["bytes"] and summary["seconds"] > 0:
+                # El tiempo de red sin la latencia de las peticiones (que ya cuenta aparte)
+                transfer = max(summary["seconds"] - len(timings) * self.latency / self.workers,
+                               0.1 * summary["seconds"])
+                measured = summary["bytes"] / transfer
+                self.throughput += SMOOTHING * (measured - self.throughput)
+
+    def next_batch(self, pending):
+        """Saca de `pending` (deque de UIDs, en orden) las series del siguiente lote."""
+        with self.lock:
+            batch, seconds, nbytes = [], 0.0, 0
+            while pending and len(batch) < self.max_series:
+                uid = pending[0]
+                cost, size = self.series_cost(uid), self.sizes.get(uid, DEFAULT_SERIES_BYTES)
+                too_long = seconds + cost > self.target_seconds
+                too_big = self.max_bytes is not None and nbytes + size > self.max_bytes
+                if batch and (too_long or too_big):
+                    break
+                batch.append(pending.popleft())
+                seconds += cost
+                nbytes += size
+            return batch
+
+    def describe(self):
+        return f"{self.throughput / 1024**2:.1f} MB/s, {self.latency:.1f} s por petición"
@@ -0,0 +1,319 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+# --- CONFIGURACIÓN ---
+# Línea base con los resultados de referencia (para comparar tras un cambio)
+BASELINE_PATH = Path("data/benchmark_baseline.json")
+# Tamaño de los datos sintéticos (se pueden escalar con --scale)
+NUM_SERIES = 4
+NUM_CASES = 4
+NUM_SLICES = 64
+SLICE_SIZE = 256
+# Un cambio es regresión si el throughput baja (o el pico de RAM sube) más de esto
+REGRESSION_TOLERANCE = 0.15
+# Semilla de los datos sintéticos (mismos datos en cada corrida)
+SEED = 1234
+# ---------------------
+
+STAGES = ("convert", "reconstruct", "organize", "move", "check")
+
+# --- Datos sintéticos ---
+
+def make_phantom(num_slices, size, seed=SEED):
+    """Volumen (Z, Y, X) tipo TC abdominal y su etiqueta KiTS (riñones, tumor, quiste).
+
+    Cuerpo elíptico de tejido blando sobre aire, con ruido: se comprime de
+    forma parecida a una TC real (el ruido uniforme puro no lo hace).
+    """
+    import numpy as np
+    rng = np.random.RandomState(seed)
+    z, y, x = np.ogrid[:num_slices, :size, :size]
+    zc, c = num_slices / 2, size / 2
+    body = ((y - c) / (0.35 * size)) ** 2 + ((x - c) / (0.45 * size)) ** 2 <= 1
+    volume = np.where(np.broadcast_to(body, (num_slices, size, size)), 40, -1000).astype(np.int16)
+    label = np.zeros((num_slices, size, size), dtype=np.uint8)
+    for side in (-1, 1):
+        kidney = (((z - zc) / (0.3 * num_slices)) ** 2 + ((y - c) / (0.12 * size)) ** 2
+                  + ((x - c - side * 0.22 * size) / (0.08 * size)) ** 2 <= 1)
+        volume[kidney] = 150
+        label[kidney] = 1
+    tumor = (((z - zc) / (0.1 * num_slices)) ** 2 + ((y - c) / (0.05 * size)) ** 2
+             + ((x - c - 0.25 * size) / (0.04 * size)) ** 2 <= 1)
+    label[tumor] = 2
+    volume[tumor] = 90
+    cyst = (((z - zc) / (0.06 * num_slices)) ** 2 + ((y - c) / (0.03 * size)) ** 2
+            + ((x - c + 0.22 * size) / (0.03 * size)) ** 2 <= 1)
+    label[cyst] = 3
+    volume[cyst] = 10
+    volume += rng.randint(-20, 21, size=volume.shape).astype(np.int16)
+    return volume, label
+
+def make_dicom_series(series_dir, patient_id, series_uid, num_slices=NUM_SLICES, size=SLICE_SIZE, seed=SEED):
+    """Escribe una serie DICOM (un .dcm por corte) con las etiquetas que usa el pipeline."""
+    import SimpleITK as sitk
+    series_dir = Path(series_dir)
+    series_dir.mkdir(parents=True, exist_ok=True)
+    volume, _ = make_phantom(num_slices, size, seed)
+    image = sitk.GetImageFromArray(volume)
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    for i in range(num_slices):
+        slice_img = image[:, :, i]
+        for tag, value in (("0010|0020", patient_id), ("0020|000e", series_uid),
+                           ("0020|000d", series_uid + ".1"), ("0008|0060", "CT"),
+                           ("0020|0032", f"0\\0\\{i * 2.5:.2f}"), ("0020|0013", str(i)),
+                           ("0020|0037", "1\\0\\0\\0\\1\\0"), ("0028|0030", "0.8\\0.8"),
+                           ("0018|0050", "2.5")):
+            slice_img.SetMetaData(tag, value)
+        writer.SetFileName(str(series_dir / f"1-{i:03d}.dcm"))
+        writer.Execute(slice_img)
+
+def make_png_case(case_dir, num_slices=NUM_SLICES, size=SLICE_SIZE, seed=SEED):
+    """Caso KiTS en PNG: JPEGImages/slice_<caso>_<z>.png y Annotations/..._mask.png."""
+    import numpy as np
+    from PIL import Image
+    case_dir = Path(case_dir)
+    (case_dir / "JPEGImages").mkdir(parents=True, exist_ok=True)
+    (case_dir / "Annotations").mkdir(parents=True, exist_ok=True)
+    volume, label = make_phantom(num_slices, size, seed)
+    # Ventana de TC a 8 bits, como los PNG del dataset
+    gray = np.clip((volume + 160) / 400 * 255, 0, 255).astype(np.uint8)
+    for z in range(num_slices):
+        Image.fromarray(gray[z]).save(case_dir / "JPEGImages" / f"slice_{case_dir.name}_{z}.png")
+        Image.fromarray(label[z]).save(case_dir / "Annotations" / f"slice_{case_dir.name}_{z}_mask.png")
+
+def make_nifti_case(case_dir, num_slices=NUM_SLICES, size=SLICE_SIZE, seed=SEED):
+    """Caso KiTS original: <caso>/imaging.nii.gz y <caso>/segmentation.nii.gz."""
+    import numpy as np
+    import nibabel as nib
+    case_dir = Path(case_dir)
+    case_dir.mkdir(parents=True, exist_ok=True)
+    volume, label = make_phantom(num_slices, size, seed)
+    affine = np.diag([0.8, 0.8, 2.5, 1.0])
+    # nibabel espera (X, Y, Z)
+    nib.save(nib.Nifti1Image(volume.T, affine), case_dir / "imaging.nii.gz")
+    nib.save(nib.Nifti1Image(label.T, affine), case_dir / "segmentation.nii.gz")
+
+def make_nnunet_dataset(dataset_dir, cases_root):
+    """Dataset nnU-Net (imagesTr/labelsTr + dataset.json) a partir de casos NIfTI."""
+    from .kits_organizer import organize_case
+    from .dataset_json import create_dataset_json
+    dataset_dir = Path(dataset_dir)
+    (dataset_dir / "imagesTr").mkdir(parents=True, exist_ok=True)
+    (dataset_dir / "labelsTr").mkdir(parents=True, exist_ok=True)
+    cases = sorted(Path(cases_root).glob("case_*"))
+    for case_dir in cases:
+        organize_case(case_dir, dataset_dir / "imagesTr", dataset_dir / "labelsTr")
+    create_dataset_json(dataset_dir, len(cases))
+
+def _dir_bytes(path):
+    return sum(f.stat().st_size for f in Path(path).rglob("*") if f.is_file())
+
+def prepare_data(work_dir, num_series=NUM_SERIES, num_cases=NUM_CASES,
+                 num_slices=NUM_SLICES, size=SLICE_SIZE):
+    """Genera todos los datos sintéticos en `work_dir` (no entra en las mediciones)."""
+    work_dir = Path(work_dir)
+    for i in range(num_series):
+        make_dicom_series(work_dir / "dicom" / f"TCGA-BM-{i:04d}" / "study" / "series",
+                          f"TCGA-BM-{i:04d}", f"1.2.826.0.1.3680043.2.1125.{i + 1}",
+                          num_slices, size, SEED + i)
+    for i in range(num_cases):
+        make_png_case(work_dir / "png" / f"case_{i:05d}", num_slices, size, SEED + i)
+        make_nifti_case(work_dir / "nifti" / f"case_{i:05d}", num_slices, size, SEED + i)
+    make_nnunet_dataset(work_dir / "nnunet" / "Dataset999_Bench", work_dir / "nifti")
+
+# --- Etapas (cada una corre en un proceso nuevo) ---
+
+def _stage_convert(work_dir, out_dir):
+    from .convert_dicom_to_nifti import convert_dicom_series
+    series = sorted(p for p in (work_dir / "dicom").rglob("series") if p.is_dir())
+    for i, series_dir in enumerate(series):
+        if not convert_dicom_series(series_dir, out_dir / f"series_{i}_0000.nii.gz"):
+            raise RuntimeError(f"Falló la conversión de {series_dir}")
+    return len(series), _dir_bytes(work_dir / "dicom")
+
+def _stage_reconstruct(work_dir, out_dir):
+    from .reconstruct_kits_from_png import reconstruct_volume
+    cases = sorted((work_dir / "png").glob("case_*"))
+    for case_dir in cases:
+        vol, _ = reconstruct_volume(list((case_dir / "JPEGImages").glob("*.png")),
+                                    list((case_dir / "Annotations").glob("*.png")))
+        if vol is None:
+            raise RuntimeError(f"Falló la reconstrucción de {case_dir}")
+    return len(cases), _dir_bytes(work_dir / "png")
+
+def _stage_organize(work_dir, out_dir):
+    # Copia real entre carpetas: es el peor caso (sin hardlink ni reflink)
+    from . import kits_organizer
+    from .file_placement import COPY
+    kits_organizer.PLACEMENT_STRATEGIES = (COPY,)
+    cases = sorted((work_dir / "nifti").glob("case_*"))
+    for sub in ("imagesTr", "labelsTr"):
+        (out_dir / sub).mkdir()
+    for case_dir in cases:
+        kits_organizer.organize_case(case_dir, out_dir / "imagesTr", out_dir / "labelsTr")
+    return len(cases), _dir_bytes(work_dir / "nifti")
+
+def _stage_move(work_dir, out_dir):
+    # Movimiento con manifiesto SHA-256 sobre una copia de los casos (la etapa los consume)
+    from . import stream_reorganizer_kits as reorganizer
+    source = out_dir / "source"
+    shutil.copytree(work_dir / "nifti", source)
+    reorganizer.NNUNET_RAW_DIR = out_dir / "dataset"
+    for sub in ("imagesTr", "labelsTr"):
+        (reorganizer.NNUNET_RAW_DIR / sub).mkdir(parents=True)
+    cases = sorted(source.glob("case_*"))
+    total = _dir_bytes(source)
+    start = time.perf_counter()
+    for case_dir in cases:
+        reorganizer.move_case(case_dir, reorganizer.NNUNET_RAW_DIR / "imagesTr",
+                              reorganizer.NNUNET_RAW_DIR / "labelsTr", {})
+    return len(cases), total, time.perf_counter() - start
+
+def _stage_check(work_dir, out_dir):
+    from .nifti_integrity_checker import check_dataset, CACHE_NAME
+    dataset_dir = work_dir / "nnunet" / "Dataset999_Bench"
+    (dataset_dir / CACHE_NAME).unlink(missing_ok=True)
+    problems = check_dataset(dataset_dir, deep=True)
+    if problems:
+        raise RuntimeError(f"El checker encontró problemas en datos sintéticos: {problems}")
+    files = list((dataset_dir / "imagesTr").glob("*")) + list((dataset_dir / "labelsTr").glob("*"))
+    return len(files) // 2, sum(f.stat().st_size for f in files)
+
+def _peak_rss_mb():
+    """Pico de RSS de este proceso y de sus hijos (pools de procesos), en MB."""
+    import resource
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss está en KB en Linux y en bytes en macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def _run_stage(stage, work_dir):
+    """Ejecuta una etapa en este proceso (hijo) y devuelve sus métricas."""
+    work_dir = Path(work_dir)
+    out_dir = work_dir / "out" / stage
+    shutil.rmtree(out_dir, ignore_errors=True)
+    out_dir.mkdir(parents=True)
+    stage_fn = globals()[f"_stage_{stage}"]
+    start = time.perf_counter()
+    result = stage_fn(work_dir, out_dir)
+    seconds = time.perf_counter() - start
+    items, nbytes = result[:2]
+    if len(result) == 3:
+        # La etapa midió solo su parte (sin la preparación)
+        seconds = result[2]
+    shutil.rmtree(out_dir, ignore_errors=True)
+    return {
+        "items": items,
+        "bytes": nbytes,
+        "seconds": round(seconds, 4),
+        "cases_per_s": round(items / seconds, 3) if seconds else None,
+        "mb_per_s": round(nbytes / 1e6 / seconds, 2) if seconds else None,
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    }
+
+def _in_fresh_process(fn, *args):
+    """Ejecuta `fn` en un proceso nuevo (spawn) y devuelve su resultado.
+
+    ru_maxrss se hereda a través de fork+exec, así que este proceso tiene que
+    quedarse pequeño: hasta la generación de datos va en un proceso aparte.
+    """
+    mp_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=mp_context) as executor:
+        return executor.submit(fn, *args).result()
+
+def _fmt(value, spec):
+    """Formatea una tasa; None (etapa sin tiempo medible) se muestra como '-'."""
+    return format(value, spec) if value is not None else format("-", ">" + spec.split(".")[0])
+
+def run_benchmarks(work_dir, stages=STAGES):
+    """Corre cada etapa en un proceso nuevo para que el pico de RAM sea solo suyo."""
+    results = {}
+    for stage in stages:
+        results[stage] = _in_fresh_process(_run_stage, stage, str(work_dir))
+        r = results[stage]
+        print(f"⏱️ {stage:12s} {r['seconds']:8.2f}s  {_fmt(r['cases_per_s'], '8.2f')} casos/s  "
+              f"{_fmt(r['mb_per_s'], '8.1f')} MB/s  pico {r['peak_rss_mb']:7.1f} MB")
+    return results
+
+# --- Línea base ---
+
+def build_report(results, scale):
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                    "cpus": os.cpu_count()},
+        "data": {"series": NUM_SERIES * scale, "cases": NUM_CASES * scale,
+                 "slices": NUM_SLICES, "slice_size": SLICE_SIZE, "seed": SEED},
+        "stages": results,
+    }
+
+def compare_to_baseline(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """Lista de regresiones (texto) respecto a la línea base."""
+    regressions = []
+    for stage, current in results.items():
+        reference = baseline.get("stages", {}).get(stage)
+        if not reference:
+            continue
+        for metric in ("cases_per_s", "mb_per_s"):
+            if current[metric] is None or not reference.get(metric):
+                continue
+            if current[metric] < reference[metric] * (1 - tolerance):
+                regressions.append(f"{stage}: {metric} {current[metric]} < {reference[metric]} "
+                                   f"(-{1 - current[metric] / reference[metric]:.0%})")
+        if reference.get("peak_rss_mb") and current["peak_rss_mb"] > reference["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{stage}: peak_rss_mb {current['peak_rss_mb']} > {reference['peak_rss_mb']} "
+                               f"(+{current['peak_rss_mb'] / reference['peak_rss_mb'] - 1:.0%})")
+    return regressions
+
+def main(save=False, compare=False, scale=1, stages=STAGES, baseline_path=BASELINE_PATH):
+    baseline_path = Path(baseline_path)
+    with tempfile.TemporaryDirectory(prefix="aura_bench_") as tmp:
+        # Las métricas y el almacén por contenido de los datos sintéticos no van a los del
+        # proyecto (los procesos hijos leen las rutas del entorno al importar los módulos)
+        os.environ["AURA_METRICS_PATH"] = os.path.join(tmp, "metrics.jsonl")
+        os.environ["AURA_CONTENT_STORE_DIR"] = os.path.join(tmp, "content_store")
+        print(f"🧪 Generando datos sintéticos ({NUM_SERIES * scale} series, {NUM_CASES * scale} casos, "
+              f"{NUM_SLICES}×{SLICE_SIZE}×{SLICE_SIZE})...")
+        _in_fresh_process(prepare_data, tmp, NUM_SERIES * scale, NUM_CASES * scale)
+        results = run_benchmarks(tmp, stages)
+    report = build_report(results, scale)
+
+    if compare:
+        if not baseline_path.exists():
+            print(f"⚠️ No existe la línea base {baseline_path}; ejecuta primero con --save.")
+        else:
+            with open(baseline_path, "r") as f:
+                baseline = json.load(f)
+            if baseline.get("data") != report["data"]:
+                # Con otro volumen de datos las tasas no son comparables
+                print(f"❌ La línea base {baseline_path} se midió con otros datos: "
+                      f"{baseline.get('data')} ≠ {report['data']}. Usa el mismo --scale o "
+                      f"regenera la línea base con --save.")
+                return 1
+            regressions = compare_to_baseline(results, baseline)
+            if regressions:
+                print(f"\n❌ {len(regressions)} regresiones respecto a {baseline_path}:")
+                for r in regressions:
+                    print(f"  {r}")
+                return 1
+            print(f"\n✅ Sin regresiones respecto a {baseline_path} (tolerancia {REGRESSION_TOLERANCE:.0%}).")
+    if save:
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = baseline_path.with_name(baseline_path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(report, f, indent=2)
+        os.replace(tmp_path, baseline_path)
+        print(f"💾 Línea base guardada en {baseline_path}")
+    return 0
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import os
+import hashlib
+from pathlib import Path
+
+# --- CONFIGURACIÓN ---
+# Manifiesto del dataset en formato `sha256sum` (se puede verificar con `sha256sum -c`)
+MANIFEST_NAME = "checksums.sha256"
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+# ---------------------
+
+def sha256_file(path, chunk_size=HASH_CHUNK_SIZE):
+    """SHA-256 de un archivo leyéndolo por bloques."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_manifest(dataset_dir):
+    """Lee el manifiesto como {ruta relativa: sha256}. Si una ruta se repite, gana la última."""
+    manifest_path = Path(dataset_dir) / MANIFEST_NAME
+    entries = {}
+    if not manifest_path.exists():
+        return entries
+    with open(manifest_path, "r") as f:
+        for line in f:
+            digest, sep, rel_path = line.rstrip("\n").partition("  ")
+            # Una línea a medias (corte al escribir) no tiene el formato completo
+            if sep and len(digest) == 64 and rel_path:
+                entries[rel_path] = digest
+    return entries
+
+def append_manifest(dataset_dir, rel_path, digest):
+    """Añade una entrada al manifiesto y la asegura en disco antes de volver."""
+    manifest_path = Path(dataset_dir) / MANIFEST_NAME
+    with open(manifest_path, "a") as f:
+        f.write(f"{digest}  {Path(rel_path).as_posix()}\n")
+        f.flush()
+        os.fsync(f.fileno())
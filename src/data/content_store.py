@@ -0,0 +1,206 @@
+import os
+import errno
+import sqlite3
+from pathlib import Path
+from tqdm import tqdm
+from .checksum_manifest import sha256_file
+
+# --- CONFIGURACIÓN ---
+# Almacén direccionado por contenido: objects/ab/<sha256>. Cada archivo deduplicado es un
+# hardlink a su objeto, así que el almacén tiene que estar en el mismo disco que los datos.
+STORE_DIR = Path(os.environ.get("AURA_CONTENT_STORE_DIR", "data/content_store"))
+# Los conversores enlazan sus salidas en el almacén ("1" lo activa). Apagado por defecto:
+# hay que leer cada salida entera para su SHA-256 y los enlaces unen las copias
+STORE_ENABLED = os.environ.get("AURA_CONTENT_STORE", "0") == "1"
+# Carpetas que recorre el comando `dedup` (el mismo caso suele estar en varias)
+SCAN_DIRS = [
+    Path("scripts/kits23/dataset"),
+    Path("data/raw/kits23"),
+    Path("data/raw/nnUNet_raw"),
+]
+# Archivos más pequeños no compensan (cabeceras, json, manifiestos)
+MIN_SIZE = 1024 * 1024
+# ---------------------
+
+INDEX_NAME = "index.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    digest TEXT
+);
+"""
+
+
+def object_path(digest, store_dir=STORE_DIR):
+    return Path(store_dir) / "objects" / digest[:2] / digest
+
+
+def _link_over(target, path):
+    """Reemplaza `path` por un hardlink a `target` sin dejar un instante sin archivo."""
+    path = Path(path)
+    tmp = path.with_name(f".{path.name}.dedup.tmp")
+    tmp.unlink(missing_ok=True)
+    os.link(target, tmp)
+    os.replace(tmp, path)
+
+
+def add_file(path, digest=None, store_dir=STORE_DIR):
+    """Mete `path` en el almacén; si el contenido ya estaba, `path` pasa a ser un enlace al objeto.
+
+    `digest` evita releer el archivo si quien lo escribió ya calculó el
+    SHA-256. Si el almacén está en otro disco o el objeto llegó al límite de
+    enlaces, el archivo se deja como está. Devuelve (SHA-256, bytes liberados).
+    """
+    path = Path(path)
+    digest = digest or sha256_file(path)
+    obj = object_path(digest, store_dir)
+    st = path.stat()
+    try:
+        obj.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(path, obj)
+            return digest, 0
+        except FileExistsError:
+            pass
+        obj_st = obj.stat()
+        if (obj_st.st_dev, obj_st.st_ino) == (st.st_dev, st.st_ino):
+            return digest, 0
+        if obj_st.st_size != st.st_size:
+            raise OSError(f"El objeto {obj.name} no coincide en tamaño con {path}")
+        _link_over(obj, path)
+        # Solo se libera espacio si nadie más enlazaba el archivo reemplazado
+        return digest, st.st_size if st.st_nlink == 1 else 0
+    except OSError as e:
+        if e.errno in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+            return digest, 0
+        raise
+
+
+def link_from_store(digest, dst, store_dir=STORE_DIR):
+    """Crea `dst` como enlace al objeto `digest`. Devuelve False si el objeto no existe."""
+    obj = object_path(digest, store_dir)
+    if not obj.exists():
+        return False
+    _link_over(obj, dst)
+    return True
+
+
+def store_output(path, digest=None):
+    """Deduplica una salida recién escrita (conversores, organizadores) si el almacén está activo.
+
+    Un fallo aquí no invalida la salida: el archivo queda como estaba.
+    """
+    if not STORE_ENABLED:
+        return None
+    try:
+        return add_file(path, digest)
+    except OSError as e:
+        print(f"⚠️ No se pudo deduplicar {Path(path).name}: {e}")
+        return None
+
+
+def _open_index(store_dir=STORE_DIR):
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(store_dir / INDEX_NAME), timeout=60)
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def dedupe_tree(root, store_dir=STORE_DIR, min_size=MIN_SIZE):
+    """Pasa por el almacén todos los archivos de `root` de al menos `min_size` bytes.
+
+    El SHA-256 se guarda en un índice por (ruta, tamaño, mtime): en la
+    siguiente pasada los archivos que no cambiaron y ya son un enlace a su
+    objeto no se vuelven a leer. Devuelve (archivos revisados, bytes liberados).
+    """
+    root = Path(root)
+    conn = _open_index(store_dir)
+    known = {row[0]: row[1:] for row in conn.execute("SELECT path, size, mtime_ns, digest FROM files")}
+    files = [p for p in root.rglob("*") if p.is_file() and not p.name.startswith(".")]
+    files = [p for p in files if p.stat().st_size >= min_size]
+    reclaimed = 0
+    rows = []
+    for path in tqdm(files, desc=f"Deduplicando {root}"):
+        st = path.stat()
+        hit = known.get(str(path))
+        digest = hit[2] if hit and hit[:2] == (st.st_size, st.st_mtime_ns) else None
+        if digest:
+            obj = object_path(digest, store_dir)
+            if obj.exists() and os.path.samefile(obj, path):
+                continue
+        digest, freed = add_file(path, digest, store_dir)
+        reclaimed += freed
+        st = path.stat()
+        rows.append((str(path), st.st_size, st.st_mtime_ns, digest))
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", rows)
+    conn.close()
+    return len(files), reclaimed
+
+
+def store_report(store_dir=STORE_DIR):
+    """Objetos, referencias y bytes ahorrados según el nº de enlaces de cada objeto.
+
+    Un objeto con n enlaces tiene n - 1 archivos que lo usan: sin deduplicar
+    serían n - 1 copias, con el almacén ocupa una sola vez. Los objetos con un
+    único enlace ya no los usa nadie (huérfanos).
+    """
+    objects_dir = Path(store_dir) / "objects"
+    report = {"objects": 0, "stored_bytes": 0, "references": 0, "logical_bytes": 0,
+              "reclaimed_bytes": 0, "orphans": 0, "orphan_bytes": 0}
+    if not objects_dir.exists():
+        return report
+    for obj in objects_dir.glob("*/*"):
+        st = obj.stat()
+        refs = st.st_nlink - 1
+        report["objects"] += 1
+        report["stored_bytes"] += st.st_size
+        report["references"] += refs
+        report["logical_bytes"] += st.st_size * refs
+        report["reclaimed_bytes"] += st.st_size * max(0, refs - 1)
+        if refs == 0:
+            report["orphans"] += 1
+            report["orphan_bytes"] += st.st_size
+    return report
+
+
+def collect_garbage(store_dir=STORE_DIR):
+    """Borra los objetos que ya no enlaza ningún archivo. Devuelve los bytes liberados."""
+    freed = 0
+    for obj in (Path(store_dir) / "objects").glob("*/*"):
+        st = obj.stat()
+        if st.st_nlink == 1:
+            obj.unlink()
+            freed += st.st_size
+    return freed
+
+
+def print_report(report):
+    gb = 1024**3
+    print(f"📦 Almacén: {report['objects']} objetos, {report['stored_bytes'] / gb:.2f} GB en disco.")
+    print(f"🔗 {report['references']} archivos los usan: sin deduplicar serían "
+          f"{report['logical_bytes'] / gb:.2f} GB; recuperados {report['reclaimed_bytes'] / gb:.2f} GB.")
+    if report["orphans"]:
+        print(f"🗑️ {report['orphans']} objetos huérfanos ({report['orphan_bytes'] / gb:.2f} GB); "
+              f"se borran con `python -m src.data dedup --gc`.")
+
+
+def main(report_only=False, gc=False):
+    if not report_only:
+        total = 0
+        for root in SCAN_DIRS:
+            if root.exists():
+                _, reclaimed = dedupe_tree(root)
+                total += reclaimed
+        print(f"✅ Liberados en esta pasada: {total / 1024**3:.2f} GB.")
+    if gc:
+        print(f"🗑️ Objetos huérfanos borrados: {collect_garbage() / 1024**3:.2f} GB.")
+    print_report(store_report())
+
+
+if __name__ == "__main__":
+    main()
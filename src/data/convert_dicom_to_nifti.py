@@ -1,9 +1,16 @@
 import os
-import shutil
-import pandas as pd
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from tqdm import tqdm
-import SimpleITK as sitk
+from .dicom_catalog import CATALOG_PATH, open_catalog, rescan, query_series
+from . import nifti_writer
+from .nifti_writer import write_sitk_image
+from .pipeline_metrics import stage, file_bytes, start_run, finish_run
+from .dataset_fingerprint import record_case, case_id_from_image, build_fingerprint
+from .volume_cache import cache_converted
+from .content_store import store_output
+from .dtype_policy import compact_sitk_image
 
 # Configuración
 RAW_DICOM_DIR = Path("data/raw/TCGA-KIRC/images")
@@ -11,47 +18,131 @@ OUTPUT_NIFTI_DIR = Path("data/raw/nnUNet_raw/Dataset102_TCGA/imagesTr")
 # Mapeo de IDs (opcional, si quieres renombrar TCGA-B0-5083 a kirc_001)
 # ID_MAPPING_FILE = "data/raw/TCGA-KIRC/id_mapping.csv" 
 
-def convert_dicom_series(series_dir, output_path):
-    """Lee una serie DICOM y la escribe como NIfTI comprimido."""
+# Número de procesos para la conversión en paralelo (1 = modo secuencial original)
+NUM_WORKERS = os.cpu_count() or 1
+
+def convert_dicom_series(series_dir, output_path, num_cases=None):
+    """Lee una serie DICOM y la escribe como NIfTI comprimido.
+
+    Con `num_cases` (casos previstos en el dataset) registra además la huella
+    de nnU-Net del volumen, que ya está en memoria.
+    """
+    import SimpleITK as sitk
     reader = sitk.ImageSeriesReader()
     dicom_names = reader.GetGDCMSeriesFileNames(str(series_dir))
     reader.SetFileNames(dicom_names)
     
     try:
-        image = reader.Execute()
+        with stage("dicom_decode", key=Path(series_dir).name, bytes_in=file_bytes(dicom_names)):
+            image = reader.Execute()
+        # float (rescale slope/intercept) o tipos anchos pasan a int16 si no se pierde nada
+        image = compact_sitk_image(image)
         # Escribir imagen. nnU-Net espera _0000.nii.gz para el canal 0
-        sitk.WriteImage(image, str(output_path))
+        with stage("nifti_write", key=Path(series_dir).name) as m:
+            digest = write_sitk_image(image, output_path)
+            m["bytes_out"] = file_bytes([output_path])
+        # Una re-descarga de la misma serie produce el mismo .nii.gz: se enlaza al objeto existente
+        store_output(output_path, digest)
+        cache_converted(output_path, sitk.GetArrayViewFromImage(image))
+        if num_cases:
+            # Vista (z, y, x) sin copia; el spacing de SimpleITK va en (x, y, z)
+            record_case(Path(output_path).parent.parent, case_id_from_image(output_path),
+                        sitk.GetArrayViewFromImage(image), None, image.GetSpacing()[::-1], num_cases)
         return True
     except Exception as e:
         print(f"Error convirtiendo {series_dir}: {e}")
         return False
 
+def _init_worker():
+    """Cada proceso usa un solo hilo de ITK (y de gzip) para no sobresuscribir los núcleos."""
+    import SimpleITK as sitk
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
+    nifti_writer.NUM_THREADS = 1
+
+def _convert_job(job):
+    """Convierte una serie dentro de un proceso del pool y mide cuánto tardó."""
+    series_dir, output_path, num_cases = job
+    start = time.perf_counter()
+    try:
+        ok = convert_dicom_series(series_dir, output_path, num_cases)
+        error = None if ok else "conversión fallida"
+    except Exception as e:
+        ok, error = False, str(e)
+    return ok, time.perf_counter() - start, error
+
+def convert_series_parallel(jobs, num_workers=NUM_WORKERS, num_cases=None):
+    """Convierte una lista de (series_dir, output_path) usando un pool de procesos.
+
+    Cada serie corre en su propio proceso, así la decodificación DICOM (GDCM)
+    y la compresión gzip se reparten entre núcleos. El progreso se reporta en
+    el mismo orden de `jobs` y un fallo (incluso la caída de un proceso) solo
+    marca esa serie como fallida. `num_cases` activa la huella de nnU-Net.
+    Devuelve una lista de dicts con series_dir, output_path, ok, seconds y error.
+    """
+    results = []
+    if num_workers <= 1:
+        for series_dir, output_path in tqdm(jobs, desc="Convirtiendo"):
+            ok, seconds, error = _convert_job((series_dir, output_path, num_cases))
+            results.append({"series_dir": series_dir, "output_path": output_path,
+                            "ok": ok, "seconds": seconds, "error": error})
+        return results
+
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker) as executor:
+        futures = [executor.submit(_convert_job, (*job, num_cases)) for job in jobs]
+        for (series_dir, output_path), future in tqdm(zip(jobs, futures), total=len(jobs), desc="Convirtiendo"):
+            try:
+                ok, seconds, error = future.result()
+            except Exception as e:
+                # El proceso murió (p. ej. segfault en GDCM); las demás series siguen
+                ok, seconds, error = False, 0.0, f"proceso abortado: {e}"
+                print(f"Error convirtiendo {series_dir}: {error}")
+            results.append({"series_dir": series_dir, "output_path": output_path,
+                            "ok": ok, "seconds": seconds, "error": error})
+    return results
+
+def print_timing_summary(results, top=5):
+    """Imprime un resumen del tiempo que tomó cada serie."""
+    if not results:
+        return
+    times = sorted(results, key=lambda r: r["seconds"], reverse=True)
+    total = sum(r["seconds"] for r in results)
+    failed = [r for r in results if not r["ok"]]
+    print(f"\n⏱️ Tiempo acumulado de conversión: {total:.1f}s "
+          f"(media {total / len(results):.1f}s por serie)")
+    print("Series más lentas:")
+    for r in times[:top]:
+        print(f"  {r['seconds']:7.1f}s  {r['series_dir']}")
+    if failed:
+        print(f"❌ {len(failed)} series fallaron:")
+        for r in failed:
+            print(f"  {r['series_dir']}: {r['error']}")
+
 def main():
+    start_run()
     # Crear carpeta de salida si no existe
     OUTPUT_NIFTI_DIR.mkdir(parents=True, exist_ok=True)
     
     # Encontrar todas las carpetas de series (asumiendo estructura de TCIA)
     # La estructura típica es: PatientID / StudyUID / SeriesUID / *.dcm
-    print("Buscando series DICOM...")
-    # Buscamos recursivamente cualquier directorio que contenga archivos .dcm
-    series_dirs = set()
-    for file in RAW_DICOM_DIR.rglob("*.dcm"):
-        series_dirs.add(file.parent)
+    # El catálogo solo re-escanea las carpetas que cambiaron desde la última vez
+    print("Actualizando catálogo de series DICOM...")
+    conn = open_catalog(CATALOG_PATH)
+    rescanned, removed = rescan(conn, RAW_DICOM_DIR)
+    catalog_series = query_series(conn, RAW_DICOM_DIR)
+    conn.close()
     
-    print(f"Se encontraron {len(series_dirs)} series para convertir.")
+    print(f"Se encontraron {len(catalog_series)} series para convertir "
+          f"({rescanned} carpetas re-escaneadas, {removed} eliminadas).")
     
-    successful_conversions = 0
+    jobs = []
+    planned_outputs = set()
+    existing_outputs = 0
     
-    for series_dir in tqdm(series_dirs, desc="Convirtiendo"):
-        # Extraer ID del paciente de la ruta (esto depende de cómo TCIA guardó los datos)
-        # Asumimos que el nombre de la carpeta abuela es el ID del paciente, o lo extraemos del DICOM
-        # Para ser robustos, leemos el primer DICOM para sacar el PatientID real
-        try:
-            first_dcm = next(series_dir.glob("*.dcm"))
-            tags = sitk.ReadImage(str(first_dcm))
-            patient_id = tags.GetMetaData("0010|0020").strip() # Tag Patient ID
-        except:
-            patient_id = series_dir.parent.parent.name # Fallback a nombre de carpeta
+    for entry in catalog_series:
+        series_dir = entry["series_dir"]
+        # El PatientID sale de la cabecera ya catalogada; si falta,
+        # asumimos que el nombre de la carpeta abuela es el ID del paciente
+        patient_id = entry["patient_id"] or series_dir.parent.parent.name
             
         # Nombre de salida compatible con nnU-Net: CASO_MODALIDAD.nii.gz
         # Ejemplo: TCGA_B0_5083_0000.nii.gz
@@ -60,12 +151,26 @@ def main():
         
         # Evitar re-convertir si ya existe
         if output_path.exists():
+            existing_outputs += 1
+            continue
+        # En paralelo dos series del mismo paciente escribirían el mismo archivo
+        if output_path in planned_outputs:
             continue
+        planned_outputs.add(output_path)
             
-        if convert_dicom_series(series_dir, output_path):
-            successful_conversions += 1
+        jobs.append((series_dir, output_path))
+
+    start = time.perf_counter()
+    # Casos que tendrá imagesTr al terminar (para repartir las muestras de la huella)
+    num_cases = existing_outputs + len(jobs)
+    results = convert_series_parallel(jobs, NUM_WORKERS, num_cases)
+    successful_conversions = sum(1 for r in results if r["ok"])
+    print_timing_summary(results)
+    print(f"Tiempo de reloj: {time.perf_counter() - start:.1f}s con {NUM_WORKERS} procesos.")
+    finish_run()
 
     print(f"\nProceso finalizado. {successful_conversions} volúmenes convertidos correctamente.")
+    build_fingerprint(OUTPUT_NIFTI_DIR.parent)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
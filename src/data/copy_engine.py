@@ -0,0 +1,45 @@
+import errno
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+
+# --- CONFIGURACIÓN ---
+# Transferencias de casos simultáneas (varias lecturas en vuelo llenan mejor NFS/red)
+COPY_WORKERS = 4
+# ---------------------
+
+def run_transfers(jobs, transfer, sizes, num_workers=COPY_WORKERS, desc="Copiando"):
+    """Ejecuta `transfer(job, progress)` para cada trabajo en un pool acotado de hilos.
+
+    `sizes` son los bytes de cada trabajo (para el total, MB/s y ETA) y
+    `progress(n)` es el callback que cada transferencia llama con los
+    bytes que va moviendo. Si una transferencia se queda sin espacio
+    (ENOSPC) no se lanzan más y las pendientes se cancelan.
+    Devuelve una lista alineada con `jobs` de (resultado, error); los
+    trabajos cancelados quedan como (None, "cancelado").
+    """
+    results = [(None, "cancelado")] * len(jobs)
+    lock = threading.Lock()
+    bar = tqdm(total=sum(sizes), desc=desc, unit="B", unit_scale=True, unit_divisor=1024)
+
+    def progress(nbytes):
+        with lock:
+            bar.update(nbytes)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(transfer, job, progress): i for i, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            i = futures[future]
+            if future.cancelled():
+                continue
+            try:
+                results[i] = (future.result(), None)
+            except OSError as e:
+                results[i] = (None, e)
+                if e.errno == errno.ENOSPC:
+                    for pending in futures:
+                        pending.cancel()
+            except Exception as e:
+                results[i] = (None, e)
+    bar.close()
+    return results
@@ -0,0 +1,248 @@
+import os
+import io
+import json
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from tqdm import tqdm
+from .pipeline_metrics import stage
+
+# --- CONFIGURACIÓN ---
+# nnU-Net busca la huella en nnUNet_preprocessed/<Dataset>/dataset_fingerprint.json
+# y, si ya existe, no vuelve a leer el dataset completo para calcularla.
+PREPROCESSED_DIR = Path(os.environ.get("nnUNet_preprocessed", "data/nnUNet_preprocessed"))
+# Datasets que recorre el comando `fingerprint`
+DATASET_DIRS = [
+    Path("data/raw/nnUNet_raw/Dataset101_KiTS23"),
+    Path("data/raw/nnUNet_raw/Dataset102_TCGA"),
+]
+NUM_WORKERS = os.cpu_count() or 1
+# Igual que nnU-Net v2: 10e7 vóxeles de primer plano repartidos entre los casos, semilla 1234 por caso
+NUM_FOREGROUND_VOXELS = 10e7
+SEED = 1234
+# ---------------------
+
+PARTS_DIR_NAME = "fingerprint_parts"
+FILE_ENDING = ".nii.gz"
+
+
+def samples_per_case(num_cases):
+    return int(NUM_FOREGROUND_VOXELS // max(1, num_cases))
+
+
+def parts_dir(dataset_dir):
+    """Estadísticas por caso, guardadas junto a donde nnU-Net espera la huella."""
+    return PREPROCESSED_DIR / Path(dataset_dir).name / PARTS_DIR_NAME
+
+
+def case_id_from_image(image_path):
+    """imagesTr/case_00000_0000.nii.gz -> case_00000"""
+    return Path(image_path).name[:-len(FILE_ENDING)].rpartition("_")[0]
+
+
+def _nonzero_bbox(image):
+    """Recorte al bounding box de los vóxeles distintos de cero (como crop_to_nonzero de nnU-Net).
+
+    nnU-Net rellena los huecos de la máscara antes de calcular la caja, lo
+    que no cambia sus límites, así que basta con la máscara tal cual.
+    """
+    import numpy as np
+    nonzero = image != 0
+    slices = []
+    for axis in range(image.ndim):
+        other = tuple(a for a in range(image.ndim) if a != axis)
+        hits = np.flatnonzero(nonzero.any(axis=other))
+        if len(hits) == 0:
+            return tuple(slice(None) for _ in range(image.ndim))
+        slices.append(slice(int(hits[0]), int(hits[-1]) + 1))
+    return tuple(slices)
+
+
+def case_statistics(image, label, spacing, num_samples):
+    """Lo que nnU-Net extrae de un caso, a partir de arrays ya en memoria.
+
+    `image` y `label` van en el orden de ejes de SimpleITK (z, y, x), igual
+    que `spacing`. Los vóxeles de primer plano (label > 0 dentro del recorte)
+    se muestrean con reemplazo como en nnU-Net; sin etiqueta no hay muestras.
+    El spacing se redondea a float32, que es como queda en la cabecera NIfTI.
+    """
+    import numpy as np
+    crop = _nonzero_bbox(image)
+    shape_after_crop = image[crop].shape
+    samples = np.empty(0, dtype=np.float32)
+    if label is not None:
+        foreground = image[crop][label[crop] > 0]
+        if len(foreground):
+            rs = np.random.RandomState(SEED)
+            samples = rs.choice(foreground, num_samples, replace=True).astype(np.float32)
+    return {
+        "spacing": [float(np.float32(s)) for s in spacing],
+        "shape_before_crop": [int(n) for n in image.shape],
+        "shape_after_crop": [int(n) for n in shape_after_crop],
+        "samples": samples,
+    }
+
+
+def save_case_statistics(dataset_dir, case_id, stats):
+    """Guarda las estadísticas de un caso (npz, reemplazo atómico)."""
+    import numpy as np
+    out_dir = parts_dir(dataset_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    buffer = io.BytesIO()
+    np.savez(buffer, **stats)
+    tmp_path = out_dir / f".{case_id}.npz.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(buffer.getbuffer())
+    os.replace(tmp_path, out_dir / f"{case_id}.npz")
+
+
+def record_case(dataset_dir, case_id, image, label, spacing, num_cases):
+    """Acumula la huella de un caso mientras su volumen sigue en memoria.
+
+    Lo llaman los conversores justo después de escribir el NIfTI. Un fallo
+    aquí no invalida la conversión: el comando `fingerprint` lo recalcula.
+    Devuelve True si se guardó.
+    """
+    try:
+        with stage("fingerprint", key=case_id, bytes_in=image.nbytes):
+            stats = case_statistics(image, label, spacing, samples_per_case(num_cases))
+            save_case_statistics(dataset_dir, case_id, stats)
+        return True
+    except Exception as e:
+        print(f"⚠️ No se pudo registrar la huella de {case_id}: {e}")
+        return False
+
+
+def _read_volume(path):
+    """Lee un NIfTI en el orden de ejes (z, y, x) y el spacing que usa el lector de nnU-Net."""
+    import numpy as np
+    import nibabel as nib
+    img = nib.load(path)
+    data = np.asanyarray(img.dataobj).astype(np.float32, copy=False)
+    # nibabel da (x, y, z); la traspuesta es una vista sin copia
+    return data.T, tuple(float(z) for z in img.header.get_zooms()[:3])[::-1]
+
+
+def _fingerprint_job(job):
+    dataset_dir, image_path, label_path, num_cases = job
+    case_id = case_id_from_image(image_path)
+    with stage("fingerprint", key=case_id) as m:
+        image, spacing = _read_volume(image_path)
+        label = _read_volume(label_path)[0] if label_path.exists() else None
+        m["bytes_in"] = image.nbytes
+        save_case_statistics(dataset_dir, case_id, case_statistics(image, label, spacing,
+                                                                   samples_per_case(num_cases)))
+    return case_id
+
+
+def stale_cases(dataset_dir):
+    """Imágenes sin estadísticas o modificadas después de calcularlas."""
+    dataset_dir = Path(dataset_dir)
+    parts = parts_dir(dataset_dir)
+    stale = []
+    for image_path in sorted((dataset_dir / "imagesTr").glob(f"*_0000{FILE_ENDING}")):
+        part = parts / f"{case_id_from_image(image_path)}.npz"
+        label_path = dataset_dir / "labelsTr" / f"{case_id_from_image(image_path)}{FILE_ENDING}"
+        newest = max(p.stat().st_mtime_ns for p in (image_path, label_path) if p.exists())
+        if not part.exists() or part.stat().st_mtime_ns < newest:
+            stale.append(image_path)
+    return stale
+
+
+def build_fingerprint(dataset_dir):
+    """Combina las estadísticas por caso en dataset_fingerprint.json (formato nnU-Net v2).
+
+    Se usan los casos presentes en imagesTr, en orden de identificador como
+    nnU-Net. Cada caso guardó muestras para el número de casos previsto al
+    convertir; si ahora hay más casos se toma el prefijo (idéntico a lo que
+    muestrearía nnU-Net con la misma semilla) y si hay menos se remuestrea.
+    Devuelve la ruta del JSON o None si no hay casos.
+    """
+    import numpy as np
+    dataset_dir = Path(dataset_dir)
+    case_ids = sorted(case_id_from_image(p) for p in (dataset_dir / "imagesTr").glob(f"*_0000{FILE_ENDING}"))
+    if not case_ids:
+        return None
+    num_samples = samples_per_case(len(case_ids))
+    parts = parts_dir(dataset_dir)
+    spacings, shapes_after_crop, relative_sizes, samples = [], [], [], []
+    missing, resampled = [], 0
+    for case_id in case_ids:
+        part = parts / f"{case_id}.npz"
+        if not part.exists():
+            missing.append(case_id)
+            continue
+        with np.load(part) as stats:
+            spacings.append(stats["spacing"].tolist())
+            shapes_after_crop.append(stats["shape_after_crop"].tolist())
+            relative_sizes.append(np.prod(stats["shape_after_crop"]) / np.prod(stats["shape_before_crop"]))
+            case_samples = stats["samples"]
+        if 0 < len(case_samples) < num_samples:
+            case_samples = np.random.RandomState(SEED).choice(case_samples, num_samples, replace=True)
+            resampled += 1
+        samples.append(case_samples[:num_samples])
+    if missing:
+        print(f"⚠️ {len(missing)} casos sin estadísticas (ejecuta `python -m src.data fingerprint`): "
+              f"{', '.join(missing[:5])}{'...' if len(missing) > 5 else ''}")
+        return None
+
+    fingerprint = {
+        "spacings": spacings,
+        "shapes_after_crop": shapes_after_crop,
+        "foreground_intensity_properties_per_channel": {},
+        "median_relative_size_after_cropping": float(np.median(relative_sizes, 0)),
+    }
+    intensities = np.concatenate(samples)
+    if len(intensities):
+        percentile_00_5, median, percentile_99_5 = np.percentile(intensities, (0.5, 50.0, 99.5))
+        fingerprint["foreground_intensity_properties_per_channel"]["0"] = {
+            "mean": float(np.mean(intensities)),
+            "median": float(median),
+            "std": float(np.std(intensities)),
+            "min": float(np.min(intensities)),
+            "max": float(np.max(intensities)),
+            "percentile_99_5": float(percentile_99_5),
+            "percentile_00_5": float(percentile_00_5),
+        }
+    else:
+        print(f"⚠️ {dataset_dir.name} no tiene etiquetas con primer plano: la huella va sin intensidades.")
+    if resampled:
+        print(f"ℹ️ {resampled} casos remuestreados (se convirtieron previendo más casos de los que hay).")
+
+    out_path = PREPROCESSED_DIR / dataset_dir.name / "dataset_fingerprint.json"
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_path.with_name(f".{out_path.name}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(fingerprint, f, indent=4)
+    os.replace(tmp_path, out_path)
+    print(f"🧬 Huella del dataset ({len(case_ids)} casos) guardada en: {out_path}")
+    return out_path
+
+
+def fingerprint_dataset(dataset_dir, num_workers=NUM_WORKERS):
+    """Pasada independiente para datasets colocados sin leer los volúmenes (kits-organize, kits-move).
+
+    Solo lee los casos que no tienen estadísticas o cambiaron desde entonces;
+    los que ya registró un conversor no se vuelven a descomprimir.
+    """
+    dataset_dir = Path(dataset_dir)
+    stale = stale_cases(dataset_dir)
+    num_cases = len(list((dataset_dir / "imagesTr").glob(f"*_0000{FILE_ENDING}")))
+    if stale:
+        jobs = [(dataset_dir, p, dataset_dir / "labelsTr" / f"{case_id_from_image(p)}{FILE_ENDING}", num_cases)
+                for p in stale]
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for _ in tqdm(executor.map(_fingerprint_job, jobs), total=len(jobs),
+                          desc=f"Huella {dataset_dir.name}"):
+                pass
+    return build_fingerprint(dataset_dir)
+
+
+def main():
+    for dataset_dir in DATASET_DIRS:
+        if (dataset_dir / "imagesTr").exists():
+            print(f"🔍 Calculando huella de {dataset_dir}...")
+            fingerprint_dataset(dataset_dir)
+
+
+if __name__ == "__main__":
+    main()
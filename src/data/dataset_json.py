@@ -0,0 +1,68 @@
+import os
+import json
+from pathlib import Path
+
+# Etiquetas de KiTS23 (también las usa dtype_policy para validar y remapear las máscaras)
+LABELS = {
+    "background": 0,
+    "kidney": 1,
+    "tumor": 2,
+    "cyst": 3
+}
+
+def create_dataset_json(output_dir, num_training_cases):
+    """
+    Crea el archivo dataset.json requerido por nnU-Net (KiTS23).
+    Lo usan todos los scripts que generan Dataset101_KiTS23.
+    """
+    json_dict = {
+        "channel_names": {
+            "0": "CT"
+        },
+        "labels": LABELS,
+        "numTraining": num_training_cases,
+        "file_ending": ".nii.gz",
+        "name": "KiTS23",
+        "reference": "KiTS23 Challenge",
+        "release": "1.0",
+        "description": "Kidney Tumor Segmentation Challenge 2023",
+        "tensorImageSize": "3D",
+        "modality": {
+            "0": "CT"
+        }
+    }
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    json_path = output_dir / "dataset.json"
+    # Temporal + renombrado: quien lo lea mientras se actualiza nunca ve un JSON a medias
+    tmp_path = output_dir / ".dataset.json.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(json_dict, f, indent=4)
+    os.replace(tmp_path, json_path)
+    print(f"✅ Archivo dataset.json creado en: {json_path}")
+
+def count_training_cases(output_dir):
+    """Casos con imagen (imagesTr/<id>_0000.nii.gz) y etiqueta (labelsTr/<id>.nii.gz)."""
+    output_dir = Path(output_dir)
+    try:
+        labels = {name[:-len(".nii.gz")] for name in os.listdir(output_dir / "labelsTr")
+                  if name.endswith(".nii.gz")}
+        images = {name[:-len("_0000.nii.gz")] for name in os.listdir(output_dir / "imagesTr")
+                  if name.endswith("_0000.nii.gz")}
+    except FileNotFoundError:
+        return 0
+    return len(labels & images)
+
+def update_dataset_json(output_dir):
+    """Reescribe dataset.json solo si cambió el número de casos completos. Devuelve ese número."""
+    json_path = Path(output_dir) / "dataset.json"
+    num_cases = count_training_cases(output_dir)
+    try:
+        with open(json_path, 'r') as f:
+            current = json.load(f).get("numTraining")
+    except (FileNotFoundError, ValueError):
+        current = None
+    if num_cases and num_cases != current:
+        create_dataset_json(output_dir, num_cases)
+    return num_cases
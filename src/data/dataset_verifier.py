@@ -0,0 +1,229 @@
+import os
+import json
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from pathlib import Path
+from tqdm import tqdm
+from .nifti_integrity_checker import iter_nifti_chunks, load_label_values
+
+# --- CONFIGURACIÓN ---
+DATASET_DIR = Path("data/raw/nnUNet_raw/Dataset101_KiTS23")
+# Hilos para leer cabeceras (trabajo de E/S) y procesos para los histogramas
+NUM_HEADER_THREADS = 16
+NUM_WORKERS = os.cpu_count() or 1
+# Histogramas de clases por etiqueta (descomprime cada etiqueta completa)
+COMPUTE_HISTOGRAMS = True
+# Tolerancias para comparar spacing y affine entre imagen y etiqueta
+SPACING_TOL = 1e-4
+AFFINE_TOL = 1e-3
+# ---------------------
+
+def load_dataset_json(dataset_dir):
+    json_path = Path(dataset_dir) / "dataset.json"
+    if not json_path.exists():
+        return None
+    with open(json_path, 'r') as f:
+        return json.load(f)
+
+def find_cases(dataset_dir, file_ending=".nii.gz", num_channels=1):
+    """Empareja imagesTr/<caso>_XXXX con labelsTr/<caso>.
+
+    Devuelve (casos completos, imágenes sin etiqueta, etiquetas sin imagen,
+    casos con canales faltantes).
+    """
+    images_dir = Path(dataset_dir) / "imagesTr"
+    labels_dir = Path(dataset_dir) / "labelsTr"
+    image_channels = {}
+    for f in images_dir.glob(f"*{file_ending}"):
+        stem = f.name[:-len(file_ending)]
+        case_id, _, channel = stem.rpartition("_")
+        image_channels.setdefault(case_id, set()).add(channel)
+    label_cases = {f.name[:-len(file_ending)] for f in labels_dir.glob(f"*{file_ending}")}
+
+    expected = {f"{c:04d}" for c in range(num_channels)}
+    missing_channels = sorted(c for c, chans in image_channels.items() if not expected <= chans)
+    complete = sorted(c for c in image_channels if c in label_cases and c not in missing_channels)
+    images_only = sorted(set(image_channels) - label_cases)
+    labels_only = sorted(label_cases - set(image_channels))
+    return complete, images_only, labels_only, missing_channels
+
+def read_geometry(path):
+    """Forma, spacing y affine desde la cabecera (sin leer los vóxeles)."""
+    import nibabel as nib
+    header = nib.load(path).header
+    shape = tuple(header.get_data_shape()) + (1, 1, 1)
+    zooms = tuple(header.get_zooms()) + (1.0, 1.0, 1.0)
+    return shape[:3], zooms[:3], header.get_best_affine()
+
+def _read_geometry_or_error(path):
+    """(geometría, None) o (None, error): una cabecera rota no detiene la verificación."""
+    try:
+        return read_geometry(path), None
+    except Exception as e:
+        return None, f"{Path(path).name}: {type(e).__name__}: {e}"
+
+# Geometría de relleno para los archivos ilegibles (se excluyen de las comparaciones)
+_NO_GEOMETRY = ((0, 0, 0), (0.0, 0.0, 0.0), np.zeros((4, 4)))
+
+def read_geometries(paths, unreadable=None, num_threads=NUM_HEADER_THREADS):
+    """Lee en bloque las cabeceras y las devuelve como arrays (N,3), (N,3), (N,4,4) y (N,) legibles.
+
+    Los errores de lectura se añaden a `unreadable` (lista) en vez de lanzarse.
+    """
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        results = list(tqdm(executor.map(_read_geometry_or_error, paths), total=len(paths),
+                            desc="Leyendo cabeceras"))
+    if unreadable is not None:
+        unreadable.extend(error for _, error in results if error)
+    geometries = [g or _NO_GEOMETRY for g, _ in results]
+    shapes = np.array([g[0] for g in geometries], dtype=np.int64).reshape(-1, 3)
+    spacings = np.array([g[1] for g in geometries], dtype=np.float64).reshape(-1, 3)
+    affines = np.array([g[2] for g in geometries], dtype=np.float64).reshape(-1, 4, 4)
+    readable = np.array([g is not None for g, _ in results], dtype=bool)
+    return shapes, spacings, affines, readable
+
+def compare_geometries(case_ids, reference, other, what):
+    """Compara en un solo paso vectorizado y devuelve la lista de discrepancias."""
+    ref_shapes, ref_spacings, ref_affines, ref_readable = reference
+    shapes, spacings, affines, readable = other
+    # Lo ilegible ya está reportado aparte
+    both = ref_readable & readable
+    bad_shape = np.any(ref_shapes != shapes, axis=1) & both
+    bad_spacing = ~np.all(np.isclose(ref_spacings, spacings, rtol=0, atol=SPACING_TOL), axis=1) & both
+    bad_affine = ~np.all(np.isclose(ref_affines, affines, rtol=0, atol=AFFINE_TOL), axis=(1, 2)) & both
+
+    mismatches = []
+    for i in np.flatnonzero(bad_shape):
+        mismatches.append(f"{case_ids[i]}: forma {what} {tuple(shapes[i].tolist())} != imagen {tuple(ref_shapes[i].tolist())}")
+    for i in np.flatnonzero(bad_spacing & ~bad_shape):
+        mismatches.append(f"{case_ids[i]}: spacing {what} {tuple(np.round(spacings[i], 4).tolist())} "
+                          f"!= imagen {tuple(np.round(ref_spacings[i], 4).tolist())}")
+    for i in np.flatnonzero(bad_affine & ~bad_spacing & ~bad_shape):
+        mismatches.append(f"{case_ids[i]}: affine {what} distinto al de la imagen")
+    return mismatches
+
+def label_histogram(path):
+    """Cuenta vóxeles por valor de etiqueta recorriendo el volumen por bloques."""
+    counts = np.zeros(0, dtype=np.int64)
+    extra = {}
+    chunks = iter_nifti_chunks(path)
+    next(chunks)  # cabecera
+    for chunk in chunks:
+        if chunk.dtype.kind in "ui" and (chunk.dtype.kind == "u" or chunk.min() >= 0):
+            binned = np.bincount(chunk.astype(np.intp, copy=False))
+            if len(binned) > len(counts):
+                counts = np.pad(counts, (0, len(binned) - len(counts)))
+            counts[:len(binned)] += binned
+        else:
+            # Etiquetas negativas o en float: caso raro, usamos np.unique
+            values, value_counts = np.unique(chunk, return_counts=True)
+            for v, c in zip(values.tolist(), value_counts.tolist()):
+                extra[v] = extra.get(v, 0) + c
+    histogram = {int(v): int(c) for v, c in enumerate(counts) if c}
+    for v, c in extra.items():
+        key = int(v) if float(v).is_integer() else v
+        histogram[key] = histogram.get(key, 0) + c
+    return histogram
+
+def _label_histogram_or_error(path):
+    try:
+        return label_histogram(path), None
+    except Exception as e:
+        return None, f"{Path(path).name}: {type(e).__name__}: {e}"
+
+def verify_dataset(dataset_dir=DATASET_DIR, histograms=COMPUTE_HISTOGRAMS, num_workers=NUM_WORKERS):
+    """Verifica la consistencia imagen/etiqueta de todo el dataset y reporta todo junto."""
+    dataset_dir = Path(dataset_dir)
+    dataset_json = load_dataset_json(dataset_dir) or {}
+    file_ending = dataset_json.get("file_ending", ".nii.gz")
+    num_channels = len(dataset_json.get("channel_names", {"0": "CT"}))
+
+    complete, images_only, labels_only, missing_channels = find_cases(dataset_dir, file_ending, num_channels)
+    report = {
+        "num_cases": len(complete),
+        "images_without_label": images_only,
+        "labels_without_image": labels_only,
+        "missing_channels": missing_channels,
+        "geometry_mismatches": [],
+        "unreadable_files": [],
+        "num_training_mismatch": None,
+        "label_histograms": {},
+        "unexpected_labels": {},
+    }
+    if not dataset_json:
+        report["num_training_mismatch"] = "No existe dataset.json"
+    elif dataset_json.get("numTraining") != len(complete):
+        report["num_training_mismatch"] = (f"numTraining={dataset_json.get('numTraining')} "
+                                           f"pero hay {len(complete)} casos completos")
+
+    if complete:
+        labels_dir = dataset_dir / "labelsTr"
+        images_dir = dataset_dir / "imagesTr"
+        label_paths = [labels_dir / f"{c}{file_ending}" for c in complete]
+        unreadable = report["unreadable_files"]
+        reference = read_geometries([images_dir / f"{c}_0000{file_ending}" for c in complete], unreadable)
+        for channel in range(1, num_channels):
+            other = read_geometries([images_dir / f"{c}_{channel:04d}{file_ending}" for c in complete],
+                                    unreadable)
+            report["geometry_mismatches"] += compare_geometries(complete, reference, other, f"canal {channel}")
+        report["geometry_mismatches"] += compare_geometries(
+            complete, reference, read_geometries(label_paths, unreadable), "etiqueta")
+
+        if histograms:
+            allowed = set(load_label_values(dataset_dir) or [])
+            reported = {error.split(":")[0] for error in unreadable}
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                hists = tqdm(executor.map(_label_histogram_or_error, label_paths, chunksize=2),
+                             total=len(label_paths), desc="Histogramas de etiquetas")
+                for case_id, (hist, error) in zip(complete, hists):
+                    if error:
+                        # Si la cabecera se leyó, los vóxeles no (gzip truncado...)
+                        if error.split(":")[0] not in reported:
+                            unreadable.append(error)
+                        continue
+                    report["label_histograms"][case_id] = hist
+                    unexpected = sorted(v for v in hist if allowed and v not in allowed)
+                    if unexpected:
+                        report["unexpected_labels"][case_id] = unexpected
+    return report
+
+def print_report(report):
+    problems = 0
+    for key, title in [("images_without_label", "Imágenes sin etiqueta"),
+                       ("labels_without_image", "Etiquetas sin imagen"),
+                       ("missing_channels", "Casos con canales faltantes"),
+                       ("unreadable_files", "Archivos ilegibles"),
+                       ("geometry_mismatches", "Discrepancias de geometría")]:
+        if report[key]:
+            problems += len(report[key])
+            print(f"\n⚠️ {title} ({len(report[key])}):")
+            for item in report[key]:
+                print(f"  {item}")
+    if report["num_training_mismatch"]:
+        problems += 1
+        print(f"\n⚠️ dataset.json: {report['num_training_mismatch']}")
+    if report["unexpected_labels"]:
+        problems += len(report["unexpected_labels"])
+        print(f"\n⚠️ Etiquetas con valores no declarados ({len(report['unexpected_labels'])}):")
+        for case_id, values in report["unexpected_labels"].items():
+            print(f"  {case_id}: {values}")
+    if report["label_histograms"]:
+        totals = {}
+        for hist in report["label_histograms"].values():
+            for v, c in hist.items():
+                totals[v] = totals.get(v, 0) + c
+        print("\n📊 Vóxeles por clase en todo el dataset:")
+        for v in sorted(totals, key=float):
+            print(f"  {v}: {totals[v]}")
+
+    if problems:
+        print(f"\n❌ {problems} problemas en {report['num_cases']} casos.")
+    else:
+        print(f"\n✅ {report['num_cases']} casos consistentes (forma, spacing y affine coinciden).")
+
+def main(dataset_dir=DATASET_DIR):
+    print(f"🔍 Verificando {dataset_dir}...")
+    print_report(verify_dataset(dataset_dir))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import os
+import json
+import sqlite3
+from pathlib import Path
+
+# --- CONFIGURACIÓN ---
+# Catálogo persistente de carpetas de series DICOM (solo metadatos de cabecera)
+CATALOG_PATH = Path("data/dicom_catalog.sqlite")
+# ---------------------
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs(parent);
+CREATE TABLE IF NOT EXISTS series (
+    series_dir TEXT PRIMARY KEY,
+    patient_id TEXT,
+    series_uid TEXT,
+    num_slices INTEGER,
+    spacing TEXT,
+    files_mtime_ns INTEGER,
+    dir_mtime_ns INTEGER
+);
+"""
+
+def open_catalog(db_path=CATALOG_PATH):
+    """Abre (o crea) el catálogo SQLite de series DICOM."""
+    db_path = Path(db_path)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(db_path))
+    conn.row_factory = sqlite3.Row
+    conn.executescript(_SCHEMA)
+    return conn
+
+def _tree_filter(root):
+    """Cláusula WHERE para `root` y todo lo que cuelga de él (sin LIKE, por los '_' en rutas)."""
+    prefix = root.rstrip(os.sep) + os.sep
+    return "(path = ? OR substr(path, 1, ?) = ?)", (root, len(prefix), prefix)
+
+def read_series_header(dcm_path):
+    """Lee solo la cabecera de un DICOM (sin decodificar píxeles)."""
+    import SimpleITK as sitk
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(dcm_path))
+    reader.LoadPrivateTagsOn()
+    reader.ReadImageInformation()
+
+    def tag(key):
+        return reader.GetMetaData(key).strip() if reader.HasMetaDataKey(key) else None
+
+    spacing = None
+    pixel_spacing = tag("0028|0030")
+    if pixel_spacing:
+        spacing = [float(v) for v in pixel_spacing.split("\\")]
+        thickness = tag("0018|0050")
+        if thickness:
+            spacing.append(float(thickness))
+    return {
+        "patient_id": tag("0010|0020"),
+        "series_uid": tag("0020|000e"),
+        "spacing": spacing,
+    }
+
+def _catalog_series(conn, series_dir, dir_mtime_ns, dcm_entries):
+    """Registra (o actualiza) una carpeta de serie a partir de sus archivos .dcm."""
+    dcm_entries.sort(key=lambda e: e.name)
+    files_mtime_ns = max(e.stat().st_mtime_ns for e in dcm_entries)
+    try:
+        header = read_series_header(dcm_entries[0].path)
+    except Exception as e:
+        print(f"⚠️ No se pudo leer la cabecera de {series_dir}: {e}")
+        header = {"patient_id": None, "series_uid": None, "spacing": None}
+    conn.execute(
+        "INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (series_dir, header["patient_id"], header["series_uid"], len(dcm_entries),
+         json.dumps(header["spacing"]), files_mtime_ns, dir_mtime_ns),
+    )
+
+def rescan(conn, root):
+    """Actualiza el catálogo bajo `root` tocando solo las carpetas que cambiaron.
+
+    Se compara el mtime de cada carpeta con el guardado: si no cambió, sus
+    hijos se toman del catálogo sin listar el directorio (las carpetas de
+    series, con cientos de .dcm, ni se abren). Solo las carpetas nuevas o
+    modificadas se listan y, si tienen .dcm, se lee la cabecera de un archivo.
+    Devuelve (carpetas re-escaneadas, carpetas eliminadas).
+    """
+    root = os.path.abspath(root)
+    where, params = _tree_filter(root)
+    known = {}
+    children = {}
+    for row in conn.execute(f"SELECT path, parent, mtime_ns FROM dirs WHERE {where}", params):
+        known[row["path"]] = row["mtime_ns"]
+        children.setdefault(row["parent"], []).append(row["path"])
+
+    seen = set()
+    rescanned = 0
+    stack = [root]
+    with conn:
+        while stack:
+            current = stack.pop()
+            try:
+                mtime_ns = os.stat(current).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            seen.add(current)
+
+            if known.get(current) == mtime_ns:
+                stack.extend(children.get(current, []))
+                continue
+
+            # Carpeta nueva o modificada: la listamos
+            rescanned += 1
+            subdirs, dcm_entries = [], []
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        # Las carpetas ocultas (p. ej. descargas a medias en .partial) no cuentan
+                        if not entry.name.startswith("."):
+                            subdirs.append(entry.path)
+                    elif entry.name.lower().endswith(".dcm"):
+                        dcm_entries.append(entry)
+
+            conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)",
+                         (current, os.path.dirname(current), mtime_ns))
+            if dcm_entries:
+                _catalog_series(conn, current, mtime_ns, dcm_entries)
+            else:
+                conn.execute("DELETE FROM series WHERE series_dir = ?", (current,))
+            stack.extend(subdirs)
+
+        removed = [path for path in known if path not in seen]
+        conn.executemany("DELETE FROM dirs WHERE path = ?", ((p,) for p in removed))
+        conn.executemany("DELETE FROM series WHERE series_dir = ?", ((p,) for p in removed))
+    return rescanned, len(removed)
+
+def query_series(conn, root):
+    """Devuelve las series catalogadas bajo `root` como lista de dicts."""
+    where, params = _tree_filter(os.path.abspath(root))
+    where = where.replace("path", "series_dir")
+    rows = conn.execute(f"SELECT * FROM series WHERE {where} ORDER BY series_dir", params)
+    series = []
+    for row in rows:
+        item = dict(row)
+        item["series_dir"] = Path(item["series_dir"])
+        item["spacing"] = json.loads(item["spacing"]) if item["spacing"] else None
+        series.append(item)
+    return series
+
+def forget_tree(conn, root):
+    """Elimina del catálogo todo lo que cuelga de `root` (p. ej. tras borrar temporales)."""
+    where, params = _tree_filter(os.path.abspath(root))
+    with conn:
+        conn.execute(f"DELETE FROM dirs WHERE {where}", params)
+        conn.execute(f"DELETE FROM series WHERE {where.replace('path', 'series_dir')}", params)
+
+def main():
+    # Uso directo: actualizar el catálogo del directorio de imágenes TCGA
+    root = Path("data/raw/TCGA-KIRC/images")
+    conn = open_catalog()
+    rescanned, removed = rescan(conn, root)
+    total = len(query_series(conn, root))
+    print(f"📇 Catálogo actualizado: {total} series ({rescanned} carpetas re-escaneadas, {removed} eliminadas).")
+
+if __name__ == "__main__":
+    main()
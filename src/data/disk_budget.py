@@ -0,0 +1,127 @@
+import errno
+import shutil
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+# --- CONFIGURACIÓN ---
+# Fracción de cada disco que el pipeline puede dejar ocupada (contando lo que ya usan otros)
+HIGH_WATER_MARK = 0.90
+# Además, no bajar nunca de estos bytes libres (en discos grandes el 10% es mucho, en
+# discos pequeños puede ser muy poco)
+MIN_FREE_BYTES = 5 * 1024**3
+# Cada cuánto se vuelve a mirar el disco mientras una unidad espera (otros procesos
+# también pueden liberar espacio)
+POLL_INTERVAL = 5.0
+# ---------------------
+
+
+class DiskBudgetExceeded(OSError):
+    """Una unidad de trabajo no cabe ni con el pipeline vacío: no tiene sentido esperar."""
+
+    def __init__(self, message):
+        super().__init__(errno.ENOSPC, message)
+
+
+def _existing(path):
+    """El propio `path` o su ancestro más cercano que exista (para carpetas aún no creadas)."""
+    path = Path(path).absolute()
+    while not path.exists() and path != path.parent:
+        path = path.parent
+    return path
+
+
+class DiskBudget:
+    """Admite trabajo solo mientras el uso previsto de cada disco quede bajo la marca de agua.
+
+    Cada unidad declara cuántos bytes va a escribir en cada carpeta
+    (temporales, destino, caché...). Las carpetas se agrupan por disco y se
+    compara lo ocupado ahora según `disk_usage` más lo reservado por las
+    unidades en vuelo con el límite del disco. Lo reservado se cuenta entero
+    hasta que la unidad termina, aunque parte ya esté escrito: se sobreestima
+    un poco, nunca se subestima. Si la unidad no cabe se espera a que termine
+    otra; si no cabe ni sin nada en vuelo se lanza DiskBudgetExceeded antes de
+    empezarla, así nunca se queda nada a medias por falta de espacio.
+    """
+
+    def __init__(self, high_water=HIGH_WATER_MARK, min_free=MIN_FREE_BYTES, poll_interval=POLL_INTERVAL):
+        self.high_water = high_water
+        self.min_free = min_free
+        self.poll_interval = poll_interval
+        self.cond = threading.Condition()
+        self.reserved = {}  # st_dev -> bytes reservados por las unidades en vuelo
+        self.inflight = 0
+
+    def limit(self, path):
+        """Bytes ocupados que se permiten en el disco de `path`."""
+        total = shutil.disk_usage(_existing(path)).total
+        return max(0, min(total * self.high_water, total - self.min_free))
+
+    def _volumes(self, needs):
+        """{st_dev: (carpeta representativa, bytes)} sumando las carpetas del mismo disco."""
+        volumes = {}
+        for path, nbytes in needs.items():
+            path = _existing(path)
+            device = path.stat().st_dev
+            first, total = volumes.get(device, (path, 0))
+            volumes[device] = (first, total + max(0, int(nbytes)))
+        return volumes
+
+    def _shortfall(self, volumes):
+        """Primer disco donde no cabe la unidad: (carpeta, bytes que faltan); None si cabe."""
+        for device, (path, nbytes) in volumes.items():
+            usage = shutil.disk_usage(path)
+            # total - free y no `used`: los bloques reservados para root tampoco son nuestros
+            projected = usage.total - usage.free + self.reserved.get(device, 0) + nbytes
+            excess = projected - self.limit(path)
+            if excess > 0:
+                return path, excess
+        return None
+
+    def headroom(self, path):
+        """Bytes que aún se pueden admitir en el disco de `path`."""
+        path = _existing(path)
+        usage = shutil.disk_usage(path)
+        with self.cond:
+            reserved = self.reserved.get(path.stat().st_dev, 0)
+        return max(0, int(self.limit(path) - (usage.total - usage.free) - reserved))
+
+    def acquire(self, needs, key=None):
+        """Espera a que quepan `needs` ({carpeta: bytes}) y los reserva. Devuelve la reserva."""
+        volumes = self._volumes(needs)
+        waiting = False
+        with self.cond:
+            while True:
+                shortfall = self._shortfall(volumes)
+                if shortfall is None:
+                    break
+                path, excess = shortfall
+                if self.inflight == 0:
+                    raise DiskBudgetExceeded(
+                        f"{key or 'La unidad'} necesita {excess / 1024**2:.0f} MB más de los "
+                        f"que permite la marca de agua en {path}")
+                if not waiting:
+                    print(f"⏸️ {key or 'Unidad'} espera espacio en {path} "
+                          f"(faltan {excess / 1024**2:.0f} MB hasta que termine otra).")
+                    waiting = True
+                self.cond.wait(self.poll_interval)
+            for device, (_, nbytes) in volumes.items():
+                self.reserved[device] = self.reserved.get(device, 0) + nbytes
+            self.inflight += 1
+        return volumes
+
+    def release(self, reservation):
+        """Devuelve una reserva; lo ya escrito lo reflejará `disk_usage`."""
+        with self.cond:
+            for device, (_, nbytes) in reservation.items():
+                self.reserved[device] -= nbytes
+            self.inflight -= 1
+            self.cond.notify_all()
+
+    @contextmanager
+    def admit(self, needs, key=None):
+        reservation = self.acquire(needs, key)
+        try:
+            yield reservation
+        finally:
+            self.release(reservation)
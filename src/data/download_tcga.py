@@ -1,91 +1,385 @@
 import os
-import pandas as pd
-from tcia_utils import nbia
 import json
+import time
+import random
+import shutil
+import zipfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from tqdm import tqdm
 
 # Configuración
 DATASET_NAME = "TCGA-KIRC"
 DOWNLOAD_PATH = "data/raw/TCGA-KIRC/images"
+FAILED_LOG = Path("failed_downloads.log")
+# API REST pública de NBIA (la misma que usa tcia_utils por debajo)
+NBIA_API_URL = "https://services.cancerimagingarchive.net/nbia-api/services/v1"
 
-# Crear directorio si no existe
-os.makedirs(DOWNLOAD_PATH, exist_ok=True)
+# Cómo se descarga: "http" (API REST de NBIA, reanuda series cortadas con Range) o
+# "nbia" (tcia_utils.downloadSeries; una serie cortada se vuelve a bajar entera)
+TRANSPORT = "http"
+# Descargas simultáneas (una serie por hilo) al empezar
+MAX_WORKERS = 4
+# Ajustar las descargas simultáneas según el MB/s medido, entre 1 y MAX_ADAPTIVE_WORKERS
+ADAPTIVE_CONCURRENCY = True
+MAX_ADAPTIVE_WORKERS = 12
+# Segundos de cada ventana de medición y cambio de MB/s que cuenta como mejora o empeoramiento
+ADAPT_INTERVAL = 10.0
+ADAPT_THRESHOLD = 0.1
+# Reintentos por serie con espera exponencial acotada
+MAX_RETRIES = 5
+BACKOFF_BASE = 2.0   # segundos
+BACKOFF_MAX = 60.0   # segundos
+# Límite de ancho de banda total (bytes/s). None = sin límite
+MAX_BYTES_PER_SEC = None
+CHUNK_SIZE = 1024 * 1024
 
-print(f"Iniciando descarga de la colección {DATASET_NAME}...")
+# Carpeta (dentro del destino) donde viven las series a medio descargar
+PARTIAL_DIRNAME = ".partial"
 
-# 1. Obtener la lista de series (scans) disponibles
-try:
-    series_data = nbia.getSeries(
-        collection=DATASET_NAME,
-        modality="CT"
-    )
-except Exception as e:
-    print(f"Error al conectar con TCIA: {e}")
-    exit(1)
 
-# Diagnóstico: Imprimir el tipo de dato recibido
-print(f"Tipo de datos recibido de getSeries: {type(series_data)}")
-if isinstance(series_data, list) and len(series_data) > 0:
-    print(f"Primer elemento: {series_data[0]} (Tipo: {type(series_data[0])})")
+class RateLimiter:
+    """Cubo de tokens compartido por todos los hilos de descarga."""
 
-# 2. Procesar los UIDs de las series
-series_uids = []
+    def __init__(self, bytes_per_sec=None):
+        self.bytes_per_sec = bytes_per_sec
+        self.lock = threading.Lock()
+        self.allowance = 0.0
+        self.last = time.monotonic()
 
-if isinstance(series_data, list):
+    def throttle(self, nbytes):
+        """Registra `nbytes` recibidos y duerme lo necesario para respetar el límite."""
+        if not self.bytes_per_sec:
+            return
+        with self.lock:
+            now = time.monotonic()
+            # Permitimos ráfagas de como mucho un segundo de tráfico
+            self.allowance = min(self.bytes_per_sec,
+                                 self.allowance + (now - self.last) * self.bytes_per_sec)
+            self.last = now
+            self.allowance -= nbytes
+            wait = -self.allowance / self.bytes_per_sec if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    """Ajusta cuántas series se descargan a la vez según el throughput medido.
+
+    Cada ADAPT_INTERVAL segundos con las plazas ocupadas (en promedio) se
+    compara el MB/s de la ventana con el de la anterior: si mejoró se da otro paso en la
+    misma dirección (una descarga más o una menos), si empeoró se invierte la
+    dirección y si apenas cambió se deja como está. Un intento fallido
+    (timeout, 503, conexión cortada) reduce el límite a la mitad: el
+    servidor o la red no dan para más. Las ventanas con plazas libres (final
+    de un lote, pausas entre lotes) no cuentan.
+    """
+
+    def __init__(self, initial=MAX_WORKERS, max_workers=MAX_ADAPTIVE_WORKERS,
+                 interval=ADAPT_INTERVAL, threshold=ADAPT_THRESHOLD, enabled=ADAPTIVE_CONCURRENCY):
+        self.enabled = enabled
+        self.limit = max(1, initial)
+        self.max_workers = max(self.limit, max_workers) if enabled else self.limit
+        self.interval = interval
+        self.threshold = threshold
+        self.cond = threading.Condition()
+        self.active = 0
+        self.direction = 1
+        self.last_rate = None
+        self._new_window()
+
+    def _new_window(self):
+        self.window_start = self.last_change = time.monotonic()
+        self.window_bytes = 0
+        self.busy_seconds = 0.0
+
+    def _tick(self):
+        """Acumula descargas activas × tiempo (para el promedio de la ventana)."""
+        now = time.monotonic()
+        self.busy_seconds += self.active * (now - self.last_change)
+        self.last_change = now
+
+    @contextmanager
+    def slot(self):
+        """Espera una plaza libre (hay `limit`) mientras dura la descarga de una serie."""
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self._tick()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self._tick()
+                self.active -= 1
+                self.cond.notify_all()
+
+    def observe(self, nbytes):
+        """Cuenta bytes recibidos y, al cerrar una ventana, ajusta el límite."""
+        if not self.enabled:
+            return
+        with self.cond:
+            self.window_bytes += nbytes
+            elapsed = time.monotonic() - self.window_start
+            if elapsed < self.interval:
+                return
+            self._tick()
+            rate = self.window_bytes / elapsed
+            # Casi todas las plazas ocupadas; si no, el MB/s no dice nada del límite
+            full = self.busy_seconds / elapsed >= 0.9 * self.limit
+            self._new_window()
+            if not full:
+                return
+            if self.last_rate is not None:
+                change = (rate - self.last_rate) / max(self.last_rate, 1.0)
+                if abs(change) <= self.threshold:
+                    return
+                if change < 0:
+                    self.direction = -self.direction
+            self.last_rate = rate
+            self.limit = min(self.max_workers, max(1, self.limit + self.direction))
+            self.cond.notify_all()
+
+    def penalize(self):
+        """Un intento falló: la mitad de descargas y se vuelve a subir poco a poco."""
+        if not self.enabled:
+            return
+        with self.cond:
+            self.limit = max(1, self.limit // 2)
+            self.direction = 1
+            self.last_rate = None
+            self._new_window()
+
+
+class NbiaTransport:
+    """Transporte basado en tcia_utils (una llamada a downloadSeries por serie).
+
+    No permite reanudar a mitad de serie: una serie parcial se vuelve a bajar
+    completa.
+    """
+
+    def get_series(self, collection, modality):
+        from tcia_utils import nbia
+        return nbia.getSeries(collection=collection, modality=modality)
+
+    def fetch(self, series_uid, staging_dir, throttle):
+        from tcia_utils import nbia
+        # tcia_utils salta las series cuya carpeta ya existe, aunque esté incompleta
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        staging_dir.parent.mkdir(parents=True, exist_ok=True)
+        nbia.downloadSeries([series_uid], input_type="list", path=str(staging_dir.parent))
+        # tcia_utils registra los errores en vez de lanzarlos: comprobamos el resultado
+        files = list(staging_dir.glob("*")) if staging_dir.exists() else []
+        if not files:
+            raise IOError(f"tcia_utils no descargó la serie {series_uid}")
+        throttle(sum(f.stat().st_size for f in files))
+
+
+class HttpTransport:
+    """Transporte HTTP directo contra la API de NBIA (o un servidor compatible).
+
+    Descarga el ZIP de la serie a un archivo `.zip.part` y, si se corta, la
+    siguiente vez pide solo los bytes que faltan con una cabecera Range.
+    """
+
+    def __init__(self, base_url=NBIA_API_URL, timeout=60):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _url(self, endpoint, **params):
+        return f"{self.base_url}/{endpoint}?{urllib.parse.urlencode(params)}"
+
+    def get_series(self, collection, modality):
+        url = self._url("getSeries", Collection=collection, Modality=modality, format="json")
+        with urllib.request.urlopen(url, timeout=self.timeout) as response:
+            return json.load(response)
+
+    def fetch(self, series_uid, staging_dir, throttle):
+        part_path = staging_dir.with_name(staging_dir.name + ".zip.part")
+        part_path.parent.mkdir(parents=True, exist_ok=True)
+        offset = part_path.stat().st_size if part_path.exists() else 0
+
+        request = urllib.request.Request(self._url("getImage", SeriesInstanceUID=series_uid))
+        if offset:
+            request.add_header("Range", f"bytes={offset}-")
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                # Si el servidor ignora el Range (200 en vez de 206), empezamos de cero
+                mode = "ab" if offset and response.status == 206 else "wb"
+                with open(part_path, mode) as f:
+                    while True:
+                        chunk = response.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        throttle(len(chunk))
+        except urllib.error.HTTPError as e:
+            # 416: el .part ya estaba completo (se cortó antes de descomprimir)
+            if e.code != 416:
+                raise
+
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        try:
+            with zipfile.ZipFile(part_path) as archive:
+                archive.extractall(staging_dir)
+        except zipfile.BadZipFile:
+            # ZIP corrupto: no sirve para reanudar, lo descartamos entero
+            part_path.unlink()
+            raise
+        part_path.unlink()
+
+
+def make_transport(kind=TRANSPORT):
+    if kind == "http":
+        return HttpTransport()
+    if kind == "nbia":
+        return NbiaTransport()
+    raise ValueError(f"Transporte desconocido: {kind}")
+
+
+def extract_series_uids(series_data):
+    """Obtiene la lista de SeriesInstanceUID de la respuesta de getSeries."""
+    if not isinstance(series_data, list):
+        raise ValueError("La respuesta de la API no es una lista.")
     if len(series_data) == 0:
-        print("No se encontraron series para los criterios dados.")
-        exit()
-        
+        return []
+
     first_item = series_data[0]
-    
     # CASO A: Es una lista de diccionarios (Formato esperado habitual)
     if isinstance(first_item, dict):
-        print("Formato detectado: Lista de Diccionarios")
-        # Convertir a DataFrame para facilitar el manejo y visualización
+        import pandas as pd
         df = pd.DataFrame(series_data)
-        print(f"Se encontraron {len(df)} series de CT.")
-        if 'SeriesInstanceUID' in df.columns:
-            series_uids = df['SeriesInstanceUID'].tolist()
-        else:
-            print("Error: La columna 'SeriesInstanceUID' no se encuentra en los datos.")
-            print("Columnas disponibles:", df.columns)
-            exit(1)
-            
+        if 'SeriesInstanceUID' not in df.columns:
+            raise ValueError(f"La columna 'SeriesInstanceUID' no se encuentra en los datos. "
+                             f"Columnas disponibles: {list(df.columns)}")
+        return df['SeriesInstanceUID'].tolist()
     # CASO B: Es una lista de strings (Formato simple)
-    elif isinstance(first_item, str):
-        print("Formato detectado: Lista de Strings (UIDs directos)")
-        series_uids = series_data
-        print(f"Se encontraron {len(series_uids)} series de CT.")
-        
-    else:
-        print(f"Formato de datos desconocido: {type(first_item)}")
-        exit(1)
-else:
-    print("La respuesta de la API no es una lista.")
-    exit(1)
-
-# 3. Descargar las imágenes
-print(f"\nPreparando descarga de {len(series_uids)} series...")
-
-BATCH_SIZE = 5 # Reducido para mejor control inicial
-total_batches = (len(series_uids) + BATCH_SIZE - 1) // BATCH_SIZE
-
-for i in range(total_batches):
-    start_idx = i * BATCH_SIZE
-    end_idx = min((i + 1) * BATCH_SIZE, len(series_uids))
-    batch_uids = series_uids[start_idx : end_idx]
-    
-    print(f"Descargando lote {i+1}/{total_batches} (Series {start_idx+1} a {end_idx})...")
-    
+    if isinstance(first_item, str):
+        return list(series_data)
+    raise ValueError(f"Formato de datos desconocido: {type(first_item)}")
+
+
+def _backoff_delay(attempt):
+    """Espera exponencial con jitter completo, acotada a BACKOFF_MAX."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def download_series(series_uids, download_path=DOWNLOAD_PATH, transport=None,
+                    max_workers=MAX_WORKERS, max_retries=MAX_RETRIES,
+                    max_bytes_per_sec=MAX_BYTES_PER_SEC, failed_log=FAILED_LOG, concurrency=None):
+    """Descarga series en paralelo con reintentos y reanudación.
+
+    Cada serie se baja a `<download_path>/.partial/<uid>` y solo cuando está
+    completa se renombra a `<download_path>/<uid>`, así una carpeta final
+    siempre es una serie entera y las que ya existen se saltan al reanudar.
+    Con HttpTransport (el de TRANSPORT por defecto) una serie cortada además
+    sigue desde el último byte; con NbiaTransport se vuelve a bajar entera.
+    Las descargas simultáneas empiezan en `max_workers` y las ajusta
+    `concurrency` (AdaptiveConcurrency; pasar la misma entre llamadas
+    conserva lo aprendido). Devuelve un dict con las listas `downloaded`,
+    `skipped`, `failed`, los bytes recibidos, los segundos empleados,
+    `timings`: (bytes, segundos) del intento que completó cada serie
+    descargada, y `workers`: descargas simultáneas al terminar.
+    """
+    transport = transport or make_transport()
+    concurrency = concurrency or AdaptiveConcurrency(max_workers)
+    download_path = Path(download_path)
+    partial_root = download_path / PARTIAL_DIRNAME
+    partial_root.mkdir(parents=True, exist_ok=True)
+
+    limiter = RateLimiter(max_bytes_per_sec)
+    counter = {"bytes": 0}
+    lock = threading.Lock()
+
+    def throttle(nbytes):
+        with lock:
+            counter["bytes"] += nbytes
+        concurrency.observe(nbytes)
+        limiter.throttle(nbytes)
+
+    def fetch_one(uid):
+        final_dir = download_path / uid
+        if final_dir.exists():
+            return uid, "skipped", None, None
+        staging_dir = partial_root / uid
+        error = None
+        for attempt in range(max_retries + 1):
+            if attempt:
+                time.sleep(_backoff_delay(attempt - 1))
+            try:
+                with concurrency.slot():
+                    started = time.perf_counter()
+                    transport.fetch(uid, staging_dir, throttle)
+                    os.replace(staging_dir, final_dir)
+                nbytes = sum(f.stat().st_size for f in final_dir.rglob("*") if f.is_file())
+                return uid, "downloaded", None, (nbytes, time.perf_counter() - started)
+            except Exception as e:
+                error = e
+                concurrency.penalize()
+        return uid, "failed", error, None
+
+    summary = {"downloaded": [], "skipped": [], "failed": [], "bytes": 0, "seconds": 0.0, "timings": []}
+    start = time.perf_counter()
+    # Hilos para el máximo de descargas; las que sobran esperan plaza en `concurrency`
+    with ThreadPoolExecutor(max_workers=concurrency.max_workers) as executor:
+        progress = tqdm(executor.map(fetch_one, series_uids), total=len(series_uids),
+                        desc="Descargando series", unit="serie")
+        for uid, status, error, timing in progress:
+            summary[status].append(uid)
+            if timing:
+                summary["timings"].append(timing)
+            elapsed = time.perf_counter() - start
+            progress.set_postfix(MBps=f"{counter['bytes'] / 1e6 / max(elapsed, 1e-9):.1f}",
+                                 hilos=concurrency.limit)
+            if status == "failed":
+                print(f" Error descargando serie {uid} tras {max_retries} reintentos: {error}")
+                # Guardamos los UIDs fallidos en un log
+                if failed_log:
+                    with open(failed_log, "a") as f:
+                        f.write(f"{uid}\n")
+
+    summary["bytes"] = counter["bytes"]
+    summary["seconds"] = time.perf_counter() - start
+    summary["workers"] = concurrency.limit
+    return summary
+
+
+def main(transport=None):
+    transport = transport or make_transport()
+    print(f"Iniciando descarga de la colección {DATASET_NAME}...")
+
+    # 1. Obtener la lista de series (scans) disponibles
     try:
-        # La función downloadSeries espera una lista de strings (UIDs)
-        # Nota: input_type="list" es el valor por defecto, pero ser explícito ayuda
-        nbia.downloadSeries(batch_uids, input_type="list", path=DOWNLOAD_PATH)
+        series_data = transport.get_series(DATASET_NAME, "CT")
     except Exception as e:
-        print(f" Error descargando lote {i+1}: {e}")
-        # Opcional: Guardar los UIDs fallidos en un log
-        with open("failed_downloads.log", "a") as f:
-            for uid in batch_uids:
-                f.write(f"{uid}\n")
-        continue
-
-print("\n¡Proceso de descarga finalizado!")
\ No newline at end of file
+        print(f"Error al conectar con TCIA: {e}")
+        return
+
+    # 2. Procesar los UIDs de las series
+    try:
+        series_uids = extract_series_uids(series_data)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+    if not series_uids:
+        print("No se encontraron series para los criterios dados.")
+        return
+    print(f"Se encontraron {len(series_uids)} series de CT.")
+
+    # 3. Descargar las imágenes
+    print(f"\nPreparando descarga de {len(series_uids)} series...")
+    summary = download_series(series_uids, DOWNLOAD_PATH, transport)
+
+    print(f"\n¡Proceso de descarga finalizado! {len(summary['downloaded'])} descargadas, "
+          f"{len(summary['skipped'])} ya existían, {len(summary['failed'])} fallidas "
+          f"({summary['bytes'] / 1e6:.1f} MB en {summary['seconds']:.1f}s, "
+          f"{summary['workers']} descargas simultáneas al final).")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# --- CONFIGURACIÓN ---
+# Tipos de destino: las etiquetas caben en uint8 y el CT (HU, -1024..3071) en int16
+LABEL_DTYPE = "uint8"
+IMAGE_DTYPE = "int16"
+# Máscaras guardadas como imagen cuyos valores no son las etiquetas: ({valor: etiqueta},
+# valores de los que tiene que aparecer alguno para usar la tabla, o None). Se usa la
+# primera tabla que cubra todos los valores presentes.
+MASK_VALUE_MAPS = [
+    # Etiquetas reescaladas a 0-255 (255 / 3 por clase). Solo si aparece un nivel intermedio:
+    # una máscara binaria 0/255 no dice de qué clase es y se rechaza (no se vuelve quiste)
+    ({0: 0, 85: 1, 170: 2, 255: 3}, {85, 170}),
+    # PNG con paleta VOC/DAVIS convertido a escala de grises (cada gris es de una clase)
+    ({0: 0, 38: 1, 75: 2, 113: 3}, None),
+]
+# Elementos por bloque al revisar rangos (acota los temporales de las comparaciones)
+CHECK_BLOCK = 16 * 1024 * 1024
+# ---------------------
+
+
+def _blocks(array):
+    """Vistas planas de `array` por bloques de CHECK_BLOCK elementos, sin copiar."""
+    # order="K" sigue el orden en memoria: vista sin copia para volúmenes C o Fortran
+    flat = array.ravel(order="K")
+    for start in range(0, flat.size, CHECK_BLOCK):
+        yield flat[start:start + CHECK_BLOCK]
+
+
+def value_range(array):
+    """(mínimo, máximo, todos enteros) recorriendo el volumen por bloques vectorizados."""
+    import numpy as np
+    lo, hi, integral = None, None, True
+    is_float = array.dtype.kind == "f"
+    for block in _blocks(array):
+        block_lo, block_hi = block.min(), block.max()
+        lo = block_lo if lo is None else min(lo, block_lo)
+        hi = block_hi if hi is None else max(hi, block_hi)
+        if is_float and integral:
+            # NaN/Inf tampoco son enteros: np.isfinite los descarta
+            integral = bool(np.all(np.isfinite(block)) and np.all(block == np.rint(block)))
+    return lo, hi, integral
+
+
+def _fits(lo, hi, integral, dtype):
+    import numpy as np
+    info = np.iinfo(dtype)
+    return integral and lo is not None and info.min <= lo and hi <= info.max
+
+
+def image_dtype(array):
+    """IMAGE_DTYPE si el CT cabe en él sin perder nada; None si hay que dejarlo como está.
+
+    Un tipo entero que ya ocupa lo mismo o menos (uint8 de los PNG, int16 de
+    la mayoría de los DICOM) se deja como está.
+    """
+    import numpy as np
+    target = np.dtype(IMAGE_DTYPE)
+    if array.dtype.kind in "iub" and array.dtype.itemsize <= target.itemsize:
+        return None
+    return target if _fits(*value_range(array), target) else None
+
+
+def compact_image(array):
+    """CT en IMAGE_DTYPE si la conversión no pierde nada; si no, tal cual (mismo orden de memoria)."""
+    target = image_dtype(array)
+    return array if target is None else array.astype(target, order="K")
+
+
+def _as_index(block):
+    """Bloque como índices: float (ya verificado entero) y uint64 no los acepta bincount/take."""
+    import numpy as np
+    if block.dtype.kind == "f" or block.dtype == np.uint64:
+        return block.astype(np.intp)
+    return block
+
+def _present_values(array, hi):
+    """Valores presentes en una máscara entera no negativa (bincount: O(n), sin ordenar)."""
+    import numpy as np
+    counts = np.zeros(int(hi) + 1, dtype=np.int64)
+    for block in _blocks(array):
+        counts += np.bincount(_as_index(block), minlength=counts.size)
+    return set(np.flatnonzero(counts).tolist())
+
+
+def label_lut(values, label_values=None):
+    """Tabla valor -> etiqueta para una máscara con `values`, o None si no hace falta remapear.
+
+    Sin `label_values` (las etiquetas de dataset.json) solo se remapea si los
+    valores no caben en LABEL_DTYPE. Lanza ValueError si ninguna tabla de
+    MASK_VALUE_MAPS explica los valores.
+    """
+    import numpy as np
+    if label_values is not None:
+        if values <= set(label_values):
+            return None
+    elif max(values, default=0) <= np.iinfo(LABEL_DTYPE).max:
+        return None
+    for mapping, required in MASK_VALUE_MAPS:
+        if values <= mapping.keys() and (required is None or values & required):
+            lut = np.zeros(max(mapping) + 1, dtype=LABEL_DTYPE)
+            for value, label in mapping.items():
+                lut[value] = label
+            return lut
+    raise ValueError(f"Valores de máscara sin tabla de etiquetas: {sorted(values)[:10]}")
+
+
+def compact_label(array, label_values=None):
+    """Máscara en LABEL_DTYPE, remapeada con una tabla (np.take) si sus valores no son etiquetas.
+
+    Lanza ValueError si los valores son negativos, no enteros o no se pueden
+    traducir a etiquetas. Mantiene el orden de memoria (C o Fortran).
+    """
+    import numpy as np
+    lo, hi, integral = value_range(array)
+    if lo is None:
+        return array.astype(LABEL_DTYPE, order="K")
+    if not integral or lo < 0:
+        raise ValueError(f"Máscara con valores no enteros o negativos (mín {lo}, máx {hi})")
+    if hi > max(np.iinfo(LABEL_DTYPE).max, *(max(mapping) for mapping, _ in MASK_VALUE_MAPS)):
+        # Ninguna tabla llega tan alto (y contar hasta `hi` sería un array enorme)
+        raise ValueError(f"Máscara con valores hasta {hi}: no caben en {LABEL_DTYPE} ni hay tabla")
+    values = _present_values(array, hi)
+    lut = label_lut(values, label_values)
+    if lut is None:
+        if array.dtype == LABEL_DTYPE:
+            return array
+        return array.astype(LABEL_DTYPE, order="K")
+    out = np.empty_like(array, dtype=LABEL_DTYPE)
+    # Por bloques, como los chequeos: sin temporales del tamaño del volumen. `out` es nuevo
+    # y contiguo, así que ravel devuelve una vista y se escribe en su sitio.
+    # Los valores están verificados, ninguno se sale de la tabla.
+    for block, out_block in zip(_blocks(array), _blocks(out)):
+        np.take(lut, _as_index(block), out=out_block, mode="clip")
+    return out
+
+
+_SITK_PIXEL_TYPES = {"uint8": "sitkUInt8", "int8": "sitkInt8", "uint16": "sitkUInt16", "int16": "sitkInt16"}
+
+
+def compact_sitk_image(image, is_label=False, label_values=None):
+    """Aplica la política a una imagen de SimpleITK conservando spacing, origen y dirección."""
+    import SimpleITK as sitk
+    array = sitk.GetArrayViewFromImage(image)
+    if not is_label:
+        target = image_dtype(array)
+        # Mismos valores en otro tipo: Cast lo hace sin pasar por NumPy
+        return image if target is None else sitk.Cast(image, getattr(sitk, _SITK_PIXEL_TYPES[target.name]))
+    compact = compact_label(array, label_values)
+    if compact is array:
+        return image
+    result = sitk.GetImageFromArray(compact)
+    result.CopyInformation(image)
+    return result
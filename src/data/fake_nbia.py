@@ -0,0 +1,183 @@
+import io
+import json
+import time
+import random
+import zipfile
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Servidor NBIA local de mentira para probar y medir download_tcga sin red.
+# Implementa los endpoints que usa HttpTransport:
+#   /getSeries?Collection=...&Modality=...   -> lista JSON de series
+#   /getImage?SeriesInstanceUID=...          -> ZIP con los .dcm (acepta Range)
+
+def make_series_catalog(num_series, images_per_series=50, image_size=512 * 1024,
+                        collection="TCGA-KIRC"):
+    """Genera metadatos sintéticos con el formato de nbia.getSeries."""
+    catalog = []
+    for i in range(num_series):
+        catalog.append({
+            "Collection": collection,
+            "PatientID": f"TCGA-FK-{i // 2:04d}",
+            "SeriesInstanceUID": f"1.2.826.0.1.3680043.9.{i}",
+            "Modality": "CT",
+            "SeriesDescription": "AXIAL",
+            "ImageCount": images_per_series,
+            "FileSize": images_per_series * image_size,
+        })
+    return catalog
+
+
+class FakeNbiaServer:
+    """Servidor HTTP en un hilo que imita la API REST de NBIA.
+
+    `latency` añade espera por petición, `fail_rate` hace fallar peticiones
+    al azar (503) y `truncate_rate` corta respuestas a la mitad, para
+    ejercitar reintentos y reanudación. El contenido de cada serie es
+    determinista, así una descarga reanudada produce el mismo ZIP.
+    """
+
+    def __init__(self, series=None, latency=0.0, fail_rate=0.0, truncate_rate=0.0,
+                 image_size=512 * 1024, seed=0):
+        self.series = series if series is not None else make_series_catalog(10, image_size=image_size)
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.truncate_rate = truncate_rate
+        self.image_size = image_size
+        self.random = random.Random(seed)
+        self.requests = 0
+        self._zips = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def series_zip(self, series_uid):
+        """ZIP (sin comprimir) con archivos .dcm sintéticos de la serie."""
+        with self._lock:
+            if series_uid not in self._zips:
+                info = next(s for s in self.series if s["SeriesInstanceUID"] == series_uid)
+                content = random.Random(series_uid)
+                buffer = io.BytesIO()
+                with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+                    for n in range(info.get("ImageCount", 1)):
+                        archive.writestr(f"1-{n + 1:03d}.dcm", content.randbytes(self.image_size))
+                self._zips[series_uid] = buffer.getvalue()
+            return self._zips[series_uid]
+
+    def _roll(self, rate):
+        with self._lock:
+            self.requests += 1
+            return rate and self.random.random() < rate
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                parsed = urllib.parse.urlparse(self.path)
+                params = {k: v[0] for k, v in urllib.parse.parse_qs(parsed.query).items()}
+                endpoint = parsed.path.rstrip("/").rsplit("/", 1)[-1]
+                if server.latency:
+                    time.sleep(server.latency)
+                if server._roll(server.fail_rate):
+                    self.send_error(503, "Fallo simulado")
+                    return
+                if endpoint == "getSeries":
+                    self._send_series(params)
+                elif endpoint == "getImage":
+                    self._send_image(params)
+                else:
+                    self.send_error(404)
+
+            def _send_series(self, params):
+                body = json.dumps([
+                    s for s in server.series
+                    if s.get("Collection") == params.get("Collection", s.get("Collection"))
+                    and s.get("Modality") == params.get("Modality", s.get("Modality"))
+                ]).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_image(self, params):
+                uid = params.get("SeriesInstanceUID")
+                if not any(s["SeriesInstanceUID"] == uid for s in server.series):
+                    self.send_error(404, "Serie desconocida")
+                    return
+                payload = server.series_zip(uid)
+                start = 0
+                range_header = self.headers.get("Range")
+                if range_header and range_header.startswith("bytes="):
+                    start = int(range_header[len("bytes="):].split("-")[0] or 0)
+                    if start >= len(payload):
+                        self.send_error(416)
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{len(payload) - 1}/{len(payload)}")
+                else:
+                    self.send_response(200)
+                body = payload[start:]
+                self.send_header("Content-Type", "application/zip")
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if server._roll(server.truncate_rate):
+                    # Cortamos la conexión a mitad de respuesta
+                    self.wfile.write(body[:len(body) // 2])
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    # Benchmark offline: misma colección sintética con distinto número de hilos
+    import tempfile
+    from pathlib import Path
+    from .download_tcga import AdaptiveConcurrency, HttpTransport, download_series
+
+    catalog = make_series_catalog(16, images_per_series=40, image_size=256 * 1024)
+    with FakeNbiaServer(catalog, latency=0.2, fail_rate=0.05, truncate_rate=0.05) as server:
+        transport = HttpTransport(server.url)
+        uids = [s["SeriesInstanceUID"] for s in transport.get_series("TCGA-KIRC", "CT")]
+        # Fijos y, al final, adaptativo desde 1 hilo (ventanas cortas: el benchmark dura poco)
+        runs = [(f"{w} hilos", AdaptiveConcurrency(w, enabled=False)) for w in (1, 4, 8)]
+        runs.append(("adaptativo", AdaptiveConcurrency(1, interval=1.0)))
+        for name, concurrency in runs:
+            with tempfile.TemporaryDirectory() as tmp:
+                summary = download_series(uids, Path(tmp), transport, failed_log=None,
+                                          concurrency=concurrency)
+                print(f"🧪 {name}: {len(summary['downloaded'])} series, "
+                      f"{summary['bytes'] / 1e6 / summary['seconds']:.1f} MB/s, "
+                      f"{len(summary['failed'])} fallidas, {summary['workers']} hilos al final")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import os
+import errno
+import shutil
+import hashlib
+from pathlib import Path
+from .checksum_manifest import sha256_file
+
+# --- CONFIGURACIÓN ---
+# Estrategias de colocación, de la más barata a la más cara
+RENAME = "rename"       # mover dentro del mismo sistema de archivos (el origen desaparece)
+HARDLINK = "hardlink"   # mismo inodo con dos nombres (0 bytes nuevos)
+REFLINK = "reflink"     # copia copy-on-write (btrfs, XFS, APFS...; 0 bytes nuevos)
+COPY = "copy"           # copia real, último recurso
+VERIFIED_COPY = "verified_copy"  # copia con SHA-256 al vuelo y relectura del destino
+
+# Conservar el origen (kits_organizer) o moverlo (stream_reorganizer_kits).
+# Al mover, el origen se borra después: la copia tiene que estar verificada.
+LINK_STRATEGIES = (HARDLINK, REFLINK, COPY)
+MOVE_STRATEGIES = (RENAME, REFLINK, VERIFIED_COPY)
+# Buffer de copia grande: en NFS/discos de red los bloques pequeños desperdician el enlace
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+# ---------------------
+
+# ioctl FICLONE de Linux (_IOW(0x94, 9, int))
+_FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    import fcntl  # solo existe en sistemas POSIX
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.unlink(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def _drop_cache(fd):
+    """Saca el archivo de la caché de páginas para que la relectura venga del disco."""
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+class ChecksumMismatch(OSError):
+    """La copia releída no coincide con lo que se leyó del origen."""
+
+
+def copy_stream(src, dst, chunk_size=COPY_CHUNK_SIZE, progress=None, digest=None, sync=False):
+    """Copia `src` a `dst` con un único buffer grande reutilizado.
+
+    `progress(n)` se llama con los bytes de cada bloque y `digest` (un
+    objeto de hashlib) se actualiza al vuelo, así el origen se lee una vez.
+    """
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(src, "rb", buffering=0) as fsrc, open(dst, "wb", buffering=0) as fdst:
+        while True:
+            n = fsrc.readinto(buffer)
+            if not n:
+                break
+            if digest is not None:
+                digest.update(view[:n])
+            written = 0
+            while written < n:
+                written += fdst.write(view[written:n])
+            if progress:
+                progress(n)
+        if sync:
+            os.fsync(fdst.fileno())
+            _drop_cache(fdst.fileno())
+    shutil.copystat(src, dst)
+
+
+def copy_verified(src, dst, chunk_size=COPY_CHUNK_SIZE, progress=None):
+    """Copia `src` a `dst` leyendo el origen una sola vez y calculando su SHA-256.
+
+    Al terminar se hace fsync, se descarta el destino de la caché y se
+    vuelve a leer desde disco: si el SHA-256 no coincide (copia truncada,
+    error de escritura) se lanza ChecksumMismatch. Devuelve el SHA-256.
+    """
+    digest = hashlib.sha256()
+    copy_stream(src, dst, chunk_size, progress, digest, sync=True)
+    expected = digest.hexdigest()
+    actual = sha256_file(dst, chunk_size)
+    if actual != expected:
+        raise ChecksumMismatch(f"SHA-256 de {dst} ({actual}) distinto al del origen ({expected})")
+    return expected
+
+
+def _place(strategy, src, tmp, progress=None):
+    """Coloca `src` en `tmp`; devuelve el SHA-256 si la estrategia lo calcula."""
+    if strategy == HARDLINK:
+        os.link(src, tmp)
+    elif strategy == REFLINK:
+        _reflink(src, tmp)
+    elif strategy == COPY:
+        copy_stream(src, tmp, progress=progress)
+    elif strategy == VERIFIED_COPY:
+        return copy_verified(src, tmp, progress=progress)
+    else:
+        raise ValueError(f"Estrategia desconocida: {strategy}")
+    return None
+
+
+def place_file(src, dst, strategies=LINK_STRATEGIES, progress=None):
+    """Coloca `src` en `dst` con la primera estrategia que funcione.
+
+    Se prueban en orden; si una no es posible (otro disco, sistema de
+    archivos sin reflink, límite de enlaces...) se pasa a la siguiente.
+    Salvo `rename`, todo se hace sobre un temporal en la carpeta destino que
+    se renombra al final, así nunca queda un archivo a medias con el nombre
+    definitivo. Un disco lleno (ENOSPC) o una copia que no verifica no se
+    tratan como "probar otra": se propagan para que el llamador se detenga.
+    Devuelve (estrategia usada, SHA-256 o None si la estrategia no lo calcula).
+    `progress(n)` recibe los bytes copiados (de golpe si no hubo copia).
+
+    Ojo con `hardlink`: origen y destino son el mismo archivo, modificar uno
+    modifica el otro (para datasets de solo lectura no es un problema).
+    """
+    src, dst = Path(src), Path(dst)
+    tmp = dst.with_name(f".{dst.name}.tmp")
+    size = src.stat().st_size if progress else 0
+    last_error = None
+    for strategy in strategies:
+        try:
+            if strategy == RENAME:
+                os.replace(src, dst)
+                digest = None
+            else:
+                tmp.unlink(missing_ok=True)
+                digest = _place(strategy, src, tmp, progress)
+                os.replace(tmp, dst)
+            if progress and strategy not in (COPY, VERIFIED_COPY):
+                progress(size)
+            return strategy, digest
+        except OSError as e:
+            tmp.unlink(missing_ok=True)
+            if e.errno == errno.ENOSPC or isinstance(e, ChecksumMismatch):
+                raise
+            last_error = e
+    raise last_error or OSError(f"No se pudo colocar {src} en {dst}")
+
+
+def move_file(src, dst, strategies=MOVE_STRATEGIES, progress=None):
+    """Mueve `src` a `dst`: renombra si se puede; si no, coloca una copia y borra el origen.
+
+    El origen solo se borra si la colocación quedó verificada: la copia
+    verificada ya comparó el SHA-256 releído del disco; cualquier otra
+    estrategia sin SHA-256 se comprueba al menos por tamaño.
+    Devuelve (estrategia, SHA-256 o None), como place_file.
+    """
+    src, dst = Path(src), Path(dst)
+    size = src.stat().st_size
+    strategy, digest = place_file(src, dst, strategies, progress)
+    if strategy != RENAME:
+        if digest is None and dst.stat().st_size != size:
+            raise OSError(f"Tamaño distinto tras colocar {dst} ({strategy}); no se borra el origen")
+        os.remove(src)
+    return strategy, digest
+
+
+def format_placement_stats(stats):
+    """Resumen legible de un Counter {estrategia: nº de archivos}."""
+    return ", ".join(f"{n} por {s}" for s, n in stats.most_common()) or "ningún archivo"
@@ -0,0 +1,278 @@
+import os
+import time
+import queue
+import threading
+from pathlib import Path
+from . import kits_organizer, reconstruct_kits_from_png, convert_dicom_to_nifti
+from .kits_organizer import find_case_files, case_destinations, organize_case
+from .reconstruct_kits_from_png import reconstruct_case
+from .convert_dicom_to_nifti import convert_dicom_series
+from .dicom_catalog import CATALOG_PATH, open_catalog, rescan, query_series
+from .dataset_json import update_dataset_json
+from .dataset_fingerprint import fingerprint_dataset
+from .pipeline_metrics import start_run, finish_run
+
+# --- CONFIGURACIÓN ---
+# Carpetas vigiladas y la rutina que procesa lo que aparece en cada una
+# (las mismas rutas que usan los comandos kits-organize, kits-png y convert)
+KITS_DIRS = [kits_organizer.RAW_KITS_DIR, reconstruct_kits_from_png.RAW_KITS_DIR]
+DICOM_DIR = convert_dicom_to_nifti.RAW_DICOM_DIR
+KITS_DATASET_DIR = kits_organizer.NNUNET_RAW_DIR
+TCGA_IMAGES_DIR = convert_dicom_to_nifti.OUTPUT_NIFTI_DIR
+# Segundos entre pasadas
+POLL_INTERVAL = 30
+# Una carpeta sin cambios (mtime) en este tiempo se da por terminada de copiar/descargar
+SETTLE_SECONDS = 60
+# Hilos que vacían la cola de trabajo (la conversión y la compresión liberan el GIL)
+NUM_INGEST_WORKERS = 2
+# Niveles de carpetas que se bajan buscando case_* (dataset/, kits23/dataset/...)
+MAX_DEPTH = 3
+# La huella muestrea cada caso como si el dataset tuviera al menos estos casos (con menos
+# casos cada uno guardaría muchísimas muestras); build_fingerprint ajusta al final
+MIN_PLANNED_CASES = 100
+# ---------------------
+
+ORGANIZE = "organize"
+RECONSTRUCT = "reconstruct"
+CONVERT = "convert"
+
+
+def find_case_dirs(root, max_depth=MAX_DEPTH):
+    """Carpetas case_* bajo `root` sin entrar en ellas (ni en carpetas ocultas)."""
+    stack = [(Path(root), 0)]
+    while stack:
+        current, depth = stack.pop()
+        try:
+            entries = list(os.scandir(current))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False) or entry.name.startswith("."):
+                continue
+            if entry.name.startswith("case_"):
+                yield Path(entry.path)
+            elif depth + 1 < max_depth:
+                stack.append((Path(entry.path), depth + 1))
+
+
+def newest_mtime_ns(case_dir):
+    """Último cambio en la carpeta del caso: ella misma, sus archivos y sus subcarpetas.
+
+    Las subcarpetas de PNG cambian de mtime al crearse cada corte, así que no
+    hace falta listarlas; los .nii.gz que se están copiando cambian el suyo.
+    """
+    newest = os.stat(case_dir).st_mtime_ns
+    with os.scandir(case_dir) as it:
+        for entry in it:
+            newest = max(newest, entry.stat(follow_symlinks=False).st_mtime_ns)
+    return newest
+
+
+def case_task(case_dir, imagesTr_dir, labelsTr_dir):
+    """Rutina para un caso KiTS: reconstruir desde PNG u organizar NIfTI (None si está incompleto o hecho)."""
+    dst_image, dst_label = case_destinations(case_dir.name, imagesTr_dir, labelsTr_dir)
+    if (case_dir / "JPEGImages").is_dir() and (case_dir / "Annotations").is_dir():
+        return None if dst_image.exists() else RECONSTRUCT
+    if find_case_files(case_dir):
+        return None if dst_image.exists() and dst_label.exists() else ORGANIZE
+    return None
+
+
+def count_images(images_dir):
+    try:
+        with os.scandir(images_dir) as it:
+            return sum(1 for entry in it if entry.name.endswith("_0000.nii.gz"))
+    except FileNotFoundError:
+        return 0
+
+
+class IngestDaemon:
+    """Vigila las carpetas crudas y manda lo nuevo a la rutina que le toca por una cola.
+
+    Cada pasada solo hace `stat` de las carpetas de casos (y el catálogo DICOM
+    solo relista carpetas cuyo mtime cambió). Un caso o serie entra en la cola
+    cuando lleva SETTLE_SECONDS sin cambios y su salida no existe; lo que
+    falla no se reintenta hasta que su carpeta vuelve a cambiar. Cuando la
+    cola se vacía se actualizan dataset.json y la huella de los datasets que
+    recibieron casos, así lo nuevo queda listo para entrenar.
+    """
+
+    def __init__(self, num_workers=NUM_INGEST_WORKERS, settle_seconds=SETTLE_SECONDS):
+        self.settle_ns = int(settle_seconds * 1e9)
+        self.work = queue.Queue()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.handled = {}   # origen -> mtime con el que se procesó (o falló)
+        self.queued = set()
+        self.outputs = set()  # salidas de lo que está en cola o en curso
+        self.dirty = set()  # datasets con casos nuevos desde la última actualización
+        self.stats = {"ok": 0, "failed": 0}
+        self.workers = [threading.Thread(target=self._worker, daemon=True) for _ in range(num_workers)]
+        for t in self.workers:
+            t.start()
+
+    def _settled(self, source, mtime_ns):
+        if source in self.queued or self.handled.get(source) == mtime_ns:
+            return False
+        return time.time_ns() - mtime_ns >= self.settle_ns
+
+    def _submit(self, kind, source, mtime_ns, dataset_dir, **extra):
+        self.queued.add(source)
+        self.work.put(dict(kind=kind, source=source, mtime_ns=mtime_ns, dataset_dir=dataset_dir, **extra))
+
+    def scan_kits(self):
+        imagesTr_dir, labelsTr_dir = KITS_DATASET_DIR / "imagesTr", KITS_DATASET_DIR / "labelsTr"
+        # Recorrido y stat sin el candado: los hilos que terminan no esperan a la pasada
+        candidates = []
+        for root in KITS_DIRS:
+            for case_dir in find_case_dirs(root):
+                try:
+                    mtime_ns = newest_mtime_ns(case_dir)
+                except FileNotFoundError:
+                    continue
+                output_path, _ = case_destinations(case_dir.name, imagesTr_dir, labelsTr_dir)
+                candidates.append((case_dir, mtime_ns, output_path,
+                                   case_task(case_dir, imagesTr_dir, labelsTr_dir)))
+        found = 0
+        with self.lock:
+            for case_dir, mtime_ns, output_path, kind in candidates:
+                if not self._settled(case_dir, mtime_ns):
+                    continue
+                if output_path in self.outputs:
+                    # El mismo caso en PNG y en NIfTI: uno a la vez
+                    continue
+                if kind is None:
+                    # Hecho (o incompleto): no se vuelve a mirar hasta que cambie
+                    self.handled[case_dir] = mtime_ns
+                    continue
+                self.outputs.add(output_path)
+                self._submit(kind, case_dir, mtime_ns, KITS_DATASET_DIR, output_path=output_path)
+                found += 1
+        return found
+
+    def scan_dicom(self):
+        if not DICOM_DIR.exists():
+            return 0
+        # El catálogo relista sin el candado; solo el reparto de trabajo lo toma
+        conn = open_catalog(CATALOG_PATH)
+        rescan(conn, DICOM_DIR)
+        catalog_series = query_series(conn, DICOM_DIR)
+        conn.close()
+        candidates = []
+        for entry in catalog_series:
+            series_dir = entry["series_dir"]
+            mtime_ns = max(entry["files_mtime_ns"] or 0, entry["dir_mtime_ns"] or 0)
+            # Mismo nombre de salida que el comando convert
+            patient_id = entry["patient_id"] or series_dir.parent.parent.name
+            output_path = TCGA_IMAGES_DIR / f"{patient_id}_0000.nii.gz"
+            candidates.append((series_dir, mtime_ns, output_path, output_path.exists()))
+        found = 0
+        with self.lock:
+            for series_dir, mtime_ns, output_path, done in candidates:
+                if not self._settled(series_dir, mtime_ns):
+                    continue
+                if output_path in self.outputs:
+                    # Otra serie del paciente va antes; si falla, esta se prueba en otra pasada
+                    continue
+                if done:
+                    self.handled[series_dir] = mtime_ns
+                    continue
+                self.outputs.add(output_path)
+                self._submit(CONVERT, series_dir, mtime_ns, TCGA_IMAGES_DIR.parent, output_path=output_path)
+                found += 1
+        return found
+
+    def _planned_cases(self, dataset_dir):
+        return max(MIN_PLANNED_CASES, count_images(dataset_dir / "imagesTr") + self.work.qsize() + 1)
+
+    def run_task(self, task):
+        kind, source, dataset_dir = task["kind"], task["source"], task["dataset_dir"]
+        imagesTr_dir, labelsTr_dir = dataset_dir / "imagesTr", dataset_dir / "labelsTr"
+        imagesTr_dir.mkdir(parents=True, exist_ok=True)
+        if kind == ORGANIZE:
+            labelsTr_dir.mkdir(parents=True, exist_ok=True)
+            organize_case(source, imagesTr_dir, labelsTr_dir)
+            return all(dst.exists() for dst in case_destinations(source.name, imagesTr_dir, labelsTr_dir))
+        if kind == RECONSTRUCT:
+            labelsTr_dir.mkdir(parents=True, exist_ok=True)
+            return reconstruct_case(source, imagesTr_dir, labelsTr_dir,
+                                    num_cases=self._planned_cases(dataset_dir))
+        return convert_dicom_series(source, task["output_path"], self._planned_cases(dataset_dir))
+
+    def _worker(self):
+        while True:
+            task = self.work.get()
+            try:
+                if self.stopping.is_set():
+                    continue
+                try:
+                    ok = self.run_task(task)
+                    error = None if ok else "la rutina no generó salida"
+                except Exception as e:
+                    ok, error = False, e
+                with self.lock:
+                    self.handled[task["source"]] = task["mtime_ns"]
+                    self.queued.discard(task["source"])
+                    self.outputs.discard(task["output_path"])
+                    self.stats["ok" if ok else "failed"] += 1
+                    if ok:
+                        self.dirty.add(task["dataset_dir"])
+                # Una sola escritura por línea: los hilos no mezclan sus mensajes
+                print(f"{'✅' if ok else '❌'} {task['kind']}: {task['source'].name}"
+                      + (f" ({error})" if error else "") + "\n", end="", flush=True)
+            finally:
+                self.work.task_done()
+
+    def publish(self):
+        """Con la cola vacía: dataset.json y huella de los datasets que recibieron casos."""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+        for dataset_dir in sorted(dirty):
+            try:
+                if dataset_dir == KITS_DATASET_DIR:
+                    update_dataset_json(dataset_dir)
+                fingerprint_dataset(dataset_dir)
+            except Exception as e:
+                # Un volumen ilegible no debe tumbar al vigilante; se reintenta cuando llegue otro caso
+                print(f"❌ No se pudo actualizar {dataset_dir.name}: {e}")
+
+    def poll(self):
+        """Una pasada: busca lo nuevo y lo encola. Devuelve cuántos trabajos encoló."""
+        return self.scan_kits() + self.scan_dicom()
+
+    def idle(self):
+        return self.work.unfinished_tasks == 0
+
+    def stop(self):
+        """Descarta lo encolado (se vuelve a encontrar al arrancar) y espera lo que está en curso."""
+        self.stopping.set()
+        self.work.join()
+
+
+def main(once=False, interval=POLL_INTERVAL):
+    start_run()
+    daemon = IngestDaemon()
+    watched = ", ".join(str(p) for p in [*KITS_DIRS, DICOM_DIR])
+    print(f"👀 Vigilando {watched} cada {interval}s (Ctrl+C para salir).")
+    try:
+        while True:
+            found = daemon.poll()
+            if found:
+                print(f"📥 {found} casos/series nuevos en la cola.")
+            if once:
+                daemon.work.join()
+            if daemon.idle():
+                daemon.publish()
+            if once:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("\n⏹️ Deteniendo: se termina lo que está en curso...")
+        daemon.stop()
+        daemon.publish()
+    print(f"✨ Ingesta: {daemon.stats['ok']} procesados, {daemon.stats['failed']} fallidos.")
+    finish_run()
+
+
+if __name__ == "__main__":
+    main()
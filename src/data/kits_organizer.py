@@ -1,8 +1,9 @@
-import os
-import shutil
-import json
+from collections import Counter
 from pathlib import Path
-from tqdm import tqdm
+from .file_placement import LINK_STRATEGIES, place_file, format_placement_stats
+from .copy_engine import COPY_WORKERS, run_transfers
+from .dataset_json import create_dataset_json
+from .pipeline_metrics import stage, file_bytes, start_run, finish_run
 
 # --- CONFIGURACIÓN ---
 # Ajusta la ruta a donde tengas DESCOMPRIMIDO tu dataset KiTS23
@@ -11,40 +12,61 @@ RAW_KITS_DIR = Path("scripts/kits23/dataset")
 
 # Ruta de destino para nnU-Net (Dataset101_KiTS23)
 NNUNET_RAW_DIR = Path("data/raw/nnUNet_raw/Dataset101_KiTS23")
+
+# Cómo colocar cada archivo sin tocar el origen: hardlink -> reflink -> copia
+# (la deduplicación entre carpetas se hace aparte, con `python -m src.data dedup`)
+PLACEMENT_STRATEGIES = LINK_STRATEGIES
+# Casos transfiriéndose a la vez cuando hay que copiar entre discos
+NUM_COPY_WORKERS = COPY_WORKERS
 # ---------------------
 
-def create_dataset_json(output_dir, num_training_cases):
-    """
-    Crea el archivo dataset.json requerido por nnU-Net.
-    """
-    json_dict = {
-        "channel_names": {
-            "0": "CT"
-        },
-        "labels": {
-            "background": 0,
-            "kidney": 1,
-            "tumor": 2,
-            "cyst": 3
-        },
-        "numTraining": num_training_cases,
-        "file_ending": ".nii.gz",
-        "name": "KiTS23",
-        "reference": "KiTS23 Challenge",
-        "release": "1.0",
-        "description": "Kidney Tumor Segmentation Challenge 2023",
-        "tensorImageSize": "3D", 
-        "modality": { 
-            "0": "CT" 
-        } 
-    }
-    
-    json_path = output_dir / "dataset.json"
-    with open(json_path, 'w') as f:
-        json.dump(json_dict, f, indent=4)
-    print(f"✅ Archivo dataset.json creado en: {json_path}")
+def find_case_files(case_dir):
+    """(imagen, etiqueta) de un caso, o None si falta alguna de las dos."""
+    # Archivos origen esperados
+    src_image = case_dir / "imaging.nii.gz"
+    src_label = case_dir / "segmentation.nii.gz"
+
+    # Verificar existencia
+    if not src_image.exists():
+        # A veces los archivos se llaman diferente, probamos variantes
+        candidates = list(case_dir.glob("imaging*.nii*"))
+        if not candidates:
+            return None # Saltamos si no hay imagen
+        src_image = candidates[0]
+
+    if not src_label.exists():
+        # Si no hay label, lo saltamos (podría ser un caso de test sin label pública)
+        return None
+    return src_image, src_label
+
+def case_destinations(case_id, imagesTr_dir, labelsTr_dir):
+    """Nombres destino (Formato nnU-Net)."""
+    # Imagen: case_00000_0000.nii.gz (IMPORTANTE: el _0000 al final)
+    # Label: case_00000.nii.gz
+    return imagesTr_dir / f"{case_id}_0000.nii.gz", labelsTr_dir / f"{case_id}.nii.gz"
+
+def organize_case(case_dir, imagesTr_dir, labelsTr_dir, progress=None):
+    """Coloca imagen y etiqueta de un caso. Devuelve las estrategias usadas."""
+    src_image, src_label = find_case_files(case_dir)
+    dst_image_path, dst_label_path = case_destinations(case_dir.name, imagesTr_dir, labelsTr_dir)
+    strategies = []
+    with stage("organize", key=case_dir.name) as m:
+        # Enlace si es el mismo disco, copia solo como último recurso
+        for src, dst in ((src_image, dst_image_path), (src_label, dst_label_path)):
+            if not dst.exists():
+                strategies.append(place_file(src, dst, PLACEMENT_STRATEGIES, progress)[0])
+                m["bytes_in"] += file_bytes([src])
+        m["bytes_out"] = m["bytes_in"]
+    return strategies
+
+def pending_bytes(case_dir, imagesTr_dir, labelsTr_dir):
+    """Bytes que faltan por colocar de un caso (los destinos ya existentes no cuentan)."""
+    sources = find_case_files(case_dir)
+    destinations = case_destinations(case_dir.name, imagesTr_dir, labelsTr_dir)
+    return sum(src.stat().st_size for src, dst in zip(sources, destinations) if not dst.exists())
 
 def main():
+    start_run()
     # 1. Verificar directorios
     if not RAW_KITS_DIR.exists():
         print(f"❌ Error: No se encuentra el directorio de origen: {RAW_KITS_DIR}")
@@ -75,51 +97,30 @@ def main():
         
     print(f"✅ Se encontraron {len(case_folders)} casos potenciales.")
     
+    # Casos con imagen y etiqueta
+    case_folders = [c for c in case_folders if find_case_files(c)]
+    sizes = [pending_bytes(c, imagesTr_dir, labelsTr_dir) for c in case_folders]
+
+    # 4. Procesar y colocar archivos (varios casos a la vez; progreso en MB/s)
+    results = run_transfers(
+        case_folders,
+        lambda case_dir, progress: organize_case(case_dir, imagesTr_dir, labelsTr_dir, progress),
+        sizes, NUM_COPY_WORKERS, desc="Colocando casos")
+
     processed_count = 0
-    
-    # 4. Procesar y copiar archivos
-    for case_dir in tqdm(case_folders, desc="Procesando casos"):
-        case_id = case_dir.name # "case_00000"
-        
-        # Archivos origen esperados
-        src_image = case_dir / "imaging.nii.gz"
-        src_label = case_dir / "segmentation.nii.gz"
-        
-        # Verificar existencia
-        if not src_image.exists():
-            # A veces los archivos se llaman diferente, probamos variantes
-            candidates = list(case_dir.glob("imaging*.nii*"))
-            if candidates:
-                src_image = candidates[0]
-            else:
-                continue # Saltamos si no hay imagen
-                
-        if not src_label.exists():
-            # Si no hay label, lo saltamos (podría ser un caso de test sin label pública)
+    placements = Counter()
+    for case_dir, (strategies, error) in zip(case_folders, results):
+        if error:
+            print(f"Error copiando caso {case_dir.name}: {error}")
             continue
-
-        # Nombres destino (Formato nnU-Net)
-        # Imagen: case_00000_0000.nii.gz (IMPORTANTE: el _0000 al final)
-        dst_image_name = f"{case_id}_0000.nii.gz"
-        # Label: case_00000.nii.gz
-        dst_label_name = f"{case_id}.nii.gz"
-        
-        dst_image_path = imagesTr_dir / dst_image_name
-        dst_label_path = labelsTr_dir / dst_label_name
-        
-        # Copiar archivos
-        try:
-            # Usamos copy2 para preservar metadatos
-            if not dst_image_path.exists():
-                shutil.copy2(src_image, dst_image_path)
-            if not dst_label_path.exists():
-                shutil.copy2(src_label, dst_label_path)
-            processed_count += 1
-        except Exception as e:
-            print(f"Error copiando caso {case_id}: {e}")
+        placements.update(strategies)
+        processed_count += 1
 
     print(f"\n✅ Procesamiento completado. {processed_count} casos organizados correctamente en {NNUNET_RAW_DIR}.")
-    
+    print(f"🔗 Archivos colocados: {format_placement_stats(placements)}.")
+    finish_run()
+    print("🧬 Huella de nnU-Net (dataset_fingerprint.json): python -m src.data fingerprint")
+
     # 5. Generar dataset.json
     if processed_count > 0:
         create_dataset_json(NNUNET_RAW_DIR, processed_count)
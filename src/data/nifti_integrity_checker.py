@@ -1,38 +1,238 @@
-import nibabel as nib
+import os
+import io
+import gzip
+import json
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from tqdm import tqdm
 import numpy as np
+from .checksum_manifest import load_manifest, sha256_file
 
-TARGET_DIR = Path("data/raw/nnUNet_raw/Dataset101_KiTS23/imagesTr")
+DATASET_DIR = Path("data/raw/nnUNet_raw/Dataset101_KiTS23")
+TARGET_DIR = DATASET_DIR / "imagesTr"
+# Caché de resultados por (ruta, tamaño, mtime) dentro del propio dataset
+CACHE_NAME = ".integrity_cache.sqlite"
+NUM_WORKERS = os.cpu_count() or 1
+# Modo profundo: descomprime todo el volumen (gzip truncado, NaN/Inf, dtype, etiquetas)
+# y compara el SHA-256 con checksums.sha256 del dataset si el archivo aparece ahí
+DEEP_CHECK = False
+CHUNK_SIZE = 16 * 1024 * 1024
 
-def check_files():
-    files = list(TARGET_DIR.glob("*.nii.gz"))
-    print(f"Verificando {len(files)} archivos en {TARGET_DIR}...")
-    
+# Tipos que nnU-Net puede leer sin sorpresas
+SUPPORTED_DTYPES = {"uint8", "int8", "uint16", "int16", "uint32", "int32", "int64", "float32", "float64"}
+
+_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    deep INTEGER,
+    issues TEXT,
+    labels TEXT
+);
+"""
+
+def find_nifti_files(dataset_dir):
+    """Todos los NIfTI del dataset (imagesTr, labelsTr, imagesTs...)."""
+    dataset_dir = Path(dataset_dir)
+    return sorted(f for f in dataset_dir.rglob("*.nii*") if f.name.endswith((".nii", ".nii.gz")))
+
+def is_label_file(path):
+    """Las etiquetas viven en carpetas labelsTr/labelsTs."""
+    return Path(path).parent.name.startswith("labels")
+
+def load_label_values(dataset_dir):
+    """Valores de etiqueta permitidos según dataset.json (None si no hay)."""
+    json_path = Path(dataset_dir) / "dataset.json"
+    if not json_path.exists():
+        return None
+    with open(json_path, 'r') as f:
+        labels = json.load(f).get("labels", {})
+    values = set()
+    for value in labels.values():
+        # nnU-Net v2 permite regiones: listas de valores por clase
+        values.update(value if isinstance(value, list) else [value])
+    return sorted(int(v) for v in values)
+
+def _open_stream(path):
+    return gzip.open(path, 'rb') if str(path).endswith(".gz") else open(path, 'rb')
+
+def _read_exact(stream, nbytes):
+    data = stream.read(nbytes)
+    if len(data) != nbytes:
+        raise EOFError("archivo truncado")
+    return data
+
+def read_stream_header(stream):
+    """Lee la cabecera NIfTI-1/2 del flujo y avanza hasta el inicio de los vóxeles."""
+    import nibabel as nib
+    raw = _read_exact(stream, 348)
+    sizeof_hdr_le = int.from_bytes(raw[:4], "little")
+    sizeof_hdr_be = int.from_bytes(raw[:4], "big")
+    if 540 in (sizeof_hdr_le, sizeof_hdr_be):
+        raw += _read_exact(stream, 540 - 348)
+        header = nib.Nifti2Header.from_fileobj(io.BytesIO(raw))
+    else:
+        header = nib.Nifti1Header.from_fileobj(io.BytesIO(raw))
+    vox_offset = int(header["vox_offset"])
+    if vox_offset > len(raw):
+        _read_exact(stream, vox_offset - len(raw))
+    return header
+
+def iter_nifti_chunks(path, chunk_size=CHUNK_SIZE):
+    """Recorre un NIfTI descomprimiendo en flujo, sin cargar el volumen entero.
+
+    Produce primero la cabecera y luego arrays 1D con los vóxeles (en el
+    orden del archivo). Lanza EOFError si el gzip o los datos están
+    truncados y gzip.BadGzipFile si el CRC no cuadra.
+    """
+    with _open_stream(path) as stream:
+        header = read_stream_header(stream)
+        yield header
+        dtype = header.get_data_dtype()
+        remaining = int(np.prod(header.get_data_shape(), dtype=np.int64)) * dtype.itemsize
+        chunk_size -= chunk_size % dtype.itemsize
+        while remaining:
+            data = _read_exact(stream, min(chunk_size, remaining))
+            remaining -= len(data)
+            yield np.frombuffer(data, dtype=dtype)
+        # Leemos hasta el final para que gzip valide el CRC de todos los miembros
+        while stream.read(chunk_size):
+            pass
+
+def check_header(path):
+    """Chequeos básicos de cabecera (los de siempre)."""
+    import nibabel as nib
+    issues = []
+    img = nib.load(path)
+    data_shape = img.header.get_data_shape()
+    if len(data_shape) != 3:
+        issues.append(f"Dimensiones incorrectas {data_shape}")
+    if np.any(np.array(data_shape) == 0):
+        issues.append("Dimensión cero detectada")
+    return issues
+
+def deep_check(path, label_values=None):
+    """Descomprime todo el volumen buscando truncados, NaN/Inf y etiquetas inválidas."""
     issues = []
-    
-    for f in tqdm(files):
-        try:
-            img = nib.load(f)
-            header = img.header
-            data_shape = header.get_data_shape()
-            
-            # Chequeos básicos
-            if len(data_shape) != 3:
-                issues.append(f"{f.name}: Dimensiones incorrectas {data_shape}")
-            
-            if np.any(np.array(data_shape) == 0):
-                issues.append(f"{f.name}: Dimensión cero detectada")
-                
-        except Exception as e:
-            issues.append(f"{f.name}: Error al leer - {e}")
-            
-    if issues:
+    is_label = is_label_file(path)
+    allowed = np.array(label_values) if label_values is not None else None
+    non_finite = 0
+    bad_values = set()
+
+    chunks = iter_nifti_chunks(path)
+    header = next(chunks)
+    dtype = header.get_data_dtype()
+    if dtype.name not in SUPPORTED_DTYPES:
+        issues.append(f"Tipo de dato no soportado: {dtype}")
+    if is_label:
+        if dtype.kind == "f":
+            issues.append(f"Etiquetas guardadas como {dtype} (se esperan enteros)")
+        slope, inter = header.get_slope_inter()
+        if slope not in (None, 1.0) or inter not in (None, 0.0):
+            issues.append(f"Etiquetas con escalado scl_slope={slope} scl_inter={inter}")
+
+    for chunk in chunks:
+        if dtype.kind == "f":
+            finite = np.isfinite(chunk)
+            if not finite.all():
+                non_finite += int(chunk.size - np.count_nonzero(finite))
+        if is_label and allowed is not None:
+            invalid = ~np.isin(chunk, allowed)
+            if invalid.any() and len(bad_values) < 10:
+                bad_values.update(np.unique(chunk[invalid])[:10].tolist())
+
+    if non_finite:
+        issues.append(f"{non_finite} vóxeles NaN/Inf")
+    if bad_values:
+        issues.append(f"Valores de etiqueta fuera de {label_values}: {sorted(bad_values)[:10]}")
+    return issues
+
+def check_file(path, deep=False, label_values=None, expected_sha256=None):
+    """Devuelve la lista de problemas de un archivo (vacía si está bien)."""
+    try:
+        issues = check_header(path)
+        if deep and expected_sha256 and sha256_file(path) != expected_sha256:
+            issues.append("SHA-256 distinto al registrado en el manifiesto")
+        if deep and not issues:
+            issues += deep_check(path, label_values)
+        return issues
+    except (EOFError, gzip.BadGzipFile) as e:
+        return [f"gzip truncado o corrupto - {e}"]
+    except Exception as e:
+        return [f"Error al leer - {e}"]
+
+def _check_job(job):
+    return check_file(*job)
+
+def _open_cache(dataset_dir):
+    conn = sqlite3.connect(str(Path(dataset_dir) / CACHE_NAME))
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(results)")}
+    if columns and "labels" not in columns:
+        # Caché de una versión sin etiquetas en la clave: se descarta entera
+        conn.execute("DROP TABLE results")
+    conn.executescript(_CACHE_SCHEMA)
+    return conn
+
+def check_dataset(dataset_dir=DATASET_DIR, deep=DEEP_CHECK, num_workers=NUM_WORKERS):
+    """Verifica en paralelo todos los NIfTI del dataset.
+
+    Los resultados se guardan en caché por (ruta, tamaño, mtime): en la
+    siguiente corrida solo se revisan los archivos nuevos o modificados (o
+    los que solo pasaron el chequeo de cabecera, si ahora se pide `deep`).
+    Las etiquetas se revisan de nuevo si cambian las de dataset.json.
+    Devuelve {ruta: [problemas]} solo con los archivos que tienen problemas.
+    """
+    dataset_dir = Path(dataset_dir)
+    files = find_nifti_files(dataset_dir)
+    label_values = load_label_values(dataset_dir)
+    manifest = load_manifest(dataset_dir) if deep else {}
+    conn = _open_cache(dataset_dir)
+    labels_key = json.dumps(label_values)
+    cached = {row[0]: row[1:] for row in conn.execute(
+        "SELECT path, size, mtime_ns, deep, issues, labels FROM results")}
+
+    results = {}
+    todo = []
+    for f in files:
+        st = f.stat()
+        key = str(f.relative_to(dataset_dir))
+        hit = cached.get(key)
+        if (hit and hit[0] == st.st_size and hit[1] == st.st_mtime_ns and hit[2] >= int(deep)
+                and (hit[4] == labels_key or not is_label_file(f))):
+            results[key] = json.loads(hit[3])
+        else:
+            todo.append((f, key, st))
+    print(f"Verificando {len(todo)} archivos en {dataset_dir} "
+          f"({len(files) - len(todo)} sin cambios desde la última vez)...")
+
+    jobs = [(f, deep, label_values, manifest.get(Path(key).as_posix())) for f, key, _ in todo]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        checked = tqdm(executor.map(_check_job, jobs, chunksize=4), total=len(jobs))
+        rows = []
+        for (f, key, st), issues in zip(todo, checked):
+            results[key] = issues
+            rows.append((key, st.st_size, st.st_mtime_ns, int(deep), json.dumps(issues), labels_key))
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)", rows)
+        # Archivos que ya no existen
+        conn.executemany("DELETE FROM results WHERE path = ?",
+                         ((k,) for k in cached if k not in results))
+    conn.close()
+    return {k: v for k, v in results.items() if v}
+
+def check_files(deep=DEEP_CHECK, dataset_dir=DATASET_DIR):
+    problems = check_dataset(dataset_dir, deep)
+
+    if problems:
         print("\n⚠️ SE ENCONTRARON PROBLEMAS:")
-        for i in issues:
-            print(i)
+        for name, issues in problems.items():
+            for i in issues:
+                print(f"{name}: {i}")
     else:
-        print("\n✅ Todos los archivos parecen válidos (encabezados legibles y 3D).")
+        detail = "datos completos, sin NaN/Inf y etiquetas válidas" if deep else "encabezados legibles y 3D"
+        print(f"\n✅ Todos los archivos parecen válidos ({detail}).")
 
 if __name__ == "__main__":
-    check_files()
\ No newline at end of file
+    check_files()
@@ -0,0 +1,194 @@
+import io
+import os
+import zlib
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# --- CONFIGURACIÓN ---
+# Tamaño de cada bloque comprimido de forma independiente
+BLOCK_SIZE = 4 * 1024 * 1024
+# Hilos de compresión por archivo (zlib libera el GIL al comprimir)
+NUM_THREADS = os.cpu_count() or 1
+# Nivel de gzip por defecto y por dataset (1 = rápido, 9 = más pequeño)
+DEFAULT_LEVEL = 6
+DATASET_COMPRESSION_LEVELS = {
+    "Dataset101_KiTS23": 1,   # lo que usaba nib.save
+    "Dataset102_TCGA": 6,     # lo que usaba sitk.WriteImage
+}
+# ---------------------
+
+def compression_level_for(output_path):
+    """Nivel de compresión según el dataset (carpeta DatasetXXX_*) al que va el archivo."""
+    for part in Path(output_path).parts:
+        if part in DATASET_COMPRESSION_LEVELS:
+            return DATASET_COMPRESSION_LEVELS[part]
+    return DEFAULT_LEVEL
+
+def _compress_block(data, level):
+    # wbits=31: cada bloque es un miembro gzip completo (cabecera, deflate y CRC)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """Archivo de solo escritura que comprime bloques fijos en un pool de hilos.
+
+    El resultado es un gzip multi-miembro estándar (RFC 1952 permite
+    concatenar miembros), legible por gzip, nibabel y SimpleITK/zlib. Se
+    escribe a un temporal y se renombra al cerrar, así nunca queda un
+    .nii.gz a medias con el nombre final. El SHA-256 del archivo comprimido
+    se calcula al escribirlo (`sha256`), sin releerlo.
+    """
+
+    def __init__(self, path, level=None, block_size=None, num_threads=None):
+        super().__init__()
+        self.path = Path(path)
+        self.level = compression_level_for(path) if level is None else level
+        self.block_size = block_size or BLOCK_SIZE
+        num_threads = num_threads or NUM_THREADS
+        self.tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        self.raw = open(self.tmp_path, "wb")
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        # Bloques en vuelo acotados para no acumular el volumen entero en RAM
+        self.max_pending = 2 * num_threads
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.position = 0
+        self.bytes_out = 0
+        self.digest = hashlib.sha256()
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # Solo se admite "saltar" a la posición actual (nibabel lo hace al escribir)
+        target = offset if whence == io.SEEK_SET else self.position + offset
+        if whence not in (io.SEEK_SET, io.SEEK_CUR) or target != self.position:
+            raise io.UnsupportedOperation("ParallelGzipWriter solo escribe secuencialmente")
+        return self.position
+
+    def write(self, data):
+        view = memoryview(data).cast("B")
+        written = len(view)
+        self.position += written
+        if self.buffer:
+            # Completar primero el bloque a medias
+            take = min(self.block_size - len(self.buffer), len(view))
+            self.buffer += view[:take]
+            view = view[take:]
+            if len(self.buffer) == self.block_size:
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+        # Bloques enteros directamente desde los datos recibidos (una sola copia)
+        while len(view) >= self.block_size:
+            self._submit(view[:self.block_size].tobytes())
+            view = view[self.block_size:]
+        self.buffer += view
+        return written
+
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(_compress_block, block, self.level))
+        while len(self.pending) > self.max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        compressed = self.pending.popleft().result()
+        self.raw.write(compressed)
+        self.digest.update(compressed)
+        self.bytes_out += len(compressed)
+
+    @property
+    def sha256(self):
+        return self.digest.hexdigest()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer or self.position == 0:
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self._write_next()
+            self.raw.close()
+            os.replace(self.tmp_path, self.path)
+        except BaseException:
+            self.abort()
+            raise
+        finally:
+            self.executor.shutdown()
+            super().close()
+
+    def abort(self):
+        """Descarta lo escrito (se usa si falla la escritura) y deja el archivo cerrado."""
+        if self.closed:
+            return
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(cancel_futures=True)
+        self.raw.close()
+        self.tmp_path.unlink(missing_ok=True)
+        # Cerrado: un close() posterior (o el del recolector) ya no intenta renombrar
+        super().close()
+
+
+def save_nifti(img, output_path, level=None, num_threads=None):
+    """Equivalente a nib.save(img, "*.nii.gz") con compresión en paralelo.
+
+    Devuelve el SHA-256 del .nii.gz escrito (None si no se comprime).
+    """
+    output_path = Path(output_path)
+    if not output_path.name.endswith(".gz"):
+        img.to_filename(str(output_path))
+        return None
+    writer = ParallelGzipWriter(output_path, level, num_threads=num_threads)
+    try:
+        img.to_file_map(img.make_file_map({"image": writer}))
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return writer.sha256
+
+def sitk_affine(image):
+    """Matriz afín RAS de NIfTI a partir del spacing, origen y dirección (LPS) de ITK."""
+    import numpy as np
+    dim = image.GetDimension()
+    direction = np.array(image.GetDirection()).reshape(dim, dim)
+    affine = np.eye(4)
+    affine[:dim, :dim] = direction * np.array(image.GetSpacing())
+    affine[:dim, 3] = image.GetOrigin()
+    # ITK trabaja en LPS y NIfTI en RAS: se invierten las filas de x e y
+    affine[:2] *= -1
+    return affine
+
+def write_sitk_image(image, output_path, level=None, num_threads=None):
+    """Equivalente a sitk.WriteImage(image, "*.nii.gz") con compresión en paralelo.
+
+    Los vóxeles se leen del buffer de SimpleITK sin copiarlo (vista de NumPy)
+    y van directos al compresor con una cabecera NIfTI equivalente a la de
+    ITK (qform/sform de escáner en mm): no se escribe ningún .nii intermedio.
+    Las imágenes vectoriales o de más de 3 dimensiones las escribe ITK directamente.
+    Devuelve el SHA-256 del .nii.gz escrito (None si lo escribió ITK).
+    """
+    import SimpleITK as sitk
+    import nibabel as nib
+    output_path = Path(output_path)
+    if (not output_path.name.endswith(".gz")
+            or image.GetNumberOfComponentsPerPixel() != 1 or image.GetDimension() > 3):
+        # Sin comprimir, vectoriales o 4D+: los escribe ITK tal cual (cabecera con intent, etc.)
+        sitk.WriteImage(image, str(output_path), output_path.name.endswith(".gz"))
+        return None
+    # (z, y, x) en orden C: la traspuesta es (x, y, z) en orden Fortran, la de NIfTI, sin copiar
+    voxels = sitk.GetArrayViewFromImage(image).T
+    img = nib.Nifti1Image(voxels, sitk_affine(image))
+    img.header.set_xyzt_units("mm", "sec")
+    img.set_qform(img.affine, code=1)
+    img.set_sform(img.affine, code=1)
+    return save_nifti(img, output_path, level, num_threads)
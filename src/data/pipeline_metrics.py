@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+# --- CONFIGURACIÓN ---
+# Métricas por etapa (tiempo, bytes, pico de RAM) en JSON lines, una línea por etapa y serie/caso.
+# Se pueden cambiar con variables de entorno, que heredan también los procesos del pool.
+METRICS_PATH = Path(os.environ.get("AURA_METRICS_PATH", "data/metrics/pipeline_metrics.jsonl"))
+# Archivo para el textfile collector de node_exporter (None = no se genera)
+PROMETHEUS_PATH = os.environ.get("AURA_PROMETHEUS_PATH") or None
+# Registrar métricas ("0" las desactiva)
+METRICS_ENABLED = os.environ.get("AURA_METRICS", "1") != "0"
+# Al pasar de este tamaño el archivo se rota (.1, .2, ...) y se conservan METRICS_BACKUPS
+METRICS_MAX_BYTES = int(os.environ.get("AURA_METRICS_MAX_BYTES", 64 * 1024**2))
+METRICS_BACKUPS = 3
+# Etapa a perfilar con cProfile (p. ej. "nifti_write"); un .prof por ejecución
+PROFILE_STAGE = os.environ.get("AURA_PROFILE_STAGE") or None
+PROFILE_DIR = Path(os.environ.get("AURA_PROFILE_DIR", "data/metrics/profiles"))
+# ---------------------
+
+_local = threading.local()
+_write_lock = threading.Lock()
+# Etapas abiertas en todos los hilos del proceso (VmHWM es uno solo para todos)
+_active = []
+_active_lock = threading.Lock()
+
+
+def _read_hwm_bytes():
+    """Pico de RSS del proceso (VmHWM en Linux; ru_maxrss en otros sistemas)."""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    import sys
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _reset_hwm():
+    """Reinicia VmHWM (Linux >= 4.0). Sin esto el pico es el de toda la vida del proceso."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def start_run():
+    """Identificador de la corrida; los procesos hijos lo heredan por el entorno."""
+    if "AURA_RUN_ID" not in os.environ:
+        os.environ["AURA_RUN_ID"] = time.strftime("%Y%m%dT%H%M%S") + f"-{os.getpid()}"
+        # Solo el proceso que abre la corrida rota el archivo (los hijos solo añaden líneas)
+        os.environ["AURA_METRICS_OWNER"] = str(os.getpid())
+    return os.environ["AURA_RUN_ID"]
+
+
+def _rotate(path=METRICS_PATH, max_bytes=METRICS_MAX_BYTES, backups=METRICS_BACKUPS):
+    """metrics.jsonl -> .1 -> .2 ... si pasó de `max_bytes`; el más viejo se descarta."""
+    try:
+        if os.stat(path).st_size < max_bytes:
+            return
+    except FileNotFoundError:
+        return
+    for i in range(backups - 1, 0, -1):
+        older = path.with_name(f"{path.name}.{i}")
+        if older.exists():
+            os.replace(older, path.with_name(f"{path.name}.{i + 1}"))
+    if backups:
+        os.replace(path, path.with_name(f"{path.name}.1"))
+    else:
+        path.unlink()
+
+
+def file_bytes(paths):
+    """Suma de tamaños de `paths` (los que no existen cuentan 0)."""
+    total = 0
+    for path in paths:
+        try:
+            total += os.stat(path).st_size
+        except OSError:
+            pass
+    return total
+
+
+def _emit(record):
+    METRICS_PATH.parent.mkdir(parents=True, exist_ok=True)
+    line = (json.dumps(record) + "\n").encode()
+    # Una sola escritura con O_APPEND: las líneas de varios procesos no se mezclan
+    with _write_lock:
+        if os.environ.get("AURA_METRICS_OWNER") == str(os.getpid()):
+            _rotate()
+        fd = os.open(METRICS_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+
+@contextmanager
+def stage(name, key=None, bytes_in=0):
+    """Mide una etapa: `with stage("nifti_write", key=case_id) as m: ...; m["bytes_out"] = n`.
+
+    Registra tiempo de reloj, bytes de entrada/salida y pico de RSS de la
+    etapa. VmHWM es del proceso entero: solo se reinicia al empezar una
+    etapa si no hay otras abiertas en otros hilos (así no se borran el pico
+    entre ellas). Si hubo solapamiento, el pico registrado es el del proceso
+    y el registro lleva peak_rss_exact=false. Si la etapa lanza una
+    excepción se registra con ok=false y la excepción sigue su camino.
+    Con AURA_PROFILE_STAGE=<nombre> guarda además un perfil de cProfile.
+    """
+    metrics = {"bytes_in": bytes_in, "bytes_out": 0}
+    if not METRICS_ENABLED and PROFILE_STAGE != name:
+        yield metrics
+        return
+
+    frames = getattr(_local, "frames", None)
+    if frames is None:
+        frames = _local.frames = []
+    # Antes de reiniciar el pico, lo que llevamos cuenta para las etapas que nos contienen
+    hwm = _read_hwm_bytes()
+    for frame in frames:
+        frame["peak"] = max(frame["peak"], hwm)
+    frame = {"peak": 0, "thread": threading.get_ident()}
+    with _active_lock:
+        others = [f for f in _active if f["thread"] != frame["thread"]]
+        # Las etapas de otros hilos ya no miden solo lo suyo, y esta tampoco
+        for other in others:
+            other["exact"] = False
+        frame["exact"] = not others and _reset_hwm()
+        _active.append(frame)
+    frames.append(frame)
+
+    profiler = None
+    if PROFILE_STAGE == name:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield metrics
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        if profiler:
+            profiler.disable()
+            PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(str(PROFILE_DIR / f"{name}_{key or 'all'}_{os.getpid()}_{int(time.time())}.prof"))
+        frames.pop()
+        with _active_lock:
+            _active.remove(frame)
+        hwm = _read_hwm_bytes()
+        peak = max(frame["peak"], hwm)
+        for outer in frames:
+            outer["peak"] = max(outer["peak"], peak)
+        if METRICS_ENABLED:
+            _emit({
+                "run": os.environ.get("AURA_RUN_ID"),
+                "ts": time.time(),
+                "stage": name,
+                "key": None if key is None else str(key),
+                "pid": os.getpid(),
+                "seconds": round(seconds, 6),
+                "bytes_in": int(metrics["bytes_in"]),
+                "bytes_out": int(metrics["bytes_out"]),
+                # Sin clear_refs, o con etapas solapadas en otros hilos, es el pico del proceso
+                "peak_rss_bytes": peak,
+                "peak_rss_exact": frame["exact"],
+                "ok": error is None,
+                "error": error,
+            })
+
+
+def load_records(path=METRICS_PATH, run=None):
+    """Registros del archivo JSONL (solo los de `run` si se indica)."""
+    path = Path(path)
+    if not path.exists():
+        return []
+    records = []
+    # json.dumps siempre escribe el campo igual: se descartan las otras corridas sin parsearlas
+    needle = None if run is None else f'"run": {json.dumps(run)}'
+    with open(path, "r") as f:
+        for line in f:
+            if needle is not None and needle not in line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Línea a medias de un proceso que murió
+            if run is None or record.get("run") == run:
+                records.append(record)
+    return records
+
+
+def summarize(records):
+    """Totales por etapa: ejecuciones, fallos, segundos, bytes y pico de RSS."""
+    summary = {}
+    for r in records:
+        s = summary.setdefault(r["stage"], {"runs": 0, "failures": 0, "seconds": 0.0,
+                                            "bytes_in": 0, "bytes_out": 0, "peak_rss_bytes": 0,
+                                            "peak_rss_exact": True})
+        s["runs"] += 1
+        s["failures"] += 0 if r["ok"] else 1
+        s["seconds"] += r["seconds"]
+        s["bytes_in"] += r["bytes_in"]
+        s["bytes_out"] += r["bytes_out"]
+        s["peak_rss_bytes"] = max(s["peak_rss_bytes"], r["peak_rss_bytes"])
+        s["peak_rss_exact"] = s["peak_rss_exact"] and r.get("peak_rss_exact", False)
+    return summary
+
+
+def write_prometheus_textfile(summary, path):
+    """Escribe el resumen en formato de exposición de Prometheus (reemplazo atómico)."""
+    path = Path(path)
+    metrics = [
+        ("aura_stage_runs_total", "counter", "Ejecuciones de la etapa", "runs"),
+        ("aura_stage_failures_total", "counter", "Ejecuciones fallidas de la etapa", "failures"),
+        ("aura_stage_seconds_total", "counter", "Segundos de reloj en la etapa", "seconds"),
+        ("aura_stage_bytes_in_total", "counter", "Bytes leídos por la etapa", "bytes_in"),
+        ("aura_stage_bytes_out_total", "counter", "Bytes escritos por la etapa", "bytes_out"),
+        ("aura_stage_peak_rss_bytes", "gauge", "Pico de RSS observado en la etapa", "peak_rss_bytes"),
+    ]
+    lines = []
+    for metric, kind, help_text, field in metrics:
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for stage_name, values in sorted(summary.items()):
+            lines.append(f'{metric}{{stage="{stage_name}"}} {values[field]}')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+
+def print_summary(summary):
+    for stage_name, s in sorted(summary.items(), key=lambda kv: -kv[1]["seconds"]):
+        mb = max(s["bytes_in"], s["bytes_out"]) / 1e6
+        rate = f"{mb / s['seconds']:8.1f} MB/s" if s["seconds"] else " " * 13
+        print(f"  {stage_name:16s} {s['runs']:5d}× {s['seconds']:9.1f}s {rate}  "
+              f"pico {s['peak_rss_bytes'] / 1024**2:8.1f} MB"
+              + ("" if s["peak_rss_exact"] else " (del proceso)")
+              + (f"  ({s['failures']} fallos)" if s["failures"] else ""))
+
+
+def finish_run(prometheus_path=PROMETHEUS_PATH):
+    """Resume la corrida actual en pantalla y, si se configuró, en el textfile de Prometheus."""
+    if not METRICS_ENABLED:
+        return None
+    summary = summarize(load_records(METRICS_PATH, os.environ.get("AURA_RUN_ID")))
+    if summary:
+        print(f"\n📈 Tiempo por etapa (detalle en {METRICS_PATH}):")
+        print_summary(summary)
+        if prometheus_path:
+            write_prometheus_textfile(summary, prometheus_path)
+    return summary
@@ -0,0 +1,141 @@
+import time
+import sqlite3
+import threading
+from pathlib import Path
+
+# --- CONFIGURACIÓN ---
+# Diario transaccional del estado de cada serie (reemplaza processed_series.log)
+JOURNAL_PATH = Path("data/processing_journal.sqlite")
+# Transiciones acumuladas antes de hacer commit (o cada COMMIT_INTERVAL segundos)
+COMMIT_EVERY = 50
+COMMIT_INTERVAL = 5.0
+# ---------------------
+
+# Estados por serie:  pending -> downloaded -> converted -> done
+#                                           \-> failed
+# skipped: descartada por la selección de series antes de descargar (motivo en `error`)
+PENDING = "pending"
+DOWNLOADED = "downloaded"
+CONVERTED = "converted"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    series_uid TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    location TEXT,
+    output_path TEXT,
+    error TEXT,
+    updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS series_state ON series(state);
+"""
+
+
+class ProcessingJournal:
+    """Diario SQLite (modo WAL) con el estado de cada serie.
+
+    Las transiciones se acumulan en memoria y se escriben en una sola
+    transacción cada `commit_every` cambios o `commit_interval` segundos;
+    un corte pierde como mucho ese último tramo, y como cada etapa es
+    idempotente, al reanudar solo se repite la etapa interrumpida.
+    """
+
+    def __init__(self, path=JOURNAL_PATH, commit_every=COMMIT_EVERY, commit_interval=COMMIT_INTERVAL):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Se usa desde los hilos del pipeline; el lock serializa el acceso
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.lock = threading.RLock()
+        self.buffer = {}
+        self.last_commit = time.monotonic()
+
+    def import_legacy_log(self, log_path):
+        """Importa un processed_series.log antiguo marcando sus UIDs como terminados."""
+        log_path = Path(log_path)
+        if not log_path.exists():
+            return 0
+        with open(log_path, 'r') as f:
+            uids = [line.strip() for line in f if line.strip()]
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO series (series_uid, state, updated_at) VALUES (?, ?, ?)",
+                ((uid, DONE, now) for uid in uids),
+            )
+        log_path.rename(log_path.with_name(log_path.name + ".migrated"))
+        return len(uids)
+
+    def record(self, series_uid, state, location=None, output_path=None, error=None):
+        """Registra una transición; se escribe en el próximo commit por lotes.
+
+        `location` y `output_path` sin valor conservan los de la transición
+        anterior (p. ej. done mantiene la salida guardada en converted).
+        """
+        with self.lock:
+            location, output_path = _str(location), _str(output_path)
+            previous = self.buffer.get(series_uid)
+            if previous:
+                location = location if location is not None else previous[2]
+                output_path = output_path if output_path is not None else previous[3]
+            self.buffer[series_uid] = (series_uid, state, location, output_path, error, time.time())
+            if (len(self.buffer) >= self.commit_every
+                    or time.monotonic() - self.last_commit >= self.commit_interval):
+                self.flush()
+
+    def flush(self):
+        """Escribe en disco todas las transiciones pendientes en una transacción."""
+        with self.lock:
+            if self.buffer:
+                with self.conn:
+                    self.conn.executemany(
+                        "INSERT INTO series VALUES (?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT(series_uid) DO UPDATE SET state = excluded.state, "
+                        "location = COALESCE(excluded.location, location), "
+                        "output_path = COALESCE(excluded.output_path, output_path), "
+                        "error = excluded.error, updated_at = excluded.updated_at",
+                        self.buffer.values(),
+                    )
+                self.buffer.clear()
+            self.last_commit = time.monotonic()
+
+    def uids_in_state(self, *states):
+        """Conjunto de UIDs en cualquiera de `states` (incluye lo aún no escrito)."""
+        with self.lock:
+            self.flush()
+            placeholders = ", ".join("?" * len(states))
+            rows = self.conn.execute(
+                f"SELECT series_uid FROM series WHERE state IN ({placeholders})", states)
+            return {row[0] for row in rows}
+
+    def entries(self, *states):
+        """Filas completas (dicts) de las series en `states`."""
+        with self.lock:
+            self.flush()
+            placeholders = ", ".join("?" * len(states))
+            cursor = self.conn.execute(
+                f"SELECT * FROM series WHERE state IN ({placeholders})", states)
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor]
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _str(value):
+    return str(value) if value is not None else None
@@ -0,0 +1,86 @@
+import shutil
+import threading
+from pathlib import Path
+
+# --- CONFIGURACIÓN ---
+# Lotes de DICOM temporales en RAM (tmpfs): se escriben y leen una vez y se borran, así
+# no gastan escrituras del SSD. Sin /dev/shm (macOS, Windows) todo va a disco.
+RAM_STAGING = True
+RAM_STAGING_DIR = Path("/dev/shm/aura_temp_dicom")
+# Tope de bytes de lotes en RAM a la vez; un lote que no cabe se descarga a disco
+RAM_STAGING_MAX_BYTES = 8 * 1024**3
+# Fracción de MemAvailable que puede ocupar lo preparado en RAM (el resto es para la
+# conversión: SimpleITK tiene el volumen entero en memoria)
+RAM_FRACTION = 0.5
+# Mientras se extrae, el ZIP de la serie y sus DICOM conviven en la carpeta del lote
+ZIP_OVERHEAD = 2.0
+# ---------------------
+
+
+def _mem_available():
+    """MemAvailable de /proc/meminfo en bytes (None si no se puede leer)."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class RamStaging:
+    """Decide si cada lote de DICOM se prepara en tmpfs o en la carpeta temporal en disco.
+
+    Un lote va a RAM si su tamaño estimado, sumado a los lotes que ya están
+    ahí, cabe en `max_bytes`, en el espacio libre del tmpfs y en RAM_FRACTION
+    de la memoria disponible. Si no (series enormes, nodo con poca RAM), va a
+    `disk_dir` sin más. Los lotes en RAM se liberan con `release`.
+    """
+
+    def __init__(self, disk_dir, ram_dir=RAM_STAGING_DIR, max_bytes=RAM_STAGING_MAX_BYTES,
+                 enabled=RAM_STAGING):
+        self.disk_dir = Path(disk_dir)
+        self.ram_dir = Path(ram_dir)
+        self.max_bytes = max_bytes
+        self.enabled = enabled and self.ram_dir.parent.is_dir()
+        self.used = 0
+        self.lock = threading.Lock()
+        if self.enabled:
+            self.ram_dir.mkdir(parents=True, exist_ok=True)
+
+    def roots(self):
+        """Carpetas donde puede haber lotes (para retomar y limpiar huérfanos)."""
+        return [self.disk_dir, self.ram_dir] if self.enabled else [self.disk_dir]
+
+    def in_ram(self, path):
+        return self.enabled and Path(path).is_relative_to(self.ram_dir)
+
+    def _ram_free(self):
+        free = shutil.disk_usage(self.ram_dir).free
+        available = _mem_available()
+        if available is not None:
+            free = min(free, int(available * RAM_FRACTION))
+        return free
+
+    def place(self, name, nbytes):
+        """Carpeta para el lote `name` de `nbytes` de DICOM estimados. Devuelve (carpeta, bytes en RAM)."""
+        nbytes = int(nbytes * ZIP_OVERHEAD)
+        with self.lock:
+            if self.enabled and self.used + nbytes <= self.max_bytes and nbytes <= self._ram_free():
+                self.used += nbytes
+                return self.ram_dir / name, nbytes
+        return self.disk_dir / name, 0
+
+    def batch_bytes(self, batches):
+        """Bytes de DICOM por lote para que `batches` lotes quepan a la vez en RAM."""
+        return int(min(self.max_bytes, self._ram_free()) / ZIP_OVERHEAD / batches)
+
+    def adopt(self, nbytes):
+        """Cuenta un lote que ya estaba en RAM (retomado de una corrida interrumpida)."""
+        with self.lock:
+            self.used += nbytes
+
+    def release(self, nbytes):
+        with self.lock:
+            self.used -= nbytes
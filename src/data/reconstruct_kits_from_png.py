@@ -1,11 +1,15 @@
 import os
-import shutil
-import numpy as np
-import nibabel as nib
-from PIL import Image
 from pathlib import Path
 from tqdm import tqdm
 import re
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from .nifti_writer import save_nifti
+from .dataset_json import LABELS, create_dataset_json
+from .dtype_policy import compact_image, compact_label
+from .pipeline_metrics import stage, file_bytes, start_run, finish_run
+from .dataset_fingerprint import record_case, build_fingerprint
+from .volume_cache import cache_converted
+from .content_store import store_output
 
 # --- CONFIGURACIÓN ---
 # Ajusta la ruta a donde tengas DESCOMPRIMIDO tu dataset KiTS23 (con PNGs)
@@ -13,25 +17,15 @@ RAW_KITS_DIR = Path("data/raw/kits23")
 
 # Ruta de destino para nnU-Net (Dataset101_KiTS23)
 NNUNET_RAW_DIR = Path("data/raw/nnUNet_raw/Dataset101_KiTS23")
-# ---------------------
 
-def create_dataset_json(output_dir, num_training_cases):
-    """Crea el archivo dataset.json requerido por nnU-Net."""
-    json_dict = {
-        "channel_names": { "0": "CT" },
-        "labels": { "background": 0, "kidney": 1, "tumor": 2, "cyst": 3 },
-        "numTraining": num_training_cases,
-        "file_ending": ".nii.gz",
-        "name": "KiTS23",
-        "reference": "KiTS23 Challenge",
-        "tensorImageSize": "3D", 
-        "modality": { "0": "CT" } 
-    }
-    json_path = output_dir / "dataset.json"
-    with open(json_path, 'w') as f:
-        import json
-        json.dump(json_dict, f, indent=4)
-    print(f"✅ Archivo dataset.json creado en: {json_path}")
+# Hilos para decodificar los PNG de un caso
+DECODE_THREADS = min(8, os.cpu_count() or 1)
+# Casos reconstruidos a la vez (un proceso por caso)
+NUM_WORKERS = os.cpu_count() or 1
+# Presupuesto de RAM para los casos en curso y margen sobre la estimación
+MEMORY_BUDGET_BYTES = 8 * 1024**3
+MEMORY_OVERHEAD = 1.5
+# ---------------------
 
 def get_slice_index(filename):
     """Extrae el número de slice del nombre del archivo.
@@ -43,42 +37,204 @@ def get_slice_index(filename):
         return int(match.group(1))
     return -1
 
-def reconstruct_volume(image_files, mask_files=None):
-    """Lee una lista de archivos de imagen ordenados y crea un volumen 3D."""
+def _decode_slice(path, volume, index):
+    """Decodifica un PNG directamente en el corte `index` del volumen."""
+    import numpy as np
+    from PIL import Image
+    with Image.open(path) as img:
+        # Convertir a escala de grises (L); PIL libera el GIL al decodificar
+        volume[:, :, index] = np.asarray(img.convert('L'))
+
+def _allocate_volume(first_file, num_slices):
+    """Reserva el volumen (H, W, Z) a partir de la cabecera del primer corte.
+
+    Orden Fortran: cada corte [:, :, z] queda contiguo en memoria y nibabel
+    lo escribe sin copias (los NIfTI se guardan en orden Fortran).
+    """
+    import numpy as np
+    from PIL import Image
+    with Image.open(first_file) as img:
+        width, height = img.size
+    return np.empty((height, width, num_slices), dtype=np.uint8, order='F')
+
+def reconstruct_volume(image_files, mask_files=None, num_threads=DECODE_THREADS):
+    """Lee una lista de archivos de imagen ordenados y crea un volumen 3D.
+
+    Los volúmenes de imagen y máscara se reservan una sola vez y los cortes
+    de ambos se decodifican en el mismo pool de hilos, escribiendo cada uno
+    en su lugar (sin lista intermedia ni np.stack).
+    """
     # Ordenar por índice de slice
     image_files.sort(key=get_slice_index)
-    
-    slices = []
-    for img_path in image_files:
-        img = Image.open(img_path).convert('L') # Convertir a escala de grises (L)
-        slices.append(np.array(img))
-        
-    # Apilar en un volumen 3D (H, W, D) -> (X, Y, Z)
-    # nnU-Net generalmente espera (X, Y, Z), donde Z son los cortes.
-    # np.stack axis=0 crea (Z, H, W). axis=-1 crea (H, W, Z).
-    # La convención médica suele ser (X, Y, Z). Probemos axis=-1 primero.
-    volume = np.stack(slices, axis=-1) 
-    
-    mask_volume = None
     if mask_files:
         mask_files.sort(key=get_slice_index)
-        mask_slices = []
-        for mask_path in mask_files:
-            mask = Image.open(mask_path).convert('L') # Asumiendo máscaras en escala de grises
-            # Mapear valores si es necesario (ej. 255 -> 1)
-            # KiTS23 suele usar 0, 1, 2, 3 directamente.
-            mask_arr = np.array(mask)
-            mask_slices.append(mask_arr)
-        
-        if len(mask_slices) != len(slices):
-            print(f"⚠️ Advertencia: Número de slices de imagen ({len(slices)}) y máscara ({len(mask_slices)}) no coinciden.")
+        if len(mask_files) != len(image_files):
+            print(f"⚠️ Advertencia: Número de slices de imagen ({len(image_files)}) y máscara ({len(mask_files)}) no coinciden.")
             return None, None
-            
-        mask_volume = np.stack(mask_slices, axis=-1)
+
+    # Volumen 3D (H, W, D) -> (X, Y, Z)
+    # nnU-Net generalmente espera (X, Y, Z), donde Z son los cortes.
+    # La convención médica suele ser (X, Y, Z): el índice de slice va en el último eje.
+    volume = _allocate_volume(image_files[0], len(image_files))
+    jobs = [(path, volume, z) for z, path in enumerate(image_files)]
+
+    mask_volume = None
+    if mask_files:
+        # Máscaras en escala de grises. KiTS23 suele usar 0, 1, 2, 3 directamente.
+        mask_volume = _allocate_volume(mask_files[0], len(mask_files))
+        jobs += [(path, mask_volume, z) for z, path in enumerate(mask_files)]
+
+    try:
+        with stage("png_decode", key=image_files[0].parent.parent.name,
+                   bytes_in=file_bytes(job[0] for job in jobs)) as m:
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                for future in [executor.submit(_decode_slice, *job) for job in jobs]:
+                    future.result()
+            m["bytes_out"] = volume.nbytes + (mask_volume.nbytes if mask_volume is not None else 0)
+    except ValueError as e:
+        # Cortes con tamaños distintos no caben en el volumen reservado
+        print(f"⚠️ Advertencia: Cortes con dimensiones inconsistentes: {e}")
+        return None, None
         
     return volume, mask_volume
 
+def reconstruct_case(case_dir, imagesTr_dir, labelsTr_dir, num_threads=DECODE_THREADS, num_cases=None):
+    """Reconstruye y guarda la imagen (y máscara) de un caso. Devuelve True si se creó.
+
+    Con `num_cases` (casos del dataset) registra además la huella de nnU-Net
+    a partir de los volúmenes que ya están en memoria.
+    """
+    import numpy as np
+    import nibabel as nib
+    case_id = case_dir.name # "case_00000"
+    
+    img_dir = case_dir / "JPEGImages"
+    mask_dir = case_dir / "Annotations"
+    
+    img_files = list(img_dir.glob("*.png"))
+    mask_files = list(mask_dir.glob("*.png"))
+    
+    if not img_files:
+        return False
+
+    # Reconstruir 3D
+    vol, mask = reconstruct_volume(img_files, mask_files, num_threads)
+    
+    if vol is None:
+        return False
+    # Tipos compactos: el CT como int16 solo si lo necesita (de PNG ya es uint8) y la
+    # máscara en uint8 con los valores de dataset.json (remapeados si el PNG usa otros)
+    vol = compact_image(vol)
+    if mask is not None:
+        mask = compact_label(mask, LABELS.values())
+        
+    # Crear objetos NIfTI
+    # IMPORTANTE: Al reconstruir desde PNGs, perdemos la información espacial original (spacing, origin, direction).
+    # Usaremos una matriz identidad por defecto. nnU-Net remuestreará esto después, 
+    # pero idealmente deberíamos tener el spacing original.
+    affine = np.eye(4) 
+    nifti_img = nib.Nifti1Image(vol, affine)
+    
+    with stage("nifti_write", key=case_id, bytes_in=vol.nbytes) as m:
+        # Guardar Imagen
+        dst_image_name = f"{case_id}_0000.nii.gz"
+        digest = save_nifti(nifti_img, imagesTr_dir / dst_image_name, num_threads=num_threads)
+        m["bytes_out"] = file_bytes([imagesTr_dir / dst_image_name])
+        store_output(imagesTr_dir / dst_image_name, digest)
+        
+        # Guardar Máscara
+        if mask is not None:
+            nifti_mask = nib.Nifti1Image(mask, affine)
+            dst_label_name = f"{case_id}.nii.gz"
+            digest = save_nifti(nifti_mask, labelsTr_dir / dst_label_name, num_threads=num_threads)
+            m["bytes_in"] += mask.nbytes
+            m["bytes_out"] += file_bytes([labelsTr_dir / dst_label_name])
+            store_output(labelsTr_dir / dst_label_name, digest)
+
+    # Caché sin comprimir en orden (z, y, x): la traspuesta del volumen Fortran es C-contigua
+    cache_converted(imagesTr_dir / dst_image_name, vol.T)
+    if mask is not None:
+        cache_converted(labelsTr_dir / dst_label_name, mask.T)
+    if num_cases:
+        # Orden (z, y, x) de SimpleITK: la traspuesta del volumen Fortran es una vista C sin copia.
+        # Con affine identidad el spacing es 1 en los tres ejes.
+        record_case(imagesTr_dir.parent, case_id, vol.T, None if mask is None else mask.T,
+                    (1.0, 1.0, 1.0), num_cases)
+    return True
+
+def estimate_case_bytes(case_dir):
+    """Memoria que ocupará un caso: nº de cortes × dimensiones del corte (imagen + máscara)."""
+    from PIL import Image
+    total = 0
+    for sub in ("JPEGImages", "Annotations"):
+        files = list((case_dir / sub).glob("*.png"))
+        if files:
+            with Image.open(files[0]) as img:
+                width, height = img.size
+            total += len(files) * width * height  # uint8
+    return int(total * MEMORY_OVERHEAD)
+
+def _reconstruct_job(job):
+    case_dir, imagesTr_dir, labelsTr_dir, num_threads, num_cases = job
+    try:
+        return reconstruct_case(case_dir, imagesTr_dir, labelsTr_dir, num_threads, num_cases), None
+    except Exception as e:
+        return False, str(e)
+
+def reconstruct_cases_parallel(cases, imagesTr_dir, labelsTr_dir,
+                               num_workers=NUM_WORKERS, memory_budget=MEMORY_BUDGET_BYTES):
+    """Reconstruye varios casos en procesos sin pasarse de `memory_budget`.
+
+    Un caso nuevo solo entra si la suma estimada de los casos en curso más
+    el suyo cabe en el presupuesto (un caso que no cabe ni solo se procesa
+    cuando no hay otro en curso). Los resultados se reportan en el orden de
+    `cases`. Devuelve una lista de booleanos alineada con `cases`.
+    """
+    estimates = [estimate_case_bytes(c) for c in cases]
+    # Repartimos los núcleos entre procesos para los hilos de decodificación
+    threads_per_case = max(1, (os.cpu_count() or 1) // num_workers)
+    pending = list(range(len(cases)))
+    running = {}
+    in_use = 0
+    results = [None] * len(cases)
+    next_to_report = 0
+    progress = tqdm(total=len(cases), desc="Reconstruyendo volúmenes")
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        while pending or running:
+            # Admitimos los primeros casos pendientes que quepan en el presupuesto
+            for idx in list(pending):
+                if len(running) >= num_workers:
+                    break
+                if in_use + estimates[idx] > memory_budget and running:
+                    continue
+                pending.remove(idx)
+                in_use += estimates[idx]
+                job = (cases[idx], imagesTr_dir, labelsTr_dir, threads_per_case, len(cases))
+                running[executor.submit(_reconstruct_job, job)] = idx
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                idx = running.pop(future)
+                in_use -= estimates[idx]
+                try:
+                    results[idx] = future.result()
+                except Exception as e:
+                    # El proceso murió (p. ej. por falta de memoria)
+                    results[idx] = (False, str(e))
+
+            # Reporte ordenado: avanzamos mientras el siguiente caso ya terminó
+            while next_to_report < len(cases) and results[next_to_report] is not None:
+                ok, error = results[next_to_report]
+                if error:
+                    print(f"Error reconstruyendo {cases[next_to_report].name}: {error}")
+                next_to_report += 1
+                progress.update(1)
+    progress.close()
+    return [ok for ok, _ in results]
+
 def main():
+    start_run()
     # 1. Crear estructura de destino
     imagesTr_dir = NNUNET_RAW_DIR / "imagesTr"
     labelsTr_dir = NNUNET_RAW_DIR / "labelsTr"
@@ -106,50 +262,16 @@ def main():
 
     print(f"✅ Se encontraron {len(valid_cases)} casos para reconstruir.")
     
-    processed_count = 0
-    
-    # 3. Procesar cada caso
-    for case_dir in tqdm(valid_cases, desc="Reconstruyendo volúmenes"):
-        case_id = case_dir.name # "case_00000"
-        
-        img_dir = case_dir / "JPEGImages"
-        mask_dir = case_dir / "Annotations"
-        
-        img_files = list(img_dir.glob("*.png"))
-        mask_files = list(mask_dir.glob("*.png"))
-        
-        if not img_files:
-            continue
-
-        # Reconstruir 3D
-        vol, mask = reconstruct_volume(img_files, mask_files)
-        
-        if vol is None:
-            continue
-            
-        # Crear objetos NIfTI
-        # IMPORTANTE: Al reconstruir desde PNGs, perdemos la información espacial original (spacing, origin, direction).
-        # Usaremos una matriz identidad por defecto. nnU-Net remuestreará esto después, 
-        # pero idealmente deberíamos tener el spacing original.
-        affine = np.eye(4) 
-        nifti_img = nib.Nifti1Image(vol, affine)
-        
-        # Guardar Imagen
-        dst_image_name = f"{case_id}_0000.nii.gz"
-        nib.save(nifti_img, imagesTr_dir / dst_image_name)
-        
-        # Guardar Máscara
-        if mask is not None:
-            nifti_mask = nib.Nifti1Image(mask, affine)
-            dst_label_name = f"{case_id}.nii.gz"
-            nib.save(nifti_mask, labelsTr_dir / dst_label_name)
-            
-        processed_count += 1
+    # 3. Procesar los casos en paralelo dentro del presupuesto de memoria
+    results = reconstruct_cases_parallel(valid_cases, imagesTr_dir, labelsTr_dir)
+    processed_count = sum(results)
 
     print(f"\n✅ Reconstrucción completada. {processed_count} volúmenes creados.")
+    finish_run()
     
     if processed_count > 0:
         create_dataset_json(NNUNET_RAW_DIR, processed_count)
+        build_fingerprint(NNUNET_RAW_DIR)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,107 @@
+import re
+from collections import Counter
+
+# --- CONFIGURACIÓN ---
+# Series que no son volúmenes diagnósticos (se descartan por SeriesDescription)
+EXCLUDE_DESCRIPTION = re.compile(
+    r"scout|localizer|locator|topogram|surview|scanogram|\bloc\b|dose|screen ?save|"
+    r"protocol|bolus|tracker|smart ?prep|monitor|\bmip\b|\bmpr\b|\bcor(onal)?\b|\bsag(ittal)?\b|\b3d\b",
+    re.IGNORECASE,
+)
+# Regiones que no incluyen los riñones (por BodyPartExamined)
+EXCLUDE_BODY_PARTS = {"HEAD", "BRAIN", "NECK", "HEADNECK", "EXTREMITY", "KNEE", "HAND", "FOOT"}
+# Menos cortes que esto no es un volumen útil (scouts sin descripción, series parciales)
+MIN_IMAGE_COUNT = 30
+# Preferencias por descripción (se suman); para riñón la fase portal/nefrográfica es la mejor
+DESCRIPTION_SCORES = [
+    (re.compile(r"portal|venous|nephro|\bpv\b", re.IGNORECASE), 3),
+    (re.compile(r"arterial|\bart\b|cortico", re.IGNORECASE), 2),
+    (re.compile(r"abd|kidney|renal|\bax(ial)?\b", re.IGNORECASE), 1),
+    (re.compile(r"w/o|without|non.?con|pre.?con|plain|delay|excret", re.IGNORECASE), -2),
+]
+PREFERRED_BODY_PARTS = {"ABDOMEN", "KIDNEY", "ABDOMENPELVIS", "ABDPELVIS", "CHESTABDPELVIS"}
+# ---------------------
+
+
+def exclusion_reason(series):
+    """Motivo para descartar una serie antes de descargarla (None si es candidata)."""
+    description = series.get("SeriesDescription") or ""
+    if EXCLUDE_DESCRIPTION.search(description):
+        return f"descripción '{description}'"
+    body_part = (series.get("BodyPartExamined") or "").upper().replace(" ", "")
+    if body_part in EXCLUDE_BODY_PARTS:
+        return f"región {body_part}"
+    image_count = series.get("ImageCount")
+    if image_count is not None and int(image_count) < MIN_IMAGE_COUNT:
+        return f"solo {image_count} imágenes"
+    return None
+
+
+def series_score(series):
+    """Clave de orden (mayor es mejor): preferencias por descripción y región, luego nº de cortes.
+
+    A igual preferencia gana la serie con más imágenes (cortes más finos) y
+    después la más pesada (suele ser la reconstrucción de mayor calidad).
+    """
+    description = series.get("SeriesDescription") or ""
+    score = sum(points for pattern, points in DESCRIPTION_SCORES if pattern.search(description))
+    body_part = (series.get("BodyPartExamined") or "").upper().replace(" ", "")
+    if body_part in PREFERRED_BODY_PARTS:
+        score += 1
+    return (score, int(series.get("ImageCount") or 0), int(series.get("FileSize") or 0))
+
+
+def select_series(series_data, in_progress=(), failed=()):
+    """Elige una serie por paciente con los metadatos de nbia.getSeries, antes de descargar nada.
+
+    `in_progress`: UIDs ya descargados, convertidos o terminados en corridas
+    anteriores; su paciente queda cubierto con la mejor de ellas y no se
+    elige otra serie para él.
+    `failed`: UIDs que fallaron; se prueba la siguiente mejor serie del paciente.
+    Devuelve (UIDs elegidos, {UID descartado: motivo}).
+    """
+    in_progress, failed = set(in_progress), set(failed)
+    by_patient = {}
+    skipped = {}
+    for series in series_data:
+        uid = series["SeriesInstanceUID"]
+        by_patient.setdefault(series.get("PatientID") or uid, []).append(series)
+
+    selected = []
+    for patient, candidates in by_patient.items():
+        # Lo ya empezado se respeta; si una corrida anterior sin selección (o interrumpida)
+        # dejó varias, se queda la mejor: una sola salida por paciente
+        started = [s for s in candidates if s["SeriesInstanceUID"] in in_progress]
+        chosen = [max(started, key=series_score)] if started else []
+        if not chosen:
+            ranked = []
+            for series in candidates:
+                uid = series["SeriesInstanceUID"]
+                reason = exclusion_reason(series)
+                if reason is None and uid in failed:
+                    reason = "falló en una corrida anterior"
+                if reason:
+                    skipped[uid] = reason
+                else:
+                    ranked.append(series)
+            if not ranked:
+                continue
+            chosen = [max(ranked, key=series_score)]
+        selected += [s["SeriesInstanceUID"] for s in chosen]
+        for series in candidates:
+            uid = series["SeriesInstanceUID"]
+            if series not in chosen and uid not in skipped:
+                skipped[uid] = f"otra serie elegida para {patient}"
+    return selected, skipped
+
+
+def print_selection_summary(series_data, selected, skipped):
+    """Cuántas series y bytes (FileSize) se ahorran, agrupado por motivo."""
+    sizes = {s["SeriesInstanceUID"]: int(s.get("FileSize") or 0) for s in series_data}
+    saved = sum(sizes.get(uid, 0) for uid in skipped)
+    total = sum(sizes.values())
+    print(f"🎯 Selección: {len(selected)} series elegidas, {len(skipped)} descartadas "
+          f"({saved / 1024**3:.2f} de {total / 1024**3:.2f} GB sin descargar).")
+    reasons = Counter(re.sub(r"'.*'|\d+|para .*", "…", reason) for reason in skipped.values())
+    for reason, count in reasons.most_common():
+        print(f"  {count:5d}  {reason}")
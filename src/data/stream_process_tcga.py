@@ -1,128 +1,496 @@
 import os
+import queue
 import shutil
-import pandas as pd
-from tcia_utils import nbia
+import threading
+import itertools
+import multiprocessing
+from collections import Counter, deque
 from pathlib import Path
-import SimpleITK as sitk
-from tqdm import tqdm
 import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from .download_tcga import MAX_WORKERS, AdaptiveConcurrency, download_series
+from .dicom_catalog import CATALOG_PATH, open_catalog, rescan, query_series, forget_tree
+from .processing_journal import ProcessingJournal, DOWNLOADED, CONVERTED, DONE, FAILED, SKIPPED
+from .nifti_writer import write_sitk_image
+from .pipeline_metrics import stage, file_bytes, start_run, finish_run
+from .dataset_fingerprint import record_case, case_id_from_image, build_fingerprint
+from .volume_cache import CACHE_DIR, CACHE_ON_CONVERT, cache_converted
+from .content_store import store_output
+from .dtype_policy import compact_sitk_image
+from .series_selection import select_series, print_selection_summary
+from .disk_budget import DiskBudget, DiskBudgetExceeded
+from .batch_sizing import DEFAULT_SERIES_BYTES, BatchSizer, series_bytes
+from .ram_staging import RamStaging
 
 # --- CONFIGURACIÓN ---
 DATASET_NAME = "TCGA-KIRC"
 # Directorios temporales y finales
 TEMP_DICOM_DIR = Path("data/temp_dicom")  # Aquí descargamos temporalmente
+# (los lotes que caben se preparan en RAM, ver ram_staging.RAM_STAGING)
 OUTPUT_NIFTI_DIR = Path("data/raw/nnUNet_raw/Dataset102_TCGA/imagesTr")
-# Archivo de registro para saber qué ya procesamos
+# Diario con el estado de cada serie (descargada/convertida/terminada/fallida)
+JOURNAL_PATH = Path("data/processing_journal.sqlite")
+# Log antiguo; si existe se importa al diario la primera vez
 PROCESSED_LOG = Path("data/processed_series.log")
+# Reintentar las series cuya conversión falló en corridas anteriores
+RETRY_FAILED = False
+# Elegir una serie por paciente con los metadatos de getSeries antes de descargar
+# (False = descargar todas las series CT de la colección)
+SELECT_SERIES = True
+# Modo pipeline: descarga, conversión y limpieza de lotes distintos en paralelo
+PIPELINE_MODE = True
+# Lotes que pueden esperar entre etapas
+QUEUE_DEPTH = 1
+# Cada cuántos segundos una etapa bloqueada en una cola llena comprueba si el pipeline se detuvo
+QUEUE_POLL_SECONDS = 1.0
+# Estimación de espacio por lote (ver disk_budget): tamaño del .nii.gz respecto a sus DICOM
+NIFTI_TO_DICOM_RATIO = 0.5
+# Procesos para la conversión dentro del pipeline
+NUM_CONVERT_WORKERS = max(1, (os.cpu_count() or 1) - 1)
+# ---------------------
 
-# Asegurar directorios
-TEMP_DICOM_DIR.mkdir(parents=True, exist_ok=True)
-OUTPUT_NIFTI_DIR.mkdir(parents=True, exist_ok=True)
+_journal = None
+_staging = None
+# Descargas simultáneas: se ajustan con el MB/s medido y se conservan de un lote al siguiente
+_concurrency = None
+# Series previstas en el dataset (para repartir las muestras de la huella de nnU-Net)
+_num_cases = None
+# Bytes estimados de cada serie según getSeries (para armar lotes y reservar espacio)
+_series_sizes = {}
+# Series que la selección dejó como única de su paciente (su salida es <paciente>_0000.nii.gz)
+_single_series = set()
 
-# ---------------------
+def get_journal():
+    """Diario de procesamiento compartido (se abre la primera vez que se usa)."""
+    global _journal
+    if _journal is None:
+        _journal = ProcessingJournal(JOURNAL_PATH)
+        migrated = _journal.import_legacy_log(PROCESSED_LOG)
+        if migrated:
+            print(f"📒 Importadas {migrated} series de {PROCESSED_LOG} al diario.")
+    return _journal
+
+def get_concurrency():
+    global _concurrency
+    if _concurrency is None:
+        _concurrency = AdaptiveConcurrency(MAX_WORKERS)
+    return _concurrency
+
+def close_journal():
+    global _journal
+    if _journal is not None:
+        _journal.close()
+        _journal = None
+
+def get_staging():
+    """Reparto de los lotes entre tmpfs y TEMP_DICOM_DIR (se crea la primera vez que se usa)."""
+    global _staging
+    if _staging is None:
+        _staging = RamStaging(TEMP_DICOM_DIR)
+    return _staging
 
 def load_processed_series():
-    if PROCESSED_LOG.exists():
-        with open(PROCESSED_LOG, 'r') as f:
-            return set(line.strip() for line in f)
-    return set()
+    """UIDs que no hay que volver a procesar (terminados y, salvo RETRY_FAILED, fallidos)."""
+    states = (DONE,) if RETRY_FAILED else (DONE, FAILED)
+    return get_journal().uids_in_state(*states)
 
 def mark_series_as_processed(series_uid):
-    with open(PROCESSED_LOG, 'a') as f:
-        f.write(f"{series_uid}\n")
+    get_journal().record(series_uid, DONE)
+
+def convert_dicom_series(series_dir, output_path, num_cases=None):
+    """Convierte una serie DICOM a NIfTI usando SimpleITK.
 
-def convert_dicom_series(series_dir, output_path):
-    """Convierte una serie DICOM a NIfTI usando SimpleITK."""
+    Con `num_cases` registra también la huella de nnU-Net del volumen.
+    """
+    import SimpleITK as sitk
     reader = sitk.ImageSeriesReader()
     try:
         dicom_names = reader.GetGDCMSeriesFileNames(str(series_dir))
         if not dicom_names:
             return False
         reader.SetFileNames(dicom_names)
-        image = reader.Execute()
-        sitk.WriteImage(image, str(output_path))
+        with stage("dicom_decode", key=Path(series_dir).name, bytes_in=file_bytes(dicom_names)):
+            image = reader.Execute()
+        # float (rescale slope/intercept) o tipos anchos pasan a int16 si no se pierde nada
+        image = compact_sitk_image(image)
+        # Los núcleos se reparten entre los procesos de conversión
+        with stage("nifti_write", key=Path(series_dir).name) as m:
+            digest = write_sitk_image(image, output_path,
+                                      num_threads=max(1, (os.cpu_count() or 1) // NUM_CONVERT_WORKERS))
+            m["bytes_out"] = file_bytes([output_path])
+        # Una re-descarga de la misma serie produce el mismo .nii.gz: se enlaza al objeto existente
+        store_output(output_path, digest)
+        cache_converted(output_path, sitk.GetArrayViewFromImage(image))
+        if num_cases:
+            record_case(Path(output_path).parent.parent, case_id_from_image(output_path),
+                        sitk.GetArrayViewFromImage(image), None, image.GetSpacing()[::-1], num_cases)
         return True
     except Exception as e:
         print(f"⚠️ Error convirtiendo {series_dir}: {e}")
         return False
 
-def get_patient_id(series_dir):
-    """Intenta extraer el PatientID de los archivos DICOM."""
-    try:
-        dcm_files = list(series_dir.glob("*.dcm"))
-        if not dcm_files: return None
-        # Leemos solo los tags del primer archivo
-        reader = sitk.ImageFileReader()
-        reader.SetFileName(str(dcm_files[0]))
-        reader.LoadPrivateTagsOn()
-        reader.ReadImageInformation()
-        return reader.GetMetaData("0010|0020").strip()
-    except:
-        return None
-
-def process_batch(series_uids):
-    """Descarga, convierte y borra un lote de series."""
-    
-    # 1. Descargar Lote
+def download_batch(series_uids, batch_dir, sizer=None):
+    """Descarga un lote de series en `batch_dir` con el motor de download_tcga.
+
+    Devuelve los UIDs que quedaron completos en disco; las series que fallan
+    tras los reintentos se quedan fuera y se reintentarán en la próxima corrida.
+    Con `sizer` (BatchSizer) los tiempos medidos ajustan los lotes siguientes.
+    """
     print(f"⬇️ Descargando lote de {len(series_uids)} series...")
-    try:
-        # Descargamos en la carpeta temporal
-        nbia.downloadSeries(series_uids, input_type="list", path=TEMP_DICOM_DIR)
-    except Exception as e:
-        print(f"❌ Error en descarga de lote: {e}")
-        return
+    # Descargamos en la carpeta temporal del lote
+    summary = download_series(series_uids, batch_dir, failed_log=None, concurrency=get_concurrency())
+    if sizer:
+        sizer.observe(summary)
+    if summary["failed"]:
+        print(f"❌ {len(summary['failed'])} series no se pudieron descargar.")
+    done_uids = summary["downloaded"] + summary["skipped"]
+    journal = get_journal()
+    for uid in done_uids:
+        journal.record(uid, DOWNLOADED, location=batch_dir / uid)
+    return done_uids
 
-    # 2. Convertir Lote
+def _convert_job(job):
+    series_dir, output_path, num_cases = job
+    return convert_dicom_series(series_dir, output_path, num_cases)
+
+def convert_batch(batch_dir, executor=None, series_uids=None):
+    """Convierte a NIfTI las series descargadas en `batch_dir`.
+
+    Si se pasa `series_uids`, solo se convierten esas (al reanudar, las que
+    ya estaban convertidas no se repiten). Si se pasa un `executor` (pool de
+    procesos), las series se convierten ahí para no competir por el GIL con
+    la descarga del lote siguiente. Devuelve los UIDs convertidos.
+    """
     print("🔄 Convirtiendo a NIfTI...")
     # Buscamos las carpetas de series descargadas (TCIA crea una estructura anidada)
-    # Buscamos recursivamente cualquier carpeta que tenga .dcm
-    downloaded_series_dirs = set()
-    for f in TEMP_DICOM_DIR.rglob("*.dcm"):
-        downloaded_series_dirs.add(f.parent)
+    # El catálogo lista las carpetas con .dcm y lee solo la cabecera de una por serie
+    conn = open_catalog(CATALOG_PATH)
+    rescan(conn, batch_dir)
+    jobs = []
     
-    for series_dir in downloaded_series_dirs:
+    for entry in query_series(conn, batch_dir):
+        series_dir = entry["series_dir"]
+        # Cada serie se descarga en <batch_dir>/<SeriesInstanceUID>/
+        uid = series_dir.relative_to(os.path.abspath(batch_dir)).parts[0]
+        if series_uids is not None and uid not in series_uids:
+            continue
         # Identificar Paciente
-        patient_id = get_patient_id(series_dir)
-        if not patient_id:
-            patient_id = "UNKNOWN" # Fallback
+        patient_id = entry["patient_id"] or "UNKNOWN" # Fallback
             
         # Definir nombre de salida (formato nnU-Net: ID_0000.nii.gz)
-        # Usamos el SeriesInstanceUID como parte del nombre para evitar colisiones si un paciente tiene varios scans
-        # Pero nnU-Net espera ID_0000. Si hay múltiples, hay que decidir.
-        # Por ahora, guardamos como ID_SERIESUID_0000.nii.gz para no sobreescribir.
-        # Luego filtraremos.
+        # Solo si la selección dejó esta serie como única de su paciente el nombre es el de
+        # nnU-Net; si no (sin selección, sin metadatos, paciente desconocido), el
+        # SeriesInstanceUID en el nombre evita pisar otros scans del paciente
         series_uid_name = series_dir.name
-        output_filename = f"{patient_id}_{series_uid_name}_0000.nii.gz"
-        output_path = OUTPUT_NIFTI_DIR / output_filename
-        
-        if convert_dicom_series(series_dir, output_path):
-            print(f"✅ Convertido: {output_filename}")
+        single = uid in _single_series and entry["patient_id"]
+        output_filename = (f"{patient_id}_0000.nii.gz" if single
+                           else f"{patient_id}_{series_uid_name}_0000.nii.gz")
+        jobs.append((uid, series_dir, OUTPUT_NIFTI_DIR / output_filename))
+    conn.close()
+
+    journal = get_journal()
+    futures = [executor.submit(_convert_job, (*job[1:], _num_cases)) for job in jobs] if executor else None
+    converted = []
+    broken = None
+    for i, (uid, series_dir, output_path) in enumerate(jobs):
+        try:
+            ok = futures[i].result() if futures else _convert_job((series_dir, output_path, _num_cases))
+        except BrokenProcessPool as e:
+            # Un proceso murió (p. ej. segfault en GDCM); avisamos al llamador al final
+            broken = e
+            ok = False
+        if ok:
+            print(f"✅ Convertido: {output_path.name}")
+            journal.record(uid, CONVERTED, location=batch_dir / uid, output_path=output_path)
+            converted.append(uid)
         else:
             print(f"❌ Falló conversión: {series_dir}")
+            journal.record(uid, FAILED, location=batch_dir / uid, error=str(broken or "conversión fallida"))
+    if broken:
+        raise broken
+    return converted
 
-    # 3. Limpiar (Borrar DICOMs)
+def cleanup_batch(batch_dir):
+    """Borra los DICOMs temporales de un lote y los saca del catálogo."""
     print("🧹 Limpiando archivos temporales...")
-    # Borramos todo el contenido de TEMP_DICOM_DIR
-    for item in TEMP_DICOM_DIR.iterdir():
-        if item.is_dir():
-            shutil.rmtree(item)
+    shutil.rmtree(batch_dir, ignore_errors=True)
+    conn = open_catalog(CATALOG_PATH)
+    forget_tree(conn, batch_dir)
+    conn.close()
+
+def _new_item(batch_dir, download=()):
+    """Unidad de trabajo: una carpeta temporal y qué falta hacer con cada serie."""
+    return {"batch_dir": Path(batch_dir), "download": list(download), "convert": [], "converted": []}
+
+def _fresh_items(uids, sizer, run_id):
+    """Lotes nuevos, armados uno a uno al pedirlos para usar las últimas mediciones del sizer.
+
+    Cada lote se prepara en RAM si su tamaño estimado cabe; si no, en disco.
+    """
+    pending = deque(uids)
+    for i in itertools.count():
+        if not pending:
+            return
+        batch = sizer.next_batch(pending)
+        estimate = sum(_series_sizes.get(uid) or DEFAULT_SERIES_BYTES for uid in batch)
+        batch_dir, ram_bytes = get_staging().place(f"batch_{run_id}_{i:05d}", estimate)
+        item = _new_item(batch_dir, batch)
+        item["ram_bytes"] = ram_bytes
+        yield item
+
+def plan_work(pending_uids, sizer):
+    """Arma las unidades de trabajo retomando lo que quedó a medias.
+
+    Las series ya descargadas cuya carpeta sigue en disco solo se convierten,
+    las ya convertidas solo se limpian, y el resto se agrupa en lotes nuevos
+    según `sizer` (BatchSizer). Las carpetas temporales que nadie reclama se
+    borran. Devuelve un iterador: los lotes nuevos se arman a medida que se
+    piden, después de medir la descarga del anterior.
+    """
+    journal = get_journal()
+    items = {}
+    resumed = set()
+    for entry in journal.entries(DOWNLOADED, CONVERTED):
+        uid = entry["series_uid"]
+        location = Path(entry["location"]) if entry["location"] else None
+        if location is None or not location.exists():
+            if entry["state"] == CONVERTED:
+                # Ya convertida y sin temporales que borrar
+                journal.record(uid, DONE, output_path=entry["output_path"])
+                resumed.add(uid)
+            # Una descarga perdida se vuelve a hacer desde cero
+            continue
+        # location = <batch_dir>/<SeriesInstanceUID>
+        batch_dir = location.parent
+        item = items.setdefault(batch_dir, _new_item(batch_dir))
+        item["convert" if entry["state"] == DOWNLOADED else "converted"].append(uid)
+        resumed.add(uid)
+
+    staging = get_staging()
+    for batch_dir, item in items.items():
+        # Lotes que siguen en tmpfs (corrida interrumpida sin reiniciar el nodo)
+        if staging.in_ram(batch_dir):
+            item["ram_bytes"] = _dir_size(batch_dir)
+            staging.adopt(item["ram_bytes"])
+    if items:
+        print(f"♻️ Retomando {len(resumed)} series interrumpidas en {len(items)} lotes.")
+    # Temporales huérfanos de corridas anteriores (en disco y en RAM)
+    for child in (child for root in staging.roots() for child in root.iterdir()):
+        if child in items:
+            continue
+        if child.is_dir():
+            cleanup_batch(child)
         else:
-            item.unlink()
-            
-    # Marcar como procesados en el log
-    for uid in series_uids:
+            child.unlink()
+
+    fresh = [uid for uid in pending_uids if uid not in resumed]
+    run_id = time.strftime("%Y%m%d%H%M%S")
+    return itertools.chain(list(items.values()), _fresh_items(fresh, sizer, run_id))
+
+def download_stage(item, sizer=None):
+    if item["download"]:
+        with stage("download", key=item["batch_dir"].name) as m:
+            item["convert"] += download_batch(item["download"], item["batch_dir"], sizer)
+            m["bytes_out"] = _dir_size(item["batch_dir"])
+
+def convert_stage(item, executor=None):
+    if item["convert"]:
+        with stage("convert", key=item["batch_dir"].name, bytes_in=_dir_size(item["batch_dir"])):
+            item["converted"] += convert_batch(item["batch_dir"], executor, set(item["convert"]))
+
+def cleanup_stage(item):
+    with stage("cleanup", key=item["batch_dir"].name):
+        cleanup_batch(item["batch_dir"])
+    if item.get("ram_bytes"):
+        get_staging().release(item.pop("ram_bytes"))
+    # Marcar como procesados en el diario
+    for uid in item["converted"]:
         mark_series_as_processed(uid)
+    get_journal().flush()
+
+def estimate_item(item):
+    """Bytes que una unidad de trabajo va a escribir en cada carpeta: {carpeta: bytes}.
+
+    Los DICOM por descargar se estiman con el FileSize de getSeries; los ya
+    descargados (al reanudar) están en disco y solo cuentan para la salida.
+    Los lotes preparados en RAM no ocupan disco temporal (los cuenta RamStaging).
+    """
+    sizes = [_series_sizes.get(uid) or DEFAULT_SERIES_BYTES for uid in item["download"]]
+    to_download = sum(sizes)
+    if item["convert"]:
+        on_disk = _dir_size(item["batch_dir"]) if item["batch_dir"].exists() else 0
+        sizes += [on_disk / len(item["convert"])] * len(item["convert"])
+    dicom = sum(sizes)
+    needs = {TEMP_DICOM_DIR: 0 if get_staging().in_ram(item["batch_dir"]) else to_download,
+             OUTPUT_NIFTI_DIR: dicom * NIFTI_TO_DICOM_RATIO}
+    if CACHE_ON_CONVERT:
+        needs[CACHE_DIR] = dicom
+    return needs
+
+def process_item(item, sizer=None):
+    """Descarga, convierte y borra una unidad de trabajo, una etapa tras otra."""
+    download_stage(item, sizer)
+    convert_stage(item)
+    cleanup_stage(item)
+
+def process_batch(series_uids, batch_dir=TEMP_DICOM_DIR / "batch"):
+    """Descarga, convierte y borra un lote de series."""
+    with stage("batch", key=Path(batch_dir).name):
+        process_item(_new_item(batch_dir, series_uids))
+
+def _dir_size(path):
+    """Bytes ocupados por los archivos bajo `path`."""
+    return sum(f.stat().st_size for f in Path(path).rglob("*") if f.is_file())
+
+def _describe_item(item):
+    series = item["download"] or item["convert"]
+    estimate = sum(_series_sizes.get(uid) or DEFAULT_SERIES_BYTES for uid in item["download"])
+    return (f"{item['batch_dir'].name}: {len(series)} series"
+            + (f", ~{estimate / 1024**3:.2f} GB" if estimate else "")
+            + (" en RAM" if get_staging().in_ram(item["batch_dir"]) else ""))
+
+def run_pipeline(items, budget=None, sizer=None, queue_depth=QUEUE_DEPTH):
+    """Procesa las unidades de trabajo solapando descarga, conversión y limpieza.
+
+    Mientras el lote N se convierte, el N+1 se descarga y el N-1 se borra.
+    Las etapas se comunican por colas acotadas y un lote solo empieza a
+    descargarse si lo que va a escribir (estimate_item) cabe en cada disco
+    bajo la marca de agua de `budget`, contando los lotes aún en vuelo.
+    Si un lote no cabe ni con el pipeline vacío, o su descarga falla, no se
+    empieza ninguno más y se devuelve esa excepción (None si se procesó
+    todo). Con `sizer`, cada descarga medida ajusta el tamaño de los lotes
+    siguientes. Si el hilo de conversión o la limpieza fallan, la descarga
+    deja de esperar en su cola y el pipeline termina en vez de colgarse.
+    """
+    budget = budget or DiskBudget()
+    convert_queue = queue.Queue(maxsize=queue_depth)
+    cleanup_queue = queue.Queue(maxsize=queue_depth)
+    stopped = []
+    stop = threading.Event()
+
+    def put(q, item):
+        """put() que se rinde si el pipeline se detuvo; True si el elemento entró."""
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=QUEUE_POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def downloader():
+        try:
+            for i, item in enumerate(items):
+                try:
+                    item["reservation"] = budget.acquire(estimate_item(item), key=item["batch_dir"].name)
+                except DiskBudgetExceeded as e:
+                    stopped.append(e)
+                    break
+                print(f"\n--- Lote {i+1} ({_describe_item(item)}) ---")
+                try:
+                    download_stage(item, sizer)
+                except Exception as e:
+                    # Lo descargado queda en el diario: la próxima corrida lo retoma
+                    budget.release(item.pop("reservation"))
+                    stopped.append(e)
+                    break
+                except BaseException:
+                    budget.release(item.pop("reservation"))
+                    raise
+                if not put(convert_queue, item):
+                    # Nadie va a convertirlo: queda descargado y en el diario para la próxima corrida
+                    budget.release(item.pop("reservation"))
+                    break
+        finally:
+            put(convert_queue, None)
+
+    def converter():
+        # "spawn" evita hacer fork de un proceso con hilos ya corriendo
+        mp_context = multiprocessing.get_context("spawn")
+        executor = item = None
+        try:
+            executor = ProcessPoolExecutor(max_workers=NUM_CONVERT_WORKERS, mp_context=mp_context)
+            while True:
+                item = convert_queue.get()
+                if item is None:
+                    break
+                try:
+                    convert_stage(item, executor)
+                except BrokenProcessPool as e:
+                    # Un proceso murió: el pool queda inutilizable, creamos otro
+                    print(f"❌ Error convirtiendo lote {item['batch_dir'].name}: {e}")
+                    executor.shutdown(wait=False)
+                    executor = ProcessPoolExecutor(max_workers=NUM_CONVERT_WORKERS, mp_context=mp_context)
+                except Exception as e:
+                    print(f"❌ Error convirtiendo lote {item['batch_dir'].name}: {e}")
+                if not put(cleanup_queue, item):
+                    break
+                item = None
+        except Exception as e:
+            # Sin conversor la descarga no debe quedarse esperando en convert_queue
+            print(f"❌ La conversión se detuvo: {e}")
+            stopped.append(e)
+            stop.set()
+            if item is not None:
+                budget.release(item.pop("reservation"))
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            # El hilo principal espera este None para terminar
+            cleanup_queue.put(None)
+
+    threads = [threading.Thread(target=downloader, daemon=True),
+               threading.Thread(target=converter, daemon=True)]
+    for t in threads:
+        t.start()
+
+    # La limpieza corre en el hilo principal
+    try:
+        while True:
+            item = cleanup_queue.get()
+            if item is None:
+                break
+            try:
+                cleanup_stage(item)
+            finally:
+                budget.release(item.pop("reservation"))
+    except BaseException:
+        stop.set()
+        raise
+
+    for t in threads:
+        t.join()
+    # Lotes descargados que no llegaron a convertirse (el conversor falló)
+    while not convert_queue.empty():
+        item = convert_queue.get_nowait()
+        if item is not None:
+            budget.release(item.pop("reservation"))
+    return stopped[0] if stopped else None
 
 def main():
+    global _num_cases
+    from tcia_utils import nbia
+    start_run()
     print(f"🚀 Iniciando Flujo de Procesamiento {DATASET_NAME}...")
+    # Asegurar directorios
+    TEMP_DICOM_DIR.mkdir(parents=True, exist_ok=True)
+    OUTPUT_NIFTI_DIR.mkdir(parents=True, exist_ok=True)
     
     # 1. Obtener lista completa de series
+    _series_sizes.clear()
+    _single_series.clear()
     try:
         series_data = nbia.getSeries(collection=DATASET_NAME, modality="CT")
         # Manejo robusto de la respuesta (como hicimos antes)
         if isinstance(series_data, list) and len(series_data) > 0:
             if isinstance(series_data[0], dict):
                 all_series_uids = [item['SeriesInstanceUID'] for item in series_data]
+                _series_sizes.update((item['SeriesInstanceUID'], series_bytes(item))
+                                     for item in series_data)
             elif isinstance(series_data[0], str):
                 all_series_uids = series_data
             else:
@@ -134,10 +502,27 @@ def main():
         print(f"Error conectando a TCIA: {e}")
         return
 
-    # 2. Filtrar ya procesados
+    # 2. Elegir una serie por paciente (sin descargar nada) y filtrar ya procesados
+    journal = get_journal()
+    if SELECT_SERIES and isinstance(series_data[0], dict):
+        failed = set() if RETRY_FAILED else journal.uids_in_state(FAILED)
+        selected, skipped = select_series(
+            series_data, in_progress=journal.uids_in_state(DOWNLOADED, CONVERTED, DONE), failed=failed)
+        print_selection_summary(series_data, selected, skipped)
+        for uid, reason in skipped.items():
+            if uid not in failed:
+                journal.record(uid, SKIPPED, error=reason)
+        journal.flush()
+        all_series_uids = selected
+        patients = {s["SeriesInstanceUID"]: s.get("PatientID") for s in series_data}
+        per_patient = Counter(patients[uid] for uid in selected)
+        _single_series.update(uid for uid in selected if patients[uid] and per_patient[patients[uid]] == 1)
+    elif SELECT_SERIES:
+        print("⚠️ getSeries no devolvió metadatos: se procesan todas las series.")
     processed = load_processed_series()
     pending_uids = [uid for uid in all_series_uids if uid not in processed]
     
+    _num_cases = len(all_series_uids)
     print(f"Total series: {len(all_series_uids)}")
     print(f"Ya procesadas: {len(processed)}")
     print(f"Pendientes: {len(pending_uids)}")
@@ -146,21 +531,46 @@ def main():
         print("¡Todo está al día!")
         return
 
-    # 3. Procesar por Lotes (Batch)
-    BATCH_SIZE = 5 # Tamaño pequeño para controlar el espacio en disco
-    total_batches = (len(pending_uids) + BATCH_SIZE - 1) // BATCH_SIZE
-    
-    for i in range(total_batches):
-        start = i * BATCH_SIZE
-        end = min((i + 1) * BATCH_SIZE, len(pending_uids))
-        batch = pending_uids[start:end]
-        
-        print(f"\n--- Procesando Lote {i+1}/{total_batches} ---")
-        process_batch(batch)
-        
-        # Pausa breve para no saturar
-        time.sleep(1)
+    # 3. Procesar por Lotes (Batch), retomando primero lo interrumpido.
+    # Los lotes se arman por tiempo de descarga estimado (series pequeñas en lotes grandes,
+    # las enormes solas) y sin pasar de un tercio del espacio temporal admisible, para que
+    # quepan a la vez el lote que se descarga, el que se convierte y el que se borra.
+    # Con tmpfs, además, lo bastante pequeños para que esos lotes quepan en RAM.
+    budget = DiskBudget()
+    max_bytes = budget.headroom(TEMP_DICOM_DIR) // 3
+    if get_staging().enabled:
+        max_bytes = min(max_bytes, get_staging().batch_bytes(3))
+    sizer = BatchSizer(_series_sizes, MAX_WORKERS, max_bytes=max_bytes)
+    items = plan_work(pending_uids, sizer)
+
+    stopped = None
+    if PIPELINE_MODE:
+        # Descarga, conversión y limpieza solapadas entre lotes consecutivos
+        stopped = run_pipeline(items, budget, sizer)
+    else:
+        for i, item in enumerate(items):
+            print(f"\n--- Procesando Lote {i+1} ({_describe_item(item)}) ---")
+            try:
+                with budget.admit(estimate_item(item), key=item["batch_dir"].name):
+                    process_item(item, sizer)
+            except Exception as e:
+                stopped = e
+                break
+            
+            # Pausa breve para no saturar
+            time.sleep(1)
+    close_journal()
+    finish_run()
+    build_fingerprint(OUTPUT_NIFTI_DIR.parent)
+    print(f"📶 Descarga medida: {sizer.describe()}.")
 
+    # Lo no empezado sigue pendiente en el diario: la próxima corrida lo retoma
+    if isinstance(stopped, DiskBudgetExceeded):
+        print(f"\n⛔ ALTO: {stopped.strerror}. Libera espacio y reanuda.")
+        return
+    if stopped:
+        print(f"\n❌ El pipeline se detuvo y no se empezaron más lotes: {stopped}. Revisa el error y reanuda.")
+        return
     print("\n🎉 ¡Misión cumplida! Todos los datos han sido procesados.")
 
 if __name__ == "__main__":
@@ -1,8 +1,16 @@
 import os
 import shutil
-import json
+import errno
+import threading
+from collections import Counter
 from pathlib import Path
-from tqdm import tqdm
+from .file_placement import MOVE_STRATEGIES, move_file, format_placement_stats
+from .copy_engine import COPY_WORKERS, run_transfers
+from .checksum_manifest import load_manifest, append_manifest, sha256_file
+from .content_store import store_output
+from .dataset_json import create_dataset_json
+from .pipeline_metrics import stage, start_run, finish_run
+from .disk_budget import DiskBudget
 
 # --- CONFIGURACIÓN ---
 # Ajusta la ruta a donde tengas el repositorio oficial de KiTS23
@@ -11,30 +19,83 @@ PROJECT_ROOT = Path(__file__).resolve().parents[2]
 RAW_KITS_DIR = (PROJECT_ROOT / "scripts/kits23/dataset").resolve()
 NNUNET_RAW_DIR = (PROJECT_ROOT / "data/raw/nnUNet_raw/Dataset101_KiTS23").resolve()
 
-print(f"Ruta base: {PROJECT_ROOT}")
-print(f"Origen KiTS: {RAW_KITS_DIR}")
-print(f"Destino nnU-Net: {NNUNET_RAW_DIR}")
+# Cómo mover cada archivo: rename (mismo disco, instantáneo) -> reflink -> copia + borrado
+PLACEMENT_STRATEGIES = MOVE_STRATEGIES
+# Registrar en checksums.sha256 del dataset el SHA-256 de los archivos que ya se leyeron
+# enteros (copias entre discos, casos repetidos). Los renombrados y reflinks no se leen:
+# calcularlo convertiría un movimiento instantáneo en una lectura de todo el dataset.
+RECORD_CHECKSUMS = True
+# Casos moviéndose a la vez cuando hay que copiar entre discos
+NUM_COPY_WORKERS = COPY_WORKERS
 # ---------------------
 
-def create_dataset_json(output_dir, num_training_cases):
-    """Crea el archivo dataset.json requerido por nnU-Net."""
-    json_dict = {
-        "channel_names": { "0": "CT" },
-        "labels": { "background": 0, "kidney": 1, "tumor": 2, "cyst": 3 },
-        "numTraining": num_training_cases,
-        "file_ending": ".nii.gz",
-        "name": "KiTS23",
-        "reference": "KiTS23 Challenge",
-        "tensorImageSize": "3D", 
-        "modality": { "0": "CT" } 
-    }
-    
-    output_dir.mkdir(parents=True, exist_ok=True)
-    with open(output_dir / "dataset.json", 'w') as f:
-        json.dump(json_dict, f, indent=4)
-    print(f"✅ dataset.json creado.")
+# El manifiesto se comparte entre los hilos de copia
+_manifest_lock = threading.Lock()
+
+class ContentConflict(FileExistsError):
+    """El destino ya existe con otro contenido: el origen se conserva."""
+
+def case_paths(case_dir, imagesTr, labelsTr):
+    """[(origen, destino)] de imagen y etiqueta de un caso."""
+    case_id = case_dir.name
+    return [(case_dir / "imaging.nii.gz", imagesTr / f"{case_id}_0000.nii.gz"),
+            (case_dir / "segmentation.nii.gz", labelsTr / f"{case_id}.nii.gz")]
+
+def record_checksum(manifest, rel_path, digest):
+    with _manifest_lock:
+        if manifest.get(rel_path) != digest:
+            append_manifest(NNUNET_RAW_DIR, rel_path, digest)
+            manifest[rel_path] = digest
+
+def move_case(case_dir, imagesTr, labelsTr, manifest, progress=None):
+    """Mueve imagen y etiqueta de un caso y borra su carpeta. Devuelve las estrategias usadas."""
+    strategies = []
+    with stage("move", key=case_dir.name) as m:
+        # 1. PROCESAR IMAGEN Y ETIQUETA
+        # move_file solo borra el origen si el destino quedó verificado
+        for src, dst in case_paths(case_dir, imagesTr, labelsTr):
+            rel_path = dst.relative_to(NNUNET_RAW_DIR).as_posix()
+            m["bytes_in"] += src.stat().st_size
+            if dst.exists():
+                # De una corrida anterior: solo se borra el origen si el contenido es idéntico
+                digest = sha256_file(src)
+                with _manifest_lock:
+                    expected = manifest.get(rel_path)
+                if digest != (expected or sha256_file(dst)):
+                    raise ContentConflict(f"{dst.name} ya existe con otro contenido")
+                os.remove(src) # 🗑️ BORRAR ORIGEN
+                if progress:
+                    progress(dst.stat().st_size)
+            else:
+                strategy, digest = move_file(src, dst, PLACEMENT_STRATEGIES, progress)
+                strategies.append(strategy)
+            if RECORD_CHECKSUMS and digest:
+                record_checksum(manifest, rel_path, digest)
+            # Si otra carpeta ya tenía este contenido, el destino pasa a compartir su objeto
+            store_output(dst, digest)
+            m["bytes_out"] += dst.stat().st_size
+
+    # 2. LIMPIEZA FINAL DEL CASO
+    # Si ya borramos las imágenes, borramos la carpeta del caso vacía
+    # Ignoramos errores aquí por si queda algún archivo basura (ej. .DS_Store)
+    shutil.rmtree(case_dir, ignore_errors=True)
+    return strategies
+
+def case_needs(case_dir, imagesTr, labelsTr):
+    """Bytes nuevos que ocupará el caso en el destino: nada si se puede renombrar (mismo disco)."""
+    needs = {}
+    for src, dst in case_paths(case_dir, imagesTr, labelsTr):
+        if dst.exists() or src.stat().st_dev == dst.parent.stat().st_dev:
+            continue
+        needs[dst.parent] = needs.get(dst.parent, 0) + src.stat().st_size
+    return needs
 
 def main():
+    start_run()
+    print(f"Ruta base: {PROJECT_ROOT}")
+    print(f"Origen KiTS: {RAW_KITS_DIR}")
+    print(f"Destino nnU-Net: {NNUNET_RAW_DIR}")
+
     if not RAW_KITS_DIR.exists():
         print(f"❌ Error: No existe {RAW_KITS_DIR}")
         return
@@ -53,61 +114,42 @@ def main():
 
     print(f"✅ Se encontraron {len(case_folders)} casos.")
     
-    processed_count = 0
-    
-    # ⚠️ IMPORTANTE: Si tu disco ya está lleno, borra manualmente
-    # la carpeta 'nnUNet_raw' antes de correr esto, o fallará al intentar copiar el primero.
-
-    for case_dir in tqdm(case_folders, desc="Moviendo y limpiando"):
-        case_id = case_dir.name 
-        
-        src_img = case_dir / "imaging.nii.gz"
-        src_seg = case_dir / "segmentation.nii.gz"
-        
-        if not src_img.exists() or not src_seg.exists():
-            continue 
-
-        dst_img = imagesTr / f"{case_id}_0000.nii.gz"
-        dst_seg = labelsTr / f"{case_id}.nii.gz"
-        
-        try:
-            # 1. PROCESAR IMAGEN
-            if not dst_img.exists():
-                shutil.copy2(src_img, dst_img) # Copiar
-            
-            # Verificar integridad básica (existencia y tamaño > 0)
-            if dst_img.exists() and dst_img.stat().st_size > 0:
-                os.remove(src_img) # 🗑️ BORRAR ORIGEN
-            else:
-                raise Exception(f"Fallo al copiar imagen {case_id}")
+    manifest = load_manifest(NNUNET_RAW_DIR)
+    case_folders = [c for c in case_folders
+                    if all(src.exists() for src, _ in case_paths(c, imagesTr, labelsTr))]
+    sizes = [sum(src.stat().st_size for src, _ in case_paths(c, imagesTr, labelsTr)) for c in case_folders]
 
-            # 2. PROCESAR ETIQUETA
-            if not dst_seg.exists():
-                shutil.copy2(src_seg, dst_seg) # Copiar
+    # ⚠️ IMPORTANTE: En el mismo disco los archivos se renombran (sin espacio extra).
+    # Entre discos cada caso se copia antes de borrar el origen: solo empieza si la copia
+    # cabe bajo la marca de agua del destino contando los casos que se están moviendo.
+    budget = DiskBudget()
 
-            if dst_seg.exists() and dst_seg.stat().st_size > 0:
-                os.remove(src_seg) # 🗑️ BORRAR ORIGEN
-            else:
-                raise Exception(f"Fallo al copiar etiqueta {case_id}")
+    def transfer(case_dir, progress):
+        with budget.admit(case_needs(case_dir, imagesTr, labelsTr), key=case_dir.name):
+            return move_case(case_dir, imagesTr, labelsTr, manifest, progress)
 
-            # 3. LIMPIEZA FINAL DEL CASO
-            # Si ya borramos las imágenes, borramos la carpeta del caso vacía
-            # Ignoramos errores aquí por si queda algún archivo basura (ej. .DS_Store)
-            shutil.rmtree(case_dir, ignore_errors=True) 
+    results = run_transfers(case_folders, transfer, sizes, NUM_COPY_WORKERS, desc="Moviendo y limpiando")
 
+    processed_count = 0
+    placements = Counter()
+    for case_dir, (strategies, error) in zip(case_folders, results):
+        if error is None:
+            placements.update(strategies)
             processed_count += 1
-            
-        except OSError as e:
-            # Si nos quedamos sin espacio justo a la mitad, paramos para no corromper datos
-            if e.errno == 28: 
-                print(f"\n⛔ ALTO: Espacio lleno en {case_id}. Libera espacio y reanuda.")
-                break
-            print(f"Error en {case_id}: {e}")
-        except Exception as e:
-            print(f"Error genérico en {case_id}: {e}")
+        elif isinstance(error, ContentConflict):
+            print(f"⚠️ {case_dir.name} no se movió: {error}. Revisa cuál de los dos es el bueno.")
+        elif isinstance(error, OSError) and error.errno == errno.ENOSPC:
+            # El presupuesto no deja empezar un caso que no cabe; un ENOSPC real (otro proceso
+            # llenó el disco) también detiene los pendientes para no corromper datos
+            print(f"\n⛔ ALTO: Sin espacio para {case_dir.name} ({error.strerror}). Libera espacio y reanuda.")
+        elif error != "cancelado":
+            print(f"Error en {case_dir.name}: {error}")
 
     print(f"\n✨ Completado. {processed_count} casos movidos.")
-    
+    print(f"🔗 Archivos colocados: {format_placement_stats(placements)}.")
+    finish_run()
+    print("🧬 Huella de nnU-Net (dataset_fingerprint.json): python -m src.data fingerprint")
+
     if processed_count > 0:
         create_dataset_json(NNUNET_RAW_DIR, processed_count)
 
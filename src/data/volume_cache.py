@@ -0,0 +1,256 @@
+import os
+import json
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from tqdm import tqdm
+from .pipeline_metrics import stage
+
+# --- CONFIGURACIÓN ---
+# Copia sin comprimir de cada .nii.gz como .npy (se abre con np.load(mmap_mode="r")
+# y se lee un corte o un bloque sin descomprimir el volumen entero)
+CACHE_DIR = Path(os.environ.get("AURA_VOLUME_CACHE_DIR", "data/volume_cache"))
+# Llenar la caché como salida secundaria de la conversión/reconstrucción.
+# Ocupa el tamaño sin comprimir (varias veces el .nii.gz); por eso viene apagada.
+CACHE_ON_CONVERT = os.environ.get("AURA_VOLUME_CACHE", "0") == "1"
+# Datasets que recorre el comando `cache`
+DATASET_DIRS = [
+    Path("data/raw/nnUNet_raw/Dataset101_KiTS23"),
+    Path("data/raw/nnUNet_raw/Dataset102_TCGA"),
+]
+NUM_WORKERS = os.cpu_count() or 1
+# ---------------------
+
+INDEX_NAME = "index.sqlite"
+FILE_ENDING = ".nii.gz"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS volumes (
+    source TEXT PRIMARY KEY,
+    dataset TEXT,
+    case_id TEXT,
+    role TEXT,
+    npy_path TEXT,
+    source_size INTEGER,
+    source_mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS volumes_case ON volumes(dataset, case_id);
+"""
+
+
+def open_index(cache_dir=CACHE_DIR):
+    """Índice SQLite: archivo fuente -> .npy, con el tamaño y mtime de la fuente al cachearla."""
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # Varios procesos de conversión escriben a la vez: esperamos el bloqueo en lugar de fallar
+    conn = sqlite3.connect(str(cache_dir / INDEX_NAME), timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def describe_source(source_path):
+    """(dataset, case_id, role, ruta relativa del .npy) de un NIfTI de nnU-Net.
+
+    imagesTr/case_00000_0000.nii.gz -> (Dataset101_KiTS23, case_00000, "image_0000", ...)
+    labelsTr/case_00000.nii.gz      -> (Dataset101_KiTS23, case_00000, "label", ...)
+    """
+    source_path = Path(source_path)
+    stem = source_path.name[:-len(FILE_ENDING)]
+    dataset = source_path.parent.parent.name
+    if source_path.parent.name.startswith("labels"):
+        case_id, role = stem, "label"
+    else:
+        case_id, _, channel = stem.rpartition("_")
+        role = f"image_{channel}"
+    return dataset, case_id, role, f"{dataset}/{source_path.parent.name}/{stem}.npy"
+
+
+def read_nifti_header(source_path):
+    """Geometría del NIfTI, solo cabecera, en el orden de ejes de la caché (z, y, x)."""
+    import nibabel as nib
+    header = nib.load(source_path).header
+    return {
+        "axes": "zyx",
+        "shape": [int(n) for n in header.get_data_shape()[:3]][::-1],
+        "spacing": [float(z) for z in header.get_zooms()[:3]][::-1],
+        # Affine del NIfTI original (índices x, y, z -> mundo RAS)
+        "affine": header.get_best_affine().tolist(),
+    }
+
+
+def cache_volume(source_path, array, cache_dir=CACHE_DIR):
+    """Guarda `array` (orden z, y, x) como caché de `source_path`, ya escrito en disco.
+
+    El .npy y su cabecera .json se escriben con reemplazo atómico y luego se
+    registran en el índice con el tamaño y mtime actuales de la fuente; si la
+    fuente cambia después, la entrada deja de ser válida. Devuelve la ruta del .npy.
+    """
+    import numpy as np
+    source_path = Path(source_path).resolve()
+    cache_dir = Path(cache_dir)
+    dataset, case_id, role, rel_npy = describe_source(source_path)
+    header = read_nifti_header(source_path)
+    if tuple(header["shape"]) != tuple(array.shape[:3]):
+        raise ValueError(f"forma {array.shape} no coincide con la cabecera {header['shape']}")
+    st = source_path.stat()
+    header.update({"dtype": str(array.dtype), "source": str(source_path)})
+
+    npy_path = cache_dir / rel_npy
+    npy_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = npy_path.with_name(f".{npy_path.name}.tmp")
+    with open(tmp_path, "wb") as f:
+        # Un array C-contiguo se escribe tal cual, sin copia intermedia
+        np.save(f, np.ascontiguousarray(array))
+    os.replace(tmp_path, npy_path)
+    json_path = npy_path.with_suffix(".json")
+    tmp_json = json_path.with_name(f".{json_path.name}.tmp")
+    with open(tmp_json, "w") as f:
+        json.dump(header, f, indent=2)
+    os.replace(tmp_json, json_path)
+
+    conn = open_index(cache_dir)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO volumes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (str(source_path), dataset, case_id, role, rel_npy, st.st_size, st.st_mtime_ns))
+    conn.close()
+    return npy_path
+
+
+def cache_converted(source_path, array):
+    """Salida secundaria de los conversores: cachea el volumen si CACHE_ON_CONVERT está activo.
+
+    Un fallo aquí no invalida la conversión (el comando `cache` lo repone).
+    """
+    if not CACHE_ON_CONVERT:
+        return None
+    try:
+        with stage("volume_cache", key=Path(source_path).name, bytes_in=array.nbytes) as m:
+            npy_path = cache_volume(source_path, array)
+            m["bytes_out"] = npy_path.stat().st_size
+        return npy_path
+    except Exception as e:
+        print(f"⚠️ No se pudo cachear {Path(source_path).name}: {e}")
+        return None
+
+
+def _is_fresh(row, source_path):
+    try:
+        st = os.stat(source_path)
+    except OSError:
+        return False
+    return st.st_size == row["source_size"] and st.st_mtime_ns == row["source_mtime_ns"]
+
+
+def open_cached(source_path, mmap_mode="r", cache_dir=CACHE_DIR):
+    """(array, cabecera) desde la caché, o None si no hay entrada o la fuente cambió.
+
+    Con mmap_mode="r" no se lee nada hasta que se accede a los datos:
+    `vol[z0:z1]` solo toca los cortes pedidos.
+    """
+    import numpy as np
+    source_path = Path(source_path).resolve()
+    conn = open_index(cache_dir)
+    row = conn.execute("SELECT * FROM volumes WHERE source = ?", (str(source_path),)).fetchone()
+    conn.close()
+    if row is None or not _is_fresh(row, source_path):
+        return None
+    npy_path = Path(cache_dir) / row["npy_path"]
+    try:
+        with open(npy_path.with_suffix(".json"), "r") as f:
+            header = json.load(f)
+        return np.load(npy_path, mmap_mode=mmap_mode), header
+    except (OSError, ValueError):
+        return None
+
+
+def load_volume(source_path, populate=True, mmap_mode="r", cache_dir=CACHE_DIR):
+    """Volumen (z, y, x) de un NIfTI: desde la caché si está al día; si no, lo descomprime.
+
+    Con `populate` el volumen descomprimido se guarda en la caché para la
+    próxima vez y se devuelve ya mapeado. Devuelve (array, cabecera).
+    """
+    import numpy as np
+    import nibabel as nib
+    cached = open_cached(source_path, mmap_mode, cache_dir)
+    if cached is not None:
+        return cached
+    data = np.asanyarray(nib.load(source_path).dataobj).T
+    if populate:
+        cache_volume(source_path, data, cache_dir)
+        cached = open_cached(source_path, mmap_mode, cache_dir)
+        if cached is not None:
+            return cached
+    header = read_nifti_header(source_path)
+    header.update({"dtype": str(data.dtype), "source": str(Path(source_path).resolve())})
+    return data, header
+
+
+def find_case(case_id, dataset=None, cache_dir=CACHE_DIR):
+    """Entradas del índice de un caso: {role: ruta del .npy} (solo las que siguen al día)."""
+    conn = open_index(cache_dir)
+    query = "SELECT * FROM volumes WHERE case_id = ?"
+    params = [case_id]
+    if dataset:
+        query += " AND dataset = ?"
+        params.append(dataset)
+    rows = conn.execute(query, params).fetchall()
+    conn.close()
+    return {row["role"]: Path(cache_dir) / row["npy_path"] for row in rows if _is_fresh(row, row["source"])}
+
+
+def prune_cache(cache_dir=CACHE_DIR):
+    """Borra las entradas cuya fuente ya no existe o cambió (tamaño o mtime). Devuelve cuántas."""
+    cache_dir = Path(cache_dir)
+    conn = open_index(cache_dir)
+    stale = [row for row in conn.execute("SELECT * FROM volumes") if not _is_fresh(row, row["source"])]
+    for row in stale:
+        npy_path = cache_dir / row["npy_path"]
+        for path in (npy_path, npy_path.with_suffix(".json")):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+    with conn:
+        conn.executemany("DELETE FROM volumes WHERE source = ?", ((row["source"],) for row in stale))
+    conn.close()
+    return len(stale)
+
+
+def _cache_job(source_path):
+    with stage("volume_cache", key=Path(source_path).name) as m:
+        array, _ = load_volume(source_path, populate=True)
+        m["bytes_out"] = array.nbytes
+    return source_path
+
+
+def build_cache(dataset_dir, num_workers=NUM_WORKERS, cache_dir=CACHE_DIR):
+    """Cachea los NIfTI de un dataset que no estén en la caché o hayan cambiado.
+
+    Pasada independiente para los datasets que se colocaron sin leer los
+    volúmenes (kits-organize, kits-move) o se convirtieron sin la caché activa.
+    """
+    dataset_dir = Path(dataset_dir)
+    sources = sorted(p for sub in ("imagesTr", "labelsTr") for p in (dataset_dir / sub).glob(f"*{FILE_ENDING}"))
+    todo = [p for p in sources if open_cached(p, cache_dir=cache_dir) is None]
+    print(f"🗃️ {dataset_dir.name}: {len(todo)} volúmenes por cachear "
+          f"({len(sources) - len(todo)} ya al día).")
+    if todo:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for _ in tqdm(executor.map(_cache_job, todo), total=len(todo), desc="Cacheando volúmenes"):
+                pass
+    return len(todo)
+
+
+def main():
+    removed = prune_cache()
+    if removed:
+        print(f"🧹 {removed} entradas obsoletas eliminadas de la caché.")
+    for dataset_dir in DATASET_DIRS:
+        if dataset_dir.exists():
+            build_cache(dataset_dir)
+    print(f"✅ Caché de volúmenes en: {CACHE_DIR}")
+
+
+if __name__ == "__main__":
+    main()